@@ -0,0 +1,333 @@
+"""
+AI planning in a worker process.
+
+AIFleet.update steers every AI car at the next track point, which is all the thinking that fits
+in a simulation step on the render thread. An AIPlanner moves the thinking to another process,
+where it can afford to look further: each car aims at a point ahead along the road scaled by
+its speed, brakes for the corners coming up, and moves over to pass slower cars (the player
+included) instead of running into them.
+
+The two processes share two blocks of memory and never send each other messages:
+
+- the track geometry, written once when the planner starts
+- a control block holding the cars' state, written by the game every simulation step, and the
+  commands (a point to steer at and a target speed per car), written by the planner at its own
+  rate, PLAN_RATE plans a second
+
+Each half of the control block has one writer and is guarded by a sequence lock: the writer
+makes the counter odd while it writes and even again when done, and a reader that saw the same
+even count before and after copying knows its copy is consistent. The planner retries until it
+gets one; the game never waits, it takes the newest consistent commands or keeps driving on
+the ones it had. Commands carry the race they were planned for, so a restarted race never
+steers by plans from the last one.
+"""
+import multiprocessing
+import time
+from multiprocessing import shared_memory
+import numpy as np
+
+PLAN_RATE = 30  # Plans per second
+MAX_OTHERS = 8  # Cars outside the fleet (the player) the planner steers around
+SPEED_SCALE = 60.0  # Car speeds are in world units per 1/60 s
+
+LOOKAHEAD_DISTANCE = 6.0  # Cars aim this far ahead along the road when standing still
+LOOKAHEAD_TIME = 0.4  # and this many seconds of driving further when moving
+CORNER_WINDOW = 30.0  # Corners are judged by how far the road turns over this distance ahead
+CORNER_WEIGHT = 0.5  # Corner turn in degrees per degree of heading error, for the fleet's corner_slowdown
+PASSING_RANGE = 15.0  # A slower car less than this far ahead in the same lane gets overtaken
+FOLLOWING_DISTANCE = 6.0  # Closer than this behind a car being passed, match its speed
+LANE_WIDTH = 2.5  # Cars closer than this side by side share a lane
+PASSING_OFFSET = 3.0  # Overtaking cars move this far to the side of the car they pass
+LANE_RETURN = 0.5  # Fraction of the way back to the middle of the road a car moves per second
+EDGE_MARGIN = 1.5  # Lanes stay this far inside the road edges
+MAX_LAG = 60  # Steps the commands may fall behind the published state, half a second at 120 Hz
+
+TRACK_ARRAYS = (("point_array", "points"), ("half_widths", "half_widths"), ("tangents", "tangents"),
+                ("normals", "normals"), ("segment_lengths", "segment_lengths"), ("arc_length", "arc_length"))
+
+# Control block header entries
+STATE_SEQ, COMMAND_SEQ, STOP, RACE, COMMAND_RACE, STATE_STEP, COMMAND_STEP, NUM_OTHERS = range(8)
+HEADER_SIZE = 8
+# Car state columns
+X, Z, ROTATION, SPEED, NEAREST, CRUISE = range(6)
+STATE_COLUMNS = 6
+# Command columns
+AIM_X, AIM_Z, TARGET_SPEED = range(3)
+COMMAND_COLUMNS = 3
+
+class SharedArrays:
+    """
+    Named numpy arrays laid out one after another in a shared memory block. layout is a list of
+    (name, dtype, shape); another process opens the same arrays from the block's name and layout.
+    """
+    def __init__(self, layout, name=None):
+        self.layout = [(array_name, np.dtype(dtype).str, tuple(shape)) for array_name, dtype, shape in layout]
+        offsets = []
+        size = 0
+        for _, dtype, shape in self.layout:
+            size = -(-size // 64) * 64  # Every array starts on a cache line
+            offsets.append(size)
+            size += np.dtype(dtype).itemsize * int(np.prod(shape, dtype=np.int64))
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=max(size, 1))
+        self.arrays = {array_name: np.ndarray(shape, dtype, buffer=self.shm.buf, offset=offset)
+                       for (array_name, dtype, shape), offset in zip(self.layout, offsets)}
+        if name is None:
+            for array in self.arrays.values():
+                array.fill(0)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def __getitem__(self, array_name):
+        return self.arrays[array_name]
+
+    def close(self, unlink=False):
+        # The views into the block have to go before it can be closed
+        self.arrays = {}
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+class SeqLock:
+    """The sequence counter guarding one writer's half of the control block."""
+    def __init__(self, header, index):
+        self.header = header
+        self.index = index
+
+    def begin_write(self):
+        self.header[self.index] += 1
+
+    def end_write(self):
+        self.header[self.index] += 1
+
+    def begin_read(self):
+        # None while a write is in progress
+        seq = int(self.header[self.index])
+        return None if seq & 1 else seq
+
+    def still_valid(self, seq):
+        return int(self.header[self.index]) == seq
+
+def control_layout(num_cars):
+    return [
+        ("header", np.int64, (HEADER_SIZE,)),
+        ("state", np.float64, (num_cars, STATE_COLUMNS)),
+        ("others", np.float64, (MAX_OTHERS, 3)),  # x, z and speed of the cars outside the fleet
+        ("commands", np.float64, (num_cars, COMMAND_COLUMNS)),
+    ]
+
+class Planner:
+    """
+    The driving decisions for a fleet on one track, made from the state of every car.
+    It works on plain arrays so it can be run and tested without a second process.
+    """
+    def __init__(self, track, num_cars, min_corner_speed=0.2, corner_slowdown=0.001):
+        self.points = np.asarray(track["points"], dtype=np.float64)[:, [0, 2]]
+        self.tangents = np.asarray(track["tangents"], dtype=np.float64)[:, [0, 2]]
+        self.normals = np.asarray(track["normals"], dtype=np.float64)[:, [0, 2]]
+        self.half_widths = np.asarray(track["half_widths"], dtype=np.float64)
+        self.segment_lengths = np.asarray(track["segment_lengths"], dtype=np.float64)
+        self.arc_length = np.asarray(track["arc_length"], dtype=np.float64)
+        self.length = float(self.arc_length[-1])
+        self.min_corner_speed = min_corner_speed
+        self.corner_slowdown = corner_slowdown
+        self.corners = self.corner_severity()
+        self.lanes = np.zeros(num_cars)  # Offset from the centerline each car keeps to, positive to the left
+        self.last_plan_time = None
+
+    def corner_severity(self):
+        # Degrees the road turns over the CORNER_WINDOW after each point
+        previous = np.roll(self.tangents, 1, axis=0)
+        turns = np.abs(np.arctan2(previous[:, 0] * self.tangents[:, 1] - previous[:, 1] * self.tangents[:, 0],
+                                  np.sum(previous * self.tangents, axis=1)))
+        num_points = len(turns)
+        total = np.concatenate([[0.0], np.cumsum(np.degrees(np.concatenate([turns, turns])))])
+        starts = self.arc_length[:-1]
+        ends = np.searchsorted(np.concatenate([starts, starts + self.length]), starts + CORNER_WINDOW, side="right")
+        return total[ends] - total[np.arange(num_points) + 1]
+
+    def locate(self, x, z, nearest):
+        # Distance along the lap and signed offset across the road of cars at (x, z)
+        lost = nearest < 0
+        if lost.any():
+            dist_sq = ((self.points[np.newaxis, :, 0] - x[lost, np.newaxis]) ** 2 +
+                       (self.points[np.newaxis, :, 1] - z[lost, np.newaxis]) ** 2)
+            nearest = nearest.copy()
+            nearest[lost] = np.argmin(dist_sq, axis=1)
+        offset = np.stack([x, z], axis=1) - self.points[nearest]
+        along = np.sum(offset * self.tangents[nearest], axis=1)
+        across = np.sum(offset * self.normals[nearest], axis=1)
+        return nearest, (self.arc_length[nearest] + along) % self.length, across
+
+    def plan(self, state, others, now, out):
+        """Fill out (cars x COMMAND_COLUMNS) with the commands for the state of every car."""
+        dt = 0.0 if self.last_plan_time is None else min(now - self.last_plan_time, 0.5)
+        self.last_plan_time = now
+        x, z, speed, cruise = state[:, X], state[:, Z], state[:, SPEED], state[:, CRUISE]
+        nearest, distance, across = self.locate(x, z, state[:, NEAREST].astype(np.int64))
+        others_nearest, others_distance, others_across = self.locate(
+            others[:, 0], others[:, 1], np.full(len(others), -1, dtype=np.int64))
+
+        # The nearest slower car ahead in each car's lane, among the fleet and the others
+        all_distance = np.concatenate([distance, others_distance])
+        all_across = np.concatenate([across, others_across])
+        all_speed = np.concatenate([speed, others[:, 2]])
+        gap = (all_distance[np.newaxis, :] - distance[:, np.newaxis]) % self.length
+        blocking = ((gap > 0) & (gap < PASSING_RANGE) &
+                    (np.abs(all_across[np.newaxis, :] - self.lanes[:, np.newaxis]) < LANE_WIDTH) &
+                    (all_speed[np.newaxis, :] < speed[:, np.newaxis]))
+        gap = np.where(blocking, gap, np.inf)
+        blocker = np.argmin(gap, axis=1)
+        blocked = np.isfinite(gap[np.arange(len(gap)), blocker])
+
+        # Pull out to the side of the blocker with more road, or drift back to the middle
+        half_widths = self.half_widths[nearest]
+        blocker_across = all_across[blocker]
+        passing_lane = blocker_across + np.where(blocker_across < 0, PASSING_OFFSET, -PASSING_OFFSET)
+        self.lanes = np.where(blocked, passing_lane, self.lanes * (1 - LANE_RETURN) ** dt)
+        np.clip(self.lanes, -(half_widths - EDGE_MARGIN), half_widths - EDGE_MARGIN, out=self.lanes)
+
+        # Aim down the road in the chosen lane, further the faster the car goes
+        aim_distance = (distance + LOOKAHEAD_DISTANCE + speed * SPEED_SCALE * LOOKAHEAD_TIME) % self.length
+        aim_idx = np.clip(np.searchsorted(self.arc_length, aim_distance, side="right") - 1, 0, len(self.points) - 1)
+        aim = (self.points[aim_idx] + self.tangents[aim_idx] * (aim_distance - self.arc_length[aim_idx])[:, np.newaxis] +
+               self.normals[aim_idx] * self.lanes[:, np.newaxis])
+
+        # Brake for the sharper of the corner here and the one at the aim point
+        corner = np.maximum(self.corners[nearest], self.corners[aim_idx])
+        target_speed = np.clip(cruise - self.corner_slowdown * corner / CORNER_WEIGHT, self.min_corner_speed, cruise)
+
+        # Until a car is out of the way, don't close in on it any further
+        too_close = blocked & (gap[np.arange(len(gap)), blocker] < FOLLOWING_DISTANCE)
+        target_speed[too_close] = np.minimum(target_speed[too_close], all_speed[blocker[too_close]])
+
+        out[:, AIM_X] = aim[:, 0]
+        out[:, AIM_Z] = aim[:, 1]
+        out[:, TARGET_SPEED] = target_speed
+
+def run_planner(track_name, track_layout, control_name, control_layout, options, rate):
+    # Worker process: plan from the newest consistent state until told to stop
+    track_block = SharedArrays(track_layout, track_name)
+    control = SharedArrays(control_layout, control_name)
+    header = control["header"]
+    state_lock = SeqLock(header, STATE_SEQ)
+    command_lock = SeqLock(header, COMMAND_SEQ)
+    planner = Planner({name: track_block[name] for name, _, _ in track_layout}, len(control["state"]), **options)
+    state = np.empty_like(control["state"])
+    others = np.empty_like(control["others"])
+    commands = np.empty_like(control["commands"])
+    last_step = None
+    period = 1.0 / rate
+    try:
+        while not header[STOP]:
+            started = time.perf_counter()
+            seq = state_lock.begin_read()
+            if seq is None:
+                continue
+            np.copyto(state, control["state"])
+            np.copyto(others, control["others"])
+            race, step, num_others = int(header[RACE]), int(header[STATE_STEP]), int(header[NUM_OTHERS])
+            if not state_lock.still_valid(seq):
+                continue
+            if step and step != last_step:  # Step 0: no state has been published yet
+                last_step = step
+                planner.plan(state, others[:num_others], started, commands)
+                command_lock.begin_write()
+                np.copyto(control["commands"], commands)
+                header[COMMAND_RACE] = race
+                header[COMMAND_STEP] = step
+                command_lock.end_write()
+            time.sleep(max(0.0, period - (time.perf_counter() - started)))
+    finally:
+        control.close()
+        track_block.close()
+
+class AIPlanner:
+    """
+    A Planner running in a worker process for a fleet of num_cars on track (a Track, or anything
+    with its geometry table). The game publishes the cars' state every step and polls for commands.
+    """
+    def __init__(self, track, num_cars, rate=PLAN_RATE, **options):
+        self.num_cars = num_cars
+        track_arrays = {name: np.ascontiguousarray(getattr(track, attribute)) for attribute, name in TRACK_ARRAYS}
+        self.track_block = SharedArrays([(name, array.dtype, array.shape) for name, array in track_arrays.items()])
+        for name, array in track_arrays.items():
+            self.track_block[name][...] = array
+        self.control = SharedArrays(control_layout(num_cars))
+        self.header = self.control["header"]
+        self.header[COMMAND_RACE] = -1  # The zero-filled commands belong to no race until the first plan
+        self.state_lock = SeqLock(self.header, STATE_SEQ)
+        self.command_lock = SeqLock(self.header, COMMAND_SEQ)
+        self.commands = np.zeros((num_cars, COMMAND_COLUMNS))  # Newest consistent commands, valid once have_commands
+        self.incoming = np.zeros((num_cars, COMMAND_COLUMNS))  # Copied into first, in case the copy comes out torn
+        self.have_commands = False
+        self.command_seq = None  # Sequence count the commands were copied at
+        self.command_step = -1  # Step of the state the commands were planned from
+        self.race = 0  # Counts restarts, so plans for an earlier race are ignored
+        self.step = 0
+
+        # Spawned rather than forked, so the worker doesn't inherit the window and GL context
+        context = multiprocessing.get_context("spawn")
+        self.process = context.Process(
+            target=run_planner, name="ai-planner", daemon=True,
+            args=(self.track_block.name, self.track_block.layout, self.control.name, self.control.layout,
+                  options, rate))
+        self.process.start()
+
+    def publish(self, positions, rotations, speeds, nearest_idx, cruise_speeds, others=()):
+        """Write the fleet's state, and the x, z and speed of up to MAX_OTHERS other cars, for the next plan."""
+        others = np.reshape(np.asarray(others, dtype=np.float64), (-1, 3))[:MAX_OTHERS]
+        state = self.control["state"]
+        self.step += 1
+        self.state_lock.begin_write()
+        state[:, X] = positions[:, 0]
+        state[:, Z] = positions[:, 2]
+        state[:, ROTATION] = rotations
+        state[:, SPEED] = speeds
+        state[:, NEAREST] = nearest_idx
+        state[:, CRUISE] = cruise_speeds
+        self.control["others"][:len(others)] = others
+        self.header[NUM_OTHERS] = len(others)
+        self.header[RACE] = self.race
+        self.header[STATE_STEP] = self.step
+        self.state_lock.end_write()
+
+    def poll(self):
+        """
+        The newest commands for this race, or None before the first, once they are more than
+        MAX_LAG steps old, or if the worker has died, so the fleet drives the racing line instead.
+        Never waits: if the planner is writing right now, the commands from before are returned.
+        """
+        if not self.process.is_alive():
+            return None
+        seq = self.command_lock.begin_read()
+        if seq is not None and seq != self.command_seq:
+            race, step = int(self.header[COMMAND_RACE]), int(self.header[COMMAND_STEP])
+            np.copyto(self.incoming, self.control["commands"])
+            if self.command_lock.still_valid(seq):
+                self.command_seq = seq
+                if race == self.race:
+                    self.commands, self.incoming = self.incoming, self.commands
+                    self.command_step = step
+                    self.have_commands = True
+        return self.commands if self.have_commands and self.lag <= MAX_LAG else None
+
+    @property
+    def lag(self):
+        # Steps between the newest published state and the one the commands were planned from
+        return self.step - self.command_step if self.have_commands else None
+
+    def restart(self):
+        # A new race: drop the commands for the old one
+        self.race += 1
+        self.have_commands = False
+        self.command_seq = None
+
+    def close(self):
+        self.header[STOP] = 1
+        self.process.join(timeout=2.0)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.control.close(unlink=True)
+        self.track_block.close(unlink=True)
@@ -0,0 +1,338 @@
+"""
+Rendering and simulation benchmarks.
+
+Runs fixed, seeded scenarios through the game's own simulation and rendering code on an
+offscreen software OpenGL context (Mesa llvmpipe through EGL, no GPU or window needed) and
+writes frame time distributions, simulation step times, GL call counts and peak memory
+to a JSON file. Results can be checked against a stored baseline:
+
+    python benchmark.py --out bench.json
+    python benchmark.py --baseline bench.json --out new.json
+
+Each scenario runs in a fresh process so its peak memory is its own.
+"""
+import os
+
+# Software rendering into an offscreen EGL surface; must be chosen before OpenGL is imported
+os.environ.setdefault("PYOPENGL_PLATFORM", "egl")
+os.environ.setdefault("EGL_PLATFORM", "surfaceless")
+os.environ.setdefault("LIBGL_ALWAYS_SOFTWARE", "1")
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import argparse
+import ctypes
+import json
+import math
+import platform
+import random
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import numpy as np
+
+import main as game
+from headless import BotDriver
+from profiler import PROFILER
+import terrain
+
+# Scenario name -> setup. Cars count the player; frames are rendered after the warmup frames.
+SCENARIOS = {
+    "flythrough": {"description": "empty track, camera flying along the centerline",
+                   "cars": 1, "trees": 0, "race": False},
+    "race": {"description": "full 8-car race driven by the bot",
+             "cars": 8, "trees": 200, "race": True},
+    "stress": {"description": "100-car race driven by the bot",
+               "cars": 100, "trees": 200, "race": True},
+    "field": {"description": "500-car race driven by the bot",
+              "cars": 500, "trees": 200, "race": True},
+    "forest": {"description": "camera flying along the centerline through 20000 trees",
+               "cars": 1, "trees": 20000, "race": False},
+}
+
+# Metrics compared against the baseline; for all of them lower is better
+COMPARED_METRICS = ["frame_ms.p50", "frame_ms.p99", "sim_step_ms.avg", "gl_calls_per_frame", "peak_rss_mb"]
+
+class OffscreenContext:
+    """An OpenGL context rendering into an EGL pbuffer, made current on creation."""
+    def __init__(self, width, height):
+        from OpenGL import EGL
+        self.egl = EGL
+        self.display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+        if not EGL.eglInitialize(self.display, None, None):
+            raise RuntimeError("could not initialize EGL")
+        attributes = (EGL.EGLint * 13)(EGL.EGL_SURFACE_TYPE, EGL.EGL_PBUFFER_BIT,
+                                       EGL.EGL_RED_SIZE, 8, EGL.EGL_GREEN_SIZE, 8, EGL.EGL_BLUE_SIZE, 8,
+                                       EGL.EGL_DEPTH_SIZE, 24,
+                                       EGL.EGL_RENDERABLE_TYPE, EGL.EGL_OPENGL_BIT, EGL.EGL_NONE)
+        config = EGL.EGLConfig()
+        num_configs = EGL.EGLint()
+        EGL.eglChooseConfig(self.display, attributes, ctypes.pointer(config), 1, ctypes.pointer(num_configs))
+        if num_configs.value == 0:
+            raise RuntimeError("no EGL config supports offscreen OpenGL rendering")
+        self.surface = EGL.eglCreatePbufferSurface(
+            self.display, config, (EGL.EGLint * 5)(EGL.EGL_WIDTH, width, EGL.EGL_HEIGHT, height, EGL.EGL_NONE))
+        EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+        self.context = EGL.eglCreateContext(self.display, config, EGL.EGL_NO_CONTEXT, None)
+        if not self.context:
+            raise RuntimeError("could not create an OpenGL context")
+        EGL.eglMakeCurrent(self.display, self.surface, self.surface, self.context)
+
+    def close(self):
+        EGL = self.egl
+        EGL.eglMakeCurrent(self.display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, EGL.EGL_NO_CONTEXT)
+        EGL.eglDestroyContext(self.display, self.context)
+        EGL.eglDestroySurface(self.display, self.surface)
+        EGL.eglTerminate(self.display)
+
+class GLCallCounter:
+    """
+    Counts calls to the gl* and glu* functions the game draws with, by swapping counting wrappers
+    into the namespace of every module that draws while active. The wrappers cost time, so frames
+    are not timed while counting.
+    """
+    modules = (game, terrain)  # Modules that import OpenGL functions and draw with them
+
+    def __init__(self):
+        self.counts = {}
+
+    def __enter__(self):
+        self.originals = [(module, name, value) for module in self.modules for name, value in vars(module).items()
+                          if name.startswith("gl") and callable(value)]
+        for module, name, function in self.originals:
+            setattr(module, name, self.wrap(name, function))
+        return self
+
+    def __exit__(self, *exc_info):
+        for module, name, function in self.originals:
+            setattr(module, name, function)
+        return False
+
+    def wrap(self, name, function):
+        counts = self.counts
+
+        def counted(*args, **kwargs):
+            counts[name] = counts.get(name, 0) + 1
+            return function(*args, **kwargs)
+        return counted
+
+def distribution(samples):
+    # Summary of a list of durations in seconds, in milliseconds
+    samples = np.asarray(samples) * 1000
+    if len(samples) == 0:
+        return {}
+    return {
+        "min": float(samples.min()),
+        "p50": float(np.percentile(samples, 50)),
+        "avg": float(samples.mean()),
+        "p95": float(np.percentile(samples, 95)),
+        "p99": float(np.percentile(samples, 99)),
+        "max": float(samples.max()),
+    }
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+class Scenario:
+    """The world of one scenario, built from its seed, and how it advances each frame."""
+    def __init__(self, name, seed):
+        setup = SCENARIOS[name]
+        rng = random.Random(seed)
+        num_ai = setup["cars"] - 1
+        colors = [game.PLAYER_COLOR] * num_ai
+        self.race = setup["race"]
+        self.game_state = game.GameState()
+        self.player = game.PlayerCar()
+        self.track = game.Track(num_trees=setup["trees"], rng=rng)
+        self.fleet = game.AIFleet(np.zeros((num_ai, 3)), colors, np.random.default_rng(seed))
+        game.place_on_grid(self.player, self.fleet, self.track)
+        self.driver = BotDriver()
+        self.distance = 0.0  # How far along the centerline the fly-through camera has come
+        self.sim_step_times = []
+        if self.race:
+            game.start_race(self.game_state)
+
+    def advance(self, frame_time):
+        """Advance the world by one rendered frame of frame_time seconds."""
+        if not self.race:
+            self.fly(frame_time)
+            return
+        for _ in range(round(frame_time / game.SIM_DT)):
+            controls = self.driver(self.game_state, self.player, self.track)
+            start = time.perf_counter()
+            with PROFILER.stage("simulation"):
+                game.update_simulation(self.game_state, self.player, controls, self.fleet, self.track, game.SIM_DT)
+            self.sim_step_times.append(time.perf_counter() - start)
+
+    def fly(self, frame_time, speed=30.0):
+        # Carry the player car along the centerline at a steady speed
+        self.player.save_previous_state()
+        self.fleet.save_previous_state()
+        track = self.track
+        self.distance = (self.distance + speed * frame_time) % track.length
+        idx = int(np.searchsorted(track.arc_length, self.distance, side="right")) - 1
+        point = track.point_array[idx] + track.tangents[idx] * (self.distance - track.arc_length[idx])
+        self.player.position[:] = point.tolist()
+        self.player.rotation = math.degrees(math.atan2(track.tangents[idx][0], track.tangents[idx][2]))
+
+def run_scenario(name, seed=0, frames=300, warmup=30, count_frames=5, width=1024, height=768):
+    """
+    Run one scenario offscreen and return its measurements. Frames are advanced by a fixed
+    1/60 s of game time however long they take, so every run renders the same frames.
+    """
+    context = OffscreenContext(width, height)
+    try:
+        game.load_fonts()
+        game.resize_viewport(width, height)
+        game.init_lighting()
+
+        setup_start = time.perf_counter()
+        scenario = Scenario(name, seed)
+        setup_time = time.perf_counter() - setup_start
+
+        frame_time = 1.0 / game.REFERENCE_FRAME_RATE
+        PROFILER.set_enabled(True)
+
+        def frame():
+            PROFILER.begin_frame()
+            scenario.advance(frame_time)
+            game.render_scene(scenario.game_state, scenario.player, scenario.fleet, scenario.track, 1.0)
+            with PROFILER.stage("finish"):
+                game.glFinish()  # Wait for the software rasterizer so the frame time includes it
+            PROFILER.end_frame()
+
+        # The first frames compile display lists and glyph atlases
+        for _ in range(warmup):
+            frame()
+        scenario.sim_step_times.clear()
+        PROFILER.clear(capacity=frames)
+
+        frame_times = []
+        for _ in range(frames):
+            start = time.perf_counter()
+            frame()
+            frame_times.append(time.perf_counter() - start)
+        stages = {stage: {"min": low * 1000, "avg": average * 1000, "p99": p99 * 1000}
+                  for stage, (low, average, p99) in PROFILER.stats().items()}
+        PROFILER.set_enabled(False)
+
+        with GLCallCounter() as counter:
+            for _ in range(count_frames):
+                frame()
+
+        return {
+            "description": SCENARIOS[name]["description"],
+            "frames": frames,
+            "setup_s": setup_time,
+            "frame_ms": distribution(frame_times),
+            "sim_step_ms": distribution(scenario.sim_step_times),
+            "stages_ms": stages,
+            "gl_calls_per_frame": sum(counter.counts.values()) / count_frames,
+            "gl_calls_by_function": {function: count / count_frames
+                                     for function, count in sorted(counter.counts.items(), key=lambda item: -item[1])},
+            "chunks_drawn": scenario.track.chunks_drawn,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+    finally:
+        context.close()
+
+def gl_info():
+    # Which OpenGL implementation the numbers come from
+    context = OffscreenContext(16, 16)
+    try:
+        return {"renderer": game.glGetString(game.GL_RENDERER).decode(),
+                "version": game.glGetString(game.GL_VERSION).decode()}
+    finally:
+        context.close()
+
+def run_isolated(function, *args, **kwargs):
+    # Run function in a fresh process, so GL state and peak memory don't carry over
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(function, *args, **kwargs).result()
+
+def run_benchmarks(names, seed=0, frames=300, warmup=30):
+    results = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "seed": seed,
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "gl": run_isolated(gl_info),
+        },
+        "scenarios": {},
+    }
+    for name in names:
+        print(f"running {name}...", file=sys.stderr)
+        results["scenarios"][name] = run_isolated(run_scenario, name, seed, frames, warmup)
+    return results
+
+def metric(scenario_results, path):
+    # Look up a dotted metric name like "frame_ms.p99"
+    value = scenario_results
+    for key in path.split("."):
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+def compare(results, baseline, tolerance=0.15):
+    """
+    Compare results against a baseline and return a list of (scenario, metric, old, new, change, regressed).
+    A metric regresses when it is more than tolerance (a fraction) above the baseline value.
+    """
+    rows = []
+    for name, scenario_results in results["scenarios"].items():
+        if name not in baseline.get("scenarios", {}):
+            continue
+        for path in COMPARED_METRICS:
+            old = metric(baseline["scenarios"][name], path)
+            new = metric(scenario_results, path)
+            if not old or new is None:
+                continue
+            change = new / old - 1
+            rows.append((name, path, old, new, change, change > tolerance))
+    return rows
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark rendering and simulation on offscreen software GL.")
+    parser.add_argument("scenarios", nargs="*", help=f"scenarios to run: {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--frames", type=int, default=300, help="timed frames per scenario")
+    parser.add_argument("--warmup", type=int, default=30, help="untimed frames before timing starts")
+    parser.add_argument("--out", default="benchmark_results.json", help="where to write the results")
+    parser.add_argument("--baseline", help="results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.15,
+                        help="allowed slowdown against the baseline, as a fraction")
+    args = parser.parse_args()
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario: {', '.join(unknown)}")
+
+    results = run_benchmarks(args.scenarios or list(SCENARIOS), args.seed, args.frames, args.warmup)
+    with open(args.out, "w") as results_file:
+        json.dump(results, results_file, indent=2)
+    print(f"wrote {args.out}", file=sys.stderr)
+
+    for name, scenario_results in results["scenarios"].items():
+        frame_ms = scenario_results["frame_ms"]
+        print(f"{name:<12} frame p50 {frame_ms['p50']:7.2f} ms  p99 {frame_ms['p99']:7.2f} ms  "
+              f"sim step {scenario_results['sim_step_ms'].get('avg', 0.0):6.3f} ms  "
+              f"gl calls {scenario_results['gl_calls_per_frame']:6.0f}  rss {scenario_results['peak_rss_mb']:6.0f} MB")
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        rows = compare(results, baseline, args.tolerance)
+        regressions = [row for row in rows if row[5]]
+        for name, path, old, new, change, regressed in rows:
+            flag = "REGRESSION" if regressed else ""
+            print(f"{name:<12} {path:<20} {old:10.3f} -> {new:10.3f} ({change:+7.1%}) {flag}")
+        if regressions:
+            print(f"{len(regressions)} metric(s) regressed by more than {args.tolerance:.0%}", file=sys.stderr)
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
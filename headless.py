@@ -0,0 +1,123 @@
+"""
+Headless race runner.
+
+Drives the race simulation from main.py (Track, PlayerCar and the AI fleet) without a
+window, GL context or audio, stepping it as fast as the CPU allows:
+
+    python headless.py --races 10 --seed 1 --laps 3
+    python headless.py --track tracks/example.track
+"""
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import numpy as np
+
+# Importing main brings in pygame, whose greeting would land in front of the JSON output
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+import trackfile
+from main import (AIFleet, Controls, GameState, PlayerCar, SIM_DT, Track, place_on_grid, start_race,
+                  update_simulation)
+
+class BotDriver:
+    """
+    Drives the player car: steers at a point a few segments ahead, shifts up whenever
+    the gear allows and lifts off for sharp corners.
+    """
+    def __init__(self, lookahead=3, corner_angle=45):
+        self.lookahead = lookahead
+        self.corner_angle = corner_angle
+    
+    def __call__(self, game_state, player, track):
+        idx = player.nearest_idx
+        if idx is None:
+            idx = track.get_nearest_point(player.position)[1]
+        target = track.points[(idx + self.lookahead) % len(track.points)]
+        
+        target_angle = math.degrees(math.atan2(target[0] - player.position[0], target[2] - player.position[2]))
+        angle_diff = (target_angle - player.rotation + 180) % 360 - 180
+        
+        # Release the shift key between shifts so every press registers
+        can_shift = player.gear < player.max_gear and (player.gear == 0 or player.speed >= player.gear * 0.1)
+        return Controls(
+            accelerate=abs(angle_diff) < self.corner_angle,
+            shift_up=can_shift and not player.shift_up_held,
+            steer_left=angle_diff > 2,
+            steer_right=angle_diff < -2,
+        )
+
+def car_name(index):
+    return "player" if index == 0 else f"ai{index}"
+
+def run_race(seed=None, total_laps=3, num_ai=7, driver=None, time_limit=600.0, ai_params=None, track_data=None):
+    """
+    Run one race to completion without a display and return its results as a dict.
+    The race ends when the player finishes or time_limit simulated seconds pass.
+    All randomness comes from generators seeded with seed, so a seeded race is reproducible.
+    ai_params overrides AIFleet tuning values by name, and track_data races on a loaded
+    track file instead of the oval.
+    """
+    rng = random.Random(seed)
+    driver = driver or BotDriver()
+    
+    game_state = GameState()
+    game_state.total_laps = total_laps
+    player = PlayerCar()
+    track = Track(num_trees=0, rng=rng, data=track_data)  # Scenery only matters when drawing
+    game_state.field_size = 1 + num_ai
+    fleet = AIFleet(np.zeros((num_ai, 3)), [(1.0, 1.0, 1.0)] * num_ai, np.random.default_rng(seed), ai_params)
+    place_on_grid(player, fleet, track)
+    start_race(game_state)
+    
+    finish_times = {}
+    steps = 0
+    while not game_state.game_over and game_state.race_clock < time_limit:
+        update_simulation(game_state, player, driver(game_state, player, track), fleet, track, SIM_DT)
+        steps += 1
+        
+        for i in np.flatnonzero(fleet.laps >= total_laps):
+            finish_times.setdefault(car_name(i + 1), game_state.race_clock)
+    if game_state.game_over:
+        finish_times["player"] = game_state.total_time
+    
+    # Finished cars in finishing order, then the rest as they stand on the road
+    finished = sorted(finish_times, key=finish_times.get)
+    standings = game_state.standings
+    running = [car_name(i) for i in standings.order.tolist() if car_name(i) not in finish_times]
+    
+    return {
+        "seed": seed,
+        "ai_params": ai_params or {},
+        "finished": game_state.game_over,
+        "race_time": game_state.race_clock,
+        "steps": steps,
+        "lap_times": game_state.lap_times,
+        "best_lap": game_state.best_lap if game_state.lap_times else None,
+        "finishing_order": finished + running,
+        "finish_times": finish_times,
+        "gaps_to_leader": {car_name(i): standings.gap_to_leader(i) for i in standings.order.tolist()},
+        "player_position": (finished + running).index("player") + 1,
+        "collisions": game_state.collisions,
+        "car_contacts": game_state.car_contacts,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Run races without a display.")
+    parser.add_argument("--races", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0, help="seed of the first race, later races count up")
+    parser.add_argument("--laps", type=int, default=3)
+    parser.add_argument("--ai", type=int, default=7, help="number of AI cars")
+    parser.add_argument("--time-limit", type=float, default=600.0, help="simulated seconds before a race is stopped")
+    parser.add_argument("--track", help="race on a track file instead of the oval")
+    args = parser.parse_args()
+    track_data = trackfile.load_track(args.track) if args.track else None
+    
+    for i in range(args.races):
+        result = run_race(args.seed + i, args.laps, args.ai, time_limit=args.time_limit, track_data=track_data)
+        json.dump(result, sys.stdout)
+        sys.stdout.write("\n")
+
+if __name__ == "__main__":
+    main()
@@ -3,42 +3,31 @@ from pygame.locals import *
 from OpenGL.GL import *
 from OpenGL.GLU import *
 import math
+import colorsys
 import random
 import sys
 import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from ai_planner import AIPlanner
+from profiler import PROFILER
+from racing_line import load_racing_line
+from replay import ReplayReader, ReplayWriter
+from standings import Standings
+from terrain import NoiseHeightmap, Terrain
+import trackfile
 
-# Initialize Pygame and OpenGL
-pygame.init()
 WIDTH, HEIGHT = 1024, 768
-pygame.display.set_mode((WIDTH, HEIGHT), DOUBLEBUF | OPENGL)
-glClearColor(0.0, 0.0, 0.0, 1.0) 
-original_flags = DOUBLEBUF | OPENGL
-screen = pygame.display.set_mode((WIDTH, HEIGHT), original_flags)
-pygame.display.set_caption("Python Racing USA")
-
-# Initialize mixer and start background music  <-- ADDED THIS BLOCK
-pygame.mixer.init()
-try:
-    pygame.mixer.music.load('bgmusic.mp3')  # Make sure 'bgmusic.mp3' is in the correct directory!
-    pygame.mixer.music.play(-1) # Loop indefinitely
-except pygame.error as e:
-    print(f"Could not load or play music: {e}")  #Error handling
-
-# Global font objects (initialized once)
-hud_font = pygame.font.SysFont("Arial", 24)
-countdown_font = pygame.font.SysFont("Arial", 100)
-game_over_font = pygame.font.SysFont("Arial", 60)
-
-# Setup OpenGL perspective
-glEnable(GL_DEPTH_TEST)
-glEnable(GL_LIGHTING)
-glEnable(GL_LIGHT0)
-glEnable(GL_COLOR_MATERIAL)
-glColorMaterial(GL_FRONT_AND_BACK, GL_AMBIENT_AND_DIFFUSE)
-
-glMatrixMode(GL_PROJECTION)
-glLoadIdentity()
-gluPerspective(60, (WIDTH / HEIGHT), 0.1, 500.0)
+screen = None
+
+# Global font objects, created by init_display
+hud_font = None
+countdown_font = None
+game_over_font = None
+profiler_font = None
 
 # --- OpenGL Setup ---
 def resize_viewport(width, height):
@@ -58,17 +47,189 @@ def resize_viewport(width, height):
     glMatrixMode(GL_MODELVIEW)  # Switch back to modelview matrix
     glLoadIdentity()
 
+WINDOW_FLAGS = DOUBLEBUF | OPENGL | RESIZABLE
+
+def init_display():
+    """
+    Open the window and its GL context, once, with pygame's built-in font standing in until
+    the system fonts have loaded. Music and system fonts are left to a Loader.
+    Nothing here runs at import, so the simulation can be used without a display.
+    """
+    global screen
+    
+    # Only the parts of pygame the first frame needs
+    pygame.display.init()
+    pygame.font.init()
+    pygame.display.set_caption("Python Racing USA")
+    screen = pygame.display.set_mode((WIDTH, HEIGHT), WINDOW_FLAGS)
+    
+    load_fonts(system_fonts=False)
+    
+    # Initial resize call to set up the viewport and perspective
+    resize_viewport(WIDTH, HEIGHT)
+
+# Global font name -> (system font, size)
+FONTS = {
+    "hud_font": ("Arial", 24),
+    "countdown_font": ("Arial", 100),
+    "game_over_font": ("Arial", 60),
+    "profiler_font": ("Courier New", 16),
+}
+
+def find_font_files():
+    """
+    Look up the file of each system font, as {global name: path or None}. Scanning the system
+    fonts can take seconds on some systems, so this is what runs in the background.
+    """
+    return {name: pygame.font.match_font(family) for name, (family, size) in FONTS.items()}
+
+def load_fonts(system_fonts=True, font_files=None):
+    """
+    Set the global font objects, from the given font files, the system fonts or, without
+    system fonts, pygame's built-in font, which loads instantly.
+    """
+    pygame.font.init()
+    if font_files is None:
+        font_files = find_font_files() if system_fonts else {}
+    for name, (family, size) in FONTS.items():
+        globals()[name] = pygame.font.Font(font_files.get(name), size)
 
-glEnable(GL_DEPTH_TEST)
-glEnable(GL_LIGHTING)
-glEnable(GL_LIGHT0)
-glEnable(GL_COLOR_MATERIAL)
-glColorMaterial(GL_FRONT_AND_BACK, GL_AMBIENT_AND_DIFFUSE)
+def start_music():
+    # Initialize mixer and start background music
+    pygame.mixer.init()
+    try:
+        pygame.mixer.music.load('bgmusic.mp3')  # Make sure 'bgmusic.mp3' is in the correct directory!
+        pygame.mixer.music.play(-1) # Loop indefinitely
+    except pygame.error as e:
+        print(f"Could not load or play music: {e}")  #Error handling
 
-# Initial resize call to set up the viewport
-resize_viewport(WIDTH, HEIGHT)
+class Loader:
+    """
+    Slow startup work run on worker threads while the first frames are already drawing:
+    the music, the system fonts and the forest of a track. poll() is called every frame and
+    applies finished work on the main thread, which owns the GL context.
+    """
+    def __init__(self, track=None, music=True):
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="loader")
+        self.tasks = [(self.executor.submit(find_font_files), self.apply_fonts)]
+        if music:
+            self.tasks.append((self.executor.submit(start_music), None))
+        if track is not None:
+            track.scenery_loading = True
+            self.tasks.append((self.executor.submit(track.plan_forest), track.build_forest))
+        self.executor.shutdown(wait=False)  # Lets the threads exit once the work is done
+    
+    @staticmethod
+    def apply_fonts(font_files):
+        # Fonts are created here rather than on the worker, to keep pygame.font on one thread
+        if font_files:
+            load_fonts(font_files=font_files)
+    
+    def poll(self):
+        """Apply whatever finished since the last call. Returns True once everything has."""
+        for task in [task for task in self.tasks if task[0].done()]:
+            self.tasks.remove(task)
+            future, apply = task
+            try:
+                result = future.result()
+            except Exception as error:
+                # Carry on with what is already there; apply(None) falls back where needed
+                print(f"Background loading failed: {error!r}")
+                result = None
+            if apply is not None:
+                apply(result)
+        return not self.tasks
+
+def init_lighting():
+    # Set up proper lighting
+    glEnable(GL_DEPTH_TEST)
+    glEnable(GL_LIGHTING)
+    glEnable(GL_LIGHT0)
+    
+    # Set light properties for better outdoor lighting
+    ambient_light = [0.4, 0.4, 0.4, 1.0]  # Brighter ambient light
+    diffuse_light = [0.8, 0.8, 0.8, 1.0]  # Strong diffuse light
+    
+    glLightfv(GL_LIGHT0, GL_AMBIENT, ambient_light)
+    glLightfv(GL_LIGHT0, GL_DIFFUSE, diffuse_light)
+    
+    # Material settings
+    glEnable(GL_COLOR_MATERIAL)
+    glColorMaterial(GL_FRONT_AND_BACK, GL_AMBIENT_AND_DIFFUSE)
+    
+    # Set clear color to match sky color
+    glClearColor(0.5, 0.7, 1.0, 1.0)
+
+# Simulation timing: the world advances in fixed steps, independent of the render frame rate
+SIM_RATE = 120  # Simulation steps per second
+SIM_DT = 1.0 / SIM_RATE
+MAX_SIM_STEPS_PER_FRAME = 8  # Beyond this the simulation falls behind instead of spiraling
+REFERENCE_FRAME_RATE = 60  # Speeds, accelerations and turn rates are tuned per 1/60 s
+MAX_RENDER_FPS = 60
 
 # Game state variables
+class GhostLap:
+    """
+    The player's path through the current lap and through the best lap so far, sampled every
+    simulation step into preallocated arrays. When a lap beats the best one the two buffers
+    swap, so recording and playback never allocate.
+    """
+    def __init__(self, capacity=SIM_RATE * 300):
+        self.capacity = capacity  # Samples per lap; a lap running longer stops recording
+        self.times = np.zeros(capacity)
+        self.positions = np.zeros((capacity, 3))
+        self.rotations = np.zeros(capacity)
+        self.count = 0
+        self.best_times = np.zeros(capacity)
+        self.best_positions = np.zeros((capacity, 3))
+        self.best_rotations = np.zeros(capacity)
+        self.best_count = 0  # Samples in the best lap, 0 until a lap has been completed
+        self.position = np.zeros(3)  # Ghost car state filled in by sample()
+        self.rotation = 0.0
+    
+    def start_lap(self):
+        self.count = 0
+    
+    def record(self, lap_time, position, rotation):
+        if self.count < self.capacity:
+            self.times[self.count] = lap_time
+            self.positions[self.count] = position
+            self.rotations[self.count] = rotation
+            self.count += 1
+    
+    def discard(self):
+        # Forget the best lap and skip the rest of the current one, for a race put back to an
+        # earlier state; the next whole lap becomes the ghost
+        self.best_count = 0
+        self.count = self.capacity
+    
+    def finish_lap(self, is_best):
+        # Keep the lap just driven if it is the new best or there is none, unless it didn't fit
+        if (is_best or not self.best_count) and self.count < self.capacity:
+            self.times, self.best_times = self.best_times, self.times
+            self.positions, self.best_positions = self.best_positions, self.positions
+            self.rotations, self.best_rotations = self.best_rotations, self.rotations
+            self.best_count = self.count
+        self.start_lap()
+    
+    def sample(self, lap_time):
+        """
+        Move the ghost to where the best lap was at lap_time, blending the samples around it.
+        Returns False when there is no best lap or it was already over by then.
+        """
+        count = self.best_count
+        if count < 2 or not self.best_times[0] <= lap_time <= self.best_times[count - 1]:
+            return False
+        after = min(int(np.searchsorted(self.best_times[:count], lap_time)), count - 1)
+        before = max(after - 1, 0)
+        span = self.best_times[after] - self.best_times[before]
+        alpha = (lap_time - self.best_times[before]) / span if span > 0 else 1.0
+        np.subtract(self.best_positions[after], self.best_positions[before], out=self.position)
+        self.position *= alpha
+        self.position += self.best_positions[before]
+        self.rotation = self.best_rotations[before] + (self.best_rotations[after] - self.best_rotations[before]) * alpha
+        return True
+
 class GameState:
     def __init__(self):
         self.game_started = False
@@ -78,10 +239,16 @@ class GameState:
         self.laps = 0
         self.total_laps = 3
         self.race_position = 1
-        self.start_time = 0
+        self.field_size = 8  # Cars in the race, the player included
+        self.race_clock = 0  # Simulated seconds since the start, advanced by each step
+        self.lap_start_time = 0
         self.total_time = 0
         self.lap_times = []
         self.best_lap = float('inf')
+        self.collisions = 0  # Player contacts with AI cars this race
+        self.car_contacts = 0  # Contacts between any two cars this race
+        self.ghost = GhostLap()  # Best lap so far, raced against as a ghost car
+        self.standings = Standings()  # Running order of the player (car 0) and the AI cars
 
 # Player car variables
 class PlayerCar:
@@ -96,83 +263,258 @@ class PlayerCar:
         self.max_gear = 5
         self.collision_radius = 1.0
         self.laps = 0
+        self.last_checkpoint = 0  # Furthest track point reached on the current lap
+        self.progress = 0.0  # Distance along the track since the start, counting whole laps
+        self.nearest_idx = None  # Last known track segment, None after a reset
+        self.shift_up_held = False  # Gear shifts trigger on press, not while held
+        self.shift_down_held = False
+        self.previous_position = list(self.position)  # State before the last step, for interpolation
+        self.previous_rotation = self.rotation
+    
+    def save_previous_state(self):
+        self.previous_position[:] = self.position
+        self.previous_rotation = self.rotation
+
+def fleet_field(name):
+    # Property reading and writing one car's entry in an AIFleet array
+    def get(car):
+        return getattr(car.fleet, name)[car.index]
+    def set(car, value):
+        getattr(car.fleet, name)[car.index] = value
+    return property(get, set)
 
 # AI Car class
 class AICar:
-    def __init__(self, start_position, color):
-        self.position = list(start_position)
-        self.rotation = 0
-        self.speed = random.uniform(0.2, 0.6)
-        self.target_speed = random.uniform(0.3, 0.7)
-        self.color = color
-        self.track_position = 0
-        self.laps = 0
-        self.collision_radius = 1.0
+    """
+    One car of an AIFleet. The state lives in the fleet's arrays; this is a thin view
+    used for rendering, collisions and standings. position is a writable numpy row.
+    """
+    position = fleet_field("position")
+    rotation = fleet_field("rotation")
+    speed = fleet_field("speed")
+    target_speed = fleet_field("target_speed")
+    laps = fleet_field("laps")
+    last_checkpoint = fleet_field("checkpoint")
+    progress = fleet_field("progress")
+    collision_radius = fleet_field("collision_radius")
+    
+    def __init__(self, fleet, index):
+        self.fleet = fleet
+        self.index = index
+        self.color = fleet.colors[index]
+    
+    @property
+    def nearest_idx(self):
+        idx = self.fleet.nearest_idx[self.index]
+        return None if idx < 0 else int(idx)
+    
+    @nearest_idx.setter
+    def nearest_idx(self, value):
+        self.fleet.nearest_idx[self.index] = -1 if value is None else value
+
+# AI fleet
+class AIFleet:
+    """
+    All AI cars held as numpy arrays and advanced together in one batched step.
+    """
+    steering_gain = 2.0  # Fraction of the heading error corrected per second
+    skill_range = (0.85, 1.0)  # Fraction of the racing line's speed each driver manages
+    line_wander = 10.0  # A driver strays up to this times (1 - skill) world units off the racing line
+    wander_length = 60.0  # Distance along the track over which the straying comes back around
+    corner_slowdown = 0.001  # Planned driving: target speed lost per degree of heading error in corners
+    min_corner_speed = 0.2
+    cruise_speed_range = (0.3, 0.7)  # Planned driving: target speeds picked on straights
+    start_speed_range = (0.2, 0.6)
+    acceleration = 0.01
+    braking = 0.02
+    
+    def __init__(self, start_positions, colors, rng=None, params=None, start_rotations=0.0):
+        self.rng = rng if rng is not None else np.random.default_rng()
         
-    def update(self, track, dt):
-        # Move forward based on speed
-        self.position[0] += math.sin(math.radians(self.rotation)) * self.speed
-        self.position[2] += math.cos(math.radians(self.rotation)) * self.speed
+        # Per-fleet overrides of the tuning values above
+        for name, value in (params or {}).items():
+            if not hasattr(AIFleet, name) or callable(getattr(AIFleet, name)):
+                raise ValueError(f"Unknown AI parameter: {name}")
+            setattr(self, name, value)
+
+        self.colors = list(colors)
+        self.color_array = np.array(self.colors, dtype=np.float32).reshape(len(self.colors), 3)
+        count = len(start_positions)
+        self.position = np.zeros((count, 3))
+        self.rotation = np.zeros(count)
+        self.speed = np.zeros(count)
+        self.target_speed = self.rng.uniform(*self.cruise_speed_range, count)
+        self.cruise_speed = self.rng.uniform(*self.cruise_speed_range, count)  # Target speed cap on straights
+        # How closely each driver keeps to the racing line, fixed for the whole session
+        self.skill = self.rng.uniform(*self.skill_range, count)
+        self.wander_amplitude = (1 - self.skill) * self.line_wander
+        self.wander_phase = self.rng.uniform(0, 2 * math.pi, count)
+        self.laps = np.zeros(count, dtype=np.int64)
+        self.checkpoint = np.zeros(count, dtype=np.int64)  # Furthest track point reached on the current lap
+        self.progress = np.zeros(count)  # Distance along the track since the start, counting whole laps
+        self.collision_radius = np.ones(count)
+        self.nearest_idx = np.full(count, -1, dtype=np.int64)  # Last known track segment, -1 after a reset
+        self.previous_position = np.zeros((count, 3))  # State before the last step, for interpolation
+        self.previous_rotation = np.zeros(count)
+        self.planner = None  # An ai_planner.AIPlanner steering the fleet from another process, if any
+        self.reset(start_positions, start_rotations)
+        self.cars = [AICar(self, i) for i in range(count)]
+    
+    def __len__(self):
+        return len(self.position)
+    
+    def reset(self, start_positions, start_rotations=0.0, start_checkpoints=None):
+        """
+        Put the cars back at the start. Cars given the track points of their grid slots as
+        start_checkpoints stand short of the start/finish line, a lap down until they cross it.
+        """
+        self.position[:] = np.reshape(start_positions, (-1, 3))
+        self.rotation[:] = start_rotations
+        self.speed[:] = self.rng.uniform(*self.start_speed_range, len(self))
+        self.laps[:] = 0 if start_checkpoints is None else -1
+        self.checkpoint[:] = 0 if start_checkpoints is None else start_checkpoints
+        self.progress[:] = 0
+        self.nearest_idx[:] = -1
+        self.save_previous_state()
+        if self.planner is not None:
+            self.planner.restart()
+    
+    def save_previous_state(self):
+        np.copyto(self.previous_position, self.position)
+        np.copyto(self.previous_rotation, self.rotation)
+    
+    def find_nearest(self, track, window=4):
+        """
+        Nearest track point for every car, searching a window around each car's last segment.
+        Cars without a hint, or whose best point is on the window edge or far away, use the track grid.
+        """
+        num_points = len(track.points)
+        offsets = np.arange(-window, window + 1)
+        candidates = (self.nearest_idx[:, np.newaxis] + offsets) % num_points
+        candidate_points = track.point_array[candidates]
+        dist_sq = ((candidate_points[:, :, 0] - self.position[:, 0:1]) ** 2 +
+                   (candidate_points[:, :, 2] - self.position[:, 2:3]) ** 2)
+        best = np.argmin(dist_sq, axis=1)
+        nearest = candidates[np.arange(len(self)), best]
         
-        # Get nearest track segment to follow
-        nearest_point, nearest_idx = track.get_nearest_point(self.position)
-        next_idx = (nearest_idx + 1) % len(track.points)
-        next_point = track.points[next_idx]
+        lost = ((self.nearest_idx < 0) | (np.abs(offsets[best]) == window) |
+                (dist_sq[np.arange(len(self)), best] > track.coherent_max_dist_sq))
+        for i in np.flatnonzero(lost):
+            nearest[i] = track.get_nearest_point(self.position[i])[1]
         
-        # Calculate direction to next point
-        direction = [next_point[0] - self.position[0], next_point[2] - self.position[2]]
-        target_angle = math.degrees(math.atan2(direction[0], direction[1])) % 360
+        self.nearest_idx[:] = nearest
+        return nearest
+    
+    def update(self, track, dt):
+        num_points = len(track.points)
+        frames = dt * REFERENCE_FRAME_RATE
+        
+        # Move forward based on speed
+        angles = np.radians(self.rotation)
+        self.position[:, 0] += np.sin(angles) * self.speed * frames
+        self.position[:, 2] += np.cos(angles) * self.speed * frames
         
-        # Steering
+        # Steer toward the planner's aim points if it has any yet, otherwise toward the racing line
+        # ahead, strayed from by each driver's skill, riding on the road surface
+        nearest_idx = self.find_nearest(track)
+        self.position[:, 1] = track.road_height(self.position[:, 0], self.position[:, 2], nearest_idx) + CAR_RIDE_HEIGHT
+        commands = self.planner.poll() if self.planner is not None else None
+        if commands is not None:
+            aim_x, aim_z = commands[:, 0], commands[:, 1]
+        else:
+            line = track.get_racing_line()
+            aim_idx = line.aim_index[nearest_idx]
+            wander = self.wander_amplitude * np.sin(self.progress * (2 * math.pi / self.wander_length) + self.wander_phase)
+            limit = np.maximum(track.half_widths[aim_idx] - 2 * self.collision_radius, 0.0)
+            offsets = np.clip(line.offsets[aim_idx] + wander, -limit, limit)
+            aim_x = track.point_array[aim_idx, 0] + track.normals[aim_idx, 0] * offsets
+            aim_z = track.point_array[aim_idx, 2] + track.normals[aim_idx, 2] * offsets
+        target_angle = np.degrees(np.arctan2(aim_x - self.position[:, 0], aim_z - self.position[:, 2])) % 360
         angle_diff = (target_angle - self.rotation) % 360
-        if angle_diff > 180:
-            angle_diff -= 360
-        self.rotation += angle_diff * dt * 2
-        
-        # Adjust speed based on curve sharpness
-        curve = abs(angle_diff)
-        if curve > 30:
-            self.target_speed = max(0.2, self.target_speed - 0.001 * curve)
+        angle_diff[angle_diff > 180] -= 360
+        self.rotation += angle_diff * dt * self.steering_gain
+        
+        # Take the planner's target speeds, or the racing line's speed just ahead scaled by skill
+        if commands is not None:
+            self.target_speed = commands[:, 2].copy()
         else:
-            self.target_speed = min(random.uniform(0.3, 0.7), self.target_speed + 0.01)
+            self.target_speed = line.speeds[(nearest_idx + 1) % num_points] * self.skill
+        
+        # The planner caps speeds on straights by cruise speeds, new ones about once per reference frame
+        if self.planner is not None:
+            redraw = self.rng.random(len(self)) < frames
+            self.cruise_speed[redraw] = self.rng.uniform(*self.cruise_speed_range, np.count_nonzero(redraw))
         
         # Adjust actual speed toward target speed
-        if self.speed < self.target_speed:
-            self.speed += 0.01
-        elif self.speed > self.target_speed:
-            self.speed -= 0.02
-            
-        # Update track position for race standings
-        self.track_position = nearest_idx + self.laps * len(track.points)
+        self.speed += np.where(self.speed < self.target_speed, self.acceleration,
+                               np.where(self.speed > self.target_speed, -self.braking, 0.0)) * frames
+        
+        # Check for lap completion at the start/finish line
+        finished_lap = (track.past_start_line(self.position[:, 0], self.position[:, 2], nearest_idx) &
+                        (self.checkpoint > num_points / 2))
+        self.laps[finished_lap] += 1
+        self.checkpoint[finished_lap] = 0
         
-        # Check for lap completion
-        if nearest_idx < 5 and self.position[2] > 0 and abs(self.position[0]) < 5:
-            if track.last_checkpoint[self] < len(track.points) - 10:
-                self.laps += 1
-                track.last_checkpoint[self] = 0
-                
         # Update checkpoint tracking
-        if nearest_idx > track.last_checkpoint.get(self, 0):
-            track.last_checkpoint[self] = nearest_idx
+        np.maximum(self.checkpoint, nearest_idx, out=self.checkpoint)
+        
+        # Update track position for race standings
+        self.progress[:] = self.laps * track.length + track.lap_progress(self.position[:, 0], self.position[:, 2],
+                                                                       nearest_idx)
+
+# Laps count when a car crosses the start/finish line within this distance of it
+START_ZONE_LENGTH = 40.0
+CAR_RIDE_HEIGHT = 0.5  # Car positions sit this far above the road surface
+TREE_BATCH = 64  # Trees stood on the terrain together, from one stretch of road
 
 # Track class
 class Track:
-    def __init__(self):
+    def __init__(self, num_trees=200, rng=None, data=None):
+        """
+        The built-in oval, or a compiled track from a TrackData (see trackfile.py) when data is given.
+        A track file's own tree count replaces num_trees, unless num_trees is 0.
+        """
+        self.rng = rng if rng is not None else random.Random()  # Source of all scenery randomness
         self.points = []
-        self.width = 10.0
-        self.generate_track()
-        self.last_checkpoint = {}  # Keeps track of the last checkpoint for each car
-        self.tree_positions = [] # List to store tree positions
-        self.generate_trees()   # Call generate_trees() to initialize the trees
-        
-    # Precompute mountain positions and heights
-    mountain_data = [
-        (-100, 0, -150, random.uniform(20, 40)),
-        (150, 0, -200, random.uniform(20, 40)),
-        (0, 0, -250, random.uniform(20, 40)),
-        (-200, 0, -180, random.uniform(20, 40)),
-        (80, 0, -220, random.uniform(20, 40))
-    ]
+        self.width = 10.0  # Road width wherever the track doesn't give its own
+        self.name = "Oval"
+        self.road_chunks = None  # Road display lists by scenery chunk, built lazily once a GL context exists
+        self.forest_chunks = None  # Tree display lists by scenery chunk, built lazily like the road
+        self.backdrop_list = None  # Display list for the mountains, built lazily like the road
+        self.chunks_drawn = 0  # Scenery chunks that passed culling in the last render
+        self.scenery_loading = False  # Set while a Loader prepares the forest on a worker thread
+        self.num_trees = num_trees
+        self.fixed_trees = []  # Trees placed by the track file, kept when the random ones are regenerated
+        if data is None:
+            self.generate_track()
+            self.build_geometry()
+        else:
+            self.load_data(data)
+        self.build_spatial_index()
+        
+        # Precompute mountain positions and heights
+        if data is not None and len(data.mountains):
+            self.mountain_data = [tuple(mountain) for mountain in data.mountains.tolist()]
+        else:
+            self.mountain_data = [
+                (-100, 0, -150, self.rng.uniform(20, 40)),
+                (150, 0, -200, self.rng.uniform(20, 40)),
+                (0, 0, -250, self.rng.uniform(20, 40)),
+                (-200, 0, -180, self.rng.uniform(20, 40)),
+                (80, 0, -220, self.rng.uniform(20, 40))
+            ]
+        
+        # The trees take the scenery randomness from here on, so any set of them can be drawn again
+        self.first_trees_rng_state = self.rng.getstate()
+        self.tree_generation = -1  # How many times the trees were regenerated since the first set
+        self.build_terrain()
+        self.generate_trees()
+    
+    def build_terrain(self):
+        # The ground: hills streamed in tiles around the camera, flattened under the road.
+        # They belong to the track rather than the race, so they are seeded by its shape.
+        seed = zlib.crc32(np.ascontiguousarray(self.point_array).tobytes())
+        self.terrain = Terrain(self.point_array, self.half_widths, NoiseHeightmap(seed))
 
     def generate_track(self):
         # Generate an oval track
@@ -190,413 +532,820 @@ class Track:
             
             self.points.append((x, y, z))
     
+    def build_spatial_index(self):
+        # Bucket the track points into a uniform grid for nearest-point queries
+        segment_length = self.length / len(self.points)
+        self.grid_cell_size = max(2 * segment_length, 1.0)
+        self.max_grid_rings = 4  # Queries further out than this use a full scan instead
+        self.grid = {}
+        for i, point in enumerate(self.points):
+            self.grid.setdefault(self.grid_cell(point), []).append(i)
+        
+        cells = list(self.grid)
+        self.grid_bounds = (min(c[0] for c in cells), max(c[0] for c in cells),
+                            min(c[1] for c in cells), max(c[1] for c in cells))
+        
+        # A coherent search further than this from its best point falls back to the grid
+        self.coherent_max_dist_sq = (2 * float(np.max(self.half_widths)) + segment_length) ** 2
+    
+    def grid_cell(self, position):
+        return (math.floor(position[0] / self.grid_cell_size), math.floor(position[2] / self.grid_cell_size))
+    
     def get_nearest_point(self, position):
-        min_dist = float('inf')
+        cx, cz = self.grid_cell(position)
+        min_ix, max_ix, min_iz, max_iz = self.grid_bounds
+        max_ring = max(abs(cx - min_ix), abs(cx - max_ix), abs(cz - min_iz), abs(cz - max_iz))
+        
+        min_dist_sq = float('inf')
         nearest_idx = 0
-        nearest_point = self.points[0]
         
-        for i, point in enumerate(self.points):
-            dist = math.sqrt((position[0] - point[0])**2 + (position[2] - point[2])**2)
-            if dist < min_dist:
-                min_dist = dist
-                nearest_idx = i
-                nearest_point = point
-                
-        return nearest_point, nearest_idx
+        # Search rings of cells around the position, stopping once no closer point can exist
+        for ring in range(min(max_ring, self.max_grid_rings) + 1):
+            for ix in range(cx - ring, cx + ring + 1):
+                step = 1 if abs(ix - cx) == ring else 2 * ring
+                for iz in range(cz - ring, cz + ring + 1, step):
+                    for i in self.grid.get((ix, iz), ()):
+                        point = self.points[i]
+                        dist_sq = (position[0] - point[0])**2 + (position[2] - point[2])**2
+                        if dist_sq < min_dist_sq:
+                            min_dist_sq = dist_sq
+                            nearest_idx = i
+            
+            # Points in the next ring are at least this far away
+            if min_dist_sq <= (ring * self.grid_cell_size) ** 2 or ring == max_ring:
+                return self.points[nearest_idx], nearest_idx
+        
+        # Far from the track, scanning every point at once beats walking empty cells
+        dist_sq = (self.point_array[:, 0] - position[0])**2 + (self.point_array[:, 2] - position[2])**2
+        nearest_idx = int(np.argmin(dist_sq))
+        return self.points[nearest_idx], nearest_idx
+    
+    def get_nearest_point_near(self, position, hint_idx, window=4):
+        """
+        Find the nearest track point by searching only around hint_idx, the car's last known segment.
+        Falls back to the full grid search when there is no hint or the car has moved too far.
+        """
+        if hint_idx is None:
+            return self.get_nearest_point(position)
+        
+        num_points = len(self.points)
+        min_dist_sq = float('inf')
+        nearest_offset = 0
+        for offset in range(-window, window + 1):
+            point = self.points[(hint_idx + offset) % num_points]
+            dist_sq = (position[0] - point[0])**2 + (position[2] - point[2])**2
+            if dist_sq < min_dist_sq:
+                min_dist_sq = dist_sq
+                nearest_offset = offset
+        
+        # A best point at the edge of the window may not be the true nearest one
+        if abs(nearest_offset) == window or min_dist_sq > self.coherent_max_dist_sq:
+            return self.get_nearest_point(position)
+        
+        nearest_idx = (hint_idx + nearest_offset) % num_points
+        return self.points[nearest_idx], nearest_idx
+    
+    def build_geometry(self, half_widths=None):
+        """
+        Precompute the per-point geometry table from self.points (see trackfile.segment_geometry),
+        with the road half as wide as self.width everywhere unless half_widths gives one per point.
+        """
+        if half_widths is None:
+            half_widths = np.full(len(self.points), self.width / 2, dtype=np.float32)
+        self.set_geometry(trackfile.segment_geometry(self.points, half_widths))
+    
+    def set_geometry(self, geometry):
+        # Adopt a precomputed geometry table, either freshly built or mapped from a track file
+        self.point_array = geometry["points"]
+        self.half_widths = geometry["half_widths"]
+        self.segment_lengths = geometry["segment_lengths"]
+        self.tangents = geometry["tangents"]
+        self.normals = geometry["normals"]
+        self.left_edges = geometry["left_edges"]
+        self.right_edges = geometry["right_edges"]
+        self.arc_length = geometry["arc_length"]
+        self.length = float(self.arc_length[-1])
+        self.curvature = geometry["curvature"]
+        self.racing_line = None  # Built or loaded the first time get_racing_line is called
+        
+        # The start/finish line runs across the road at the first point
+        self.start_point = self.point_array[0].tolist()
+        self.start_tangent = self.tangents[0].tolist()
+    
+    def get_racing_line(self):
+        # The AI's racing line for the current geometry, from the on-disk cache after the first time
+        if self.racing_line is None:
+            self.racing_line = load_racing_line(self)
+        return self.racing_line
+    
+    def load_data(self, data):
+        # Take the centerline, its tables and the scenery from a compiled track
+        self.name = data.name
+        self.points = data.points.tolist()
+        self.set_geometry({name: getattr(data, name) for name in trackfile.TrackData.ARRAYS})
+        self.fixed_trees = [tuple(tree) for tree in data.trees.tolist()]
+        if data.random_trees is not None and self.num_trees:
+            self.num_trees = data.random_trees
+    
+    def set_points(self, points, half_widths=None):
+        """Replace the centerline with new points and rebuild everything derived from it."""
+        self.points = [tuple(point) for point in np.asarray(points, dtype=np.float64).tolist()]
+        self.build_geometry(half_widths)
+        self.build_spatial_index()
+        self.release_mesh()
+        self.release_backdrop()
+        self.terrain.release()
+        self.build_terrain()
+        self.generate_trees()
+    
+    def lap_progress(self, x, z, nearest_idx):
+        """
+        Distance along the centerline from the start/finish line to cars at (x, z), whose nearest
+        track points are nearest_idx: the arc length to that point plus how far the car is past it.
+        Cars still short of the line count as nearly a full lap in. Works on arrays.
+        """
+        point = self.point_array[nearest_idx]
+        tangent = self.tangents[nearest_idx]
+        along = (x - point[..., 0]) * tangent[..., 0] + (z - point[..., 2]) * tangent[..., 2]
+        along = np.clip(along, -self.segment_lengths[nearest_idx - 1], self.segment_lengths[nearest_idx])
+        distance = self.arc_length[nearest_idx] + along
+        return np.where(distance < 0, distance + self.length, distance)
+    
+    def road_height(self, x, z, nearest_idx):
+        # Height of the road surface under cars at (x, z), along the segment from their nearest points
+        point = self.point_array[nearest_idx]
+        next_point = self.point_array[(nearest_idx + 1) % len(self.point_array)]
+        tangent = self.tangents[nearest_idx]
+        along = (x - point[..., 0]) * tangent[..., 0] + (z - point[..., 2]) * tangent[..., 2]
+        t = np.clip(along / np.maximum(self.segment_lengths[nearest_idx], 1e-9), 0, 1)
+        return point[..., 1] + (next_point[..., 1] - point[..., 1]) * t
+    
+    def past_start_line(self, x, z, nearest_idx):
+        """
+        Whether cars at (x, z) nearest to track points nearest_idx have just crossed the start/finish
+        line: on the far side of it, within the first START_ZONE_LENGTH of the lap. Works on arrays.
+        """
+        along = (x - self.start_point[0]) * self.start_tangent[0] + (z - self.start_point[2]) * self.start_tangent[2]
+        return (self.arc_length[nearest_idx] < START_ZONE_LENGTH) & (along >= 0)
     
     def get_road_boundaries(self, idx):
+        return tuple(self.left_edges[idx].tolist()), tuple(self.right_edges[idx].tolist())
+    
+    def lateral_offset(self, position, idx):
+        # Signed distance from the centerline at point idx, positive toward the left edge
         point = self.points[idx]
-        next_idx = (idx + 1) % len(self.points)
-        next_point = self.points[next_idx]
+        normal = self.normals[idx]
+        return (position[0] - point[0]) * float(normal[0]) + (position[2] - point[2]) * float(normal[2])
+    
+    def build_mesh(self):
+        """
+        Compile the road, start/finish checkerboard, center dashes and guardrails into display lists,
+        one scenery chunk per square of the ground the segments fall in.
+        """
+        self.release_mesh()
+        num_points = len(self.points)
+        left1, right1 = self.left_edges, self.right_edges
+        left2, right2 = np.roll(left1, -1, axis=0), np.roll(right1, -1, axis=0)
         
-        # Calculate direction vector
-        dx = next_point[0] - point[0]
-        dz = next_point[2] - point[2]
-        length = math.sqrt(dx*dx + dz*dz)
+        # Road segments, with a checkerboard pattern near the start/finish line
+        road_vertices = np.stack([left1, right1, right2, left2], axis=1)
+        indices = np.arange(num_points)
+        colors = np.full((num_points, 3), 0.4, dtype=np.float32)  # Regular road color
+        near_start = (indices < 5) | (indices > num_points - 5)
+        colors[near_start] = np.where((indices[near_start] % 2 == 0)[:, np.newaxis], 1.0, 0.0)  # White/black
         
-        if length > 0:
-            dx /= length
-            dz /= length
-            
-        # Perpendicular vector
-        px, pz = -dz, dx
+        # Dashed yellow line down the middle on every other segment
+        lift = np.array([0, 0.01, 0], dtype=np.float32)
+        dashes = np.stack([(left1 + right1) / 2 + lift, (left2 + right2) / 2 + lift], axis=1)
+        dashed = indices % 2 == 0
         
-        # Left and right road boundaries
-        left_x = point[0] + px * self.width / 2
-        left_z = point[2] + pz * self.width / 2
-        right_x = point[0] - px * self.width / 2
-        right_z = point[2] - pz * self.width / 2
+        # Left and right guardrails
+        rail = np.array([0, 0.5, 0], dtype=np.float32)
+        rails = np.stack([left1 + rail, left2 + rail, right1 + rail, right2 + rail], axis=1)
         
-        return (left_x, point[1], left_z), (right_x, point[1], right_z)
+        midpoints = (self.point_array + np.roll(self.point_array, -1, axis=0)) / 2
+        self.road_chunks = []
+        for segments in group_by_chunk(midpoints):
+            segment_dashes = dashes[segments[dashed[segments]]].reshape(-1, 3)
+            segment_rails = rails[segments].reshape(-1, 3)
+            line_vertices = np.concatenate([segment_dashes, segment_rails])
+            line_colors = np.concatenate([np.tile((1.0, 1.0, 0.0), (len(segment_dashes), 1)),  # Yellow
+                                          np.tile((0.6, 0.6, 0.6), (len(segment_rails), 1))])  # Light gray
+            lists = [
+                compile_mesh(GL_QUADS, road_vertices[segments].reshape(-1, 3), np.repeat(colors[segments], 4, axis=0)),
+                compile_mesh(GL_LINES, line_vertices, line_colors),
+            ]
+            vertices = np.concatenate([road_vertices[segments].reshape(-1, 3), segment_rails])
+            self.road_chunks.append(SceneryChunk(vertices.min(axis=0), vertices.max(axis=0), [lists]))
+        self.road_chunk_bounds = chunk_bounds(self.road_chunks)
     
-    def render(self):
-        glColor3f(0.4, 0.4, 0.4)  # Gray road
-        
-        # Draw the road segments
-        for i in range(len(self.points)):
-            next_idx = (i + 1) % len(self.points)
-            
-            point = self.points[i]
-            next_point = self.points[next_idx]
-            
-            left1, right1 = self.get_road_boundaries(i)
-            left2, right2 = self.get_road_boundaries(next_idx)
-            
-            # Draw road segment as quad strip
-            glBegin(GL_QUADS)
-            
-            # Add checkerboard pattern near the start/finish line
-            if i < 5 or i > len(self.points) - 5:
-                if i % 2 == 0:
-                    glColor3f(1.0, 1.0, 1.0)  # White
-                else:
-                    glColor3f(0.0, 0.0, 0.0)  # Black
-            else:
-                glColor3f(0.4, 0.4, 0.4)  # Regular road color
-            
-            glVertex3f(left1[0], left1[1], left1[2])
-            glVertex3f(right1[0], right1[1], right1[2])
-            glVertex3f(right2[0], right2[1], right2[2])
-            glVertex3f(left2[0], left2[1], left2[2])
-            glEnd()
-            
-            # Draw yellow line down the middle
-            glColor3f(1.0, 1.0, 0.0)  # Yellow
-            glBegin(GL_LINES)
-            mid1 = ((left1[0] + right1[0])/2, left1[1] + 0.01, (left1[2] + right1[2])/2)
-            mid2 = ((left2[0] + right2[0])/2, left2[1] + 0.01, (left2[2] + right2[2])/2)
-            
-            # Draw dashed line
-            if i % 2 == 0:
-                glVertex3f(mid1[0], mid1[1], mid1[2])
-                glVertex3f(mid2[0], mid2[1], mid2[2])
-            glEnd()
-            
-            # Draw guardrails
-            glColor3f(0.6, 0.6, 0.6)  # Light gray
-            glBegin(GL_LINES)
-            # Left guardrail
-            glVertex3f(left1[0], left1[1] + 0.5, left1[2])
-            glVertex3f(left2[0], left2[1] + 0.5, left2[2])
-            
-            # Right guardrail
-            glVertex3f(right1[0], right1[1] + 0.5, right1[2])
-            glVertex3f(right2[0], right2[1] + 0.5, right2[2])
-            glEnd()
+    def release_mesh(self):
+        # Free the compiled road geometry so it is rebuilt on the next render
+        for chunk in self.road_chunks or []:
+            chunk.release()
+        self.road_chunks = None
+    
+    def render(self, frustum=None, camera_position=None):
+        """
+        Draw the road and scenery. With a frustum only chunks inside the view are drawn,
+        and with a camera position trees further away use simpler meshes.
+        """
+        # The road geometry never changes, so it is compiled once on first use
+        if self.road_chunks is None:
+            self.build_mesh()
+        self.chunks_drawn = draw_chunks(self.road_chunks, self.road_chunk_bounds, frustum, camera_position)
         
         # Draw the landscape
-        self.render_landscape()
+        self.render_landscape(frustum, camera_position)
     
-    def render_landscape(self):
-        # Draw green ground
-        glColor3f(0.0, 0.6, 0.0)  # Green
-        glBegin(GL_QUADS)
-        glVertex3f(-500, -0.1, -500)
-        glVertex3f(-500, -0.1, 500)
-        glVertex3f(500, -0.1, 500)
-        glVertex3f(500, -0.1, -500)
-        glEnd()
+    def render_landscape(self, frustum=None, camera_position=None):
+        # The mountains never change, so they are baked into one display list
+        if self.backdrop_list is None:
+            self.build_backdrop()
+        glCallList(self.backdrop_list)
         
-        # Draw mountains in the distance
-        glColor3f(0.5, 0.5, 0.5)  # Mountain color
+        # The ground tiles around the camera, generated as they come into view
+        with PROFILER.stage("terrain"):
+            self.terrain.render(frustum, camera_position)
+
+        # Draw the trees in view, simplified with distance; while they load in the background there are none
+        if self.forest_chunks is None and not self.scenery_loading:
+            self.build_forest()
+        if self.forest_chunks is not None:
+            self.chunks_drawn += draw_chunks(self.forest_chunks, self.forest_chunk_bounds, frustum, camera_position)
+
+    def build_backdrop(self):
+        """Compile the ring of distant mountains, standing on the terrain, into a single display list."""
+        self.release_backdrop()
+        mountains = []
+        angles = np.linspace(0, 2 * math.pi, 12, endpoint=False)
+        for x, y, z, height in self.mountain_data:
+            # Stand each cone on the lowest ground under its rim, so no part of it floats
+            ground = self.terrain.height_at(x + height * 0.8 * np.cos(angles), z + height * 0.8 * np.sin(angles))
+            mountains.append(build_mountain_mesh(x, y + float(ground.min()), z, height))
+        mountains = np.concatenate(mountains)
         
-        # Draw a few simple mountains
-        for pos in self.mountain_data:
-            draw_mountain(pos[0], pos[1], pos[2], pos[3])
+        self.backdrop_list = glGenLists(1)
+        glNewList(self.backdrop_list, GL_COMPILE)
+        # Enable polygon offset to prevent z-fighting with the ground
+        glEnable(GL_POLYGON_OFFSET_FILL)
+        glPolygonOffset(1.0, 1.0)
+        draw_arrays(GL_TRIANGLES, mountains, (0.5, 0.5, 0.5))  # Mountain color
+        glDisable(GL_POLYGON_OFFSET_FILL)
+        glEndList()
+    
+    def release_backdrop(self):
+        # Free the compiled mountains so they are rebuilt on the next render
+        if self.backdrop_list is not None:
+            glDeleteLists(self.backdrop_list, 1)
+        self.backdrop_list = None
 
-        # Draw trees
-        for pos in self.tree_positions:
-          draw_tree(pos[0], pos[1], pos[2], pos[3])
+    def plan_forest(self):
+        """
+        Merge pre-transformed copies of the shared trunk and canopy meshes, one scenery chunk
+        per square of the ground with a set of meshes per level of detail. This is the slow part
+        of building the forest and needs no GL, so it can run on a worker thread.
+        Returns the tree list it was made from and (low, high, meshes by LOD) per chunk.
+        """
+        tree_positions = self.tree_positions
+        trees = np.array(tree_positions, dtype=np.float32).reshape(-1, 4)
+        chunks = []
+        for chunk_trees in group_by_chunk(trees[:, :3]):
+            chunk_trees = trees[chunk_trees]
+            # Canopies reach 1 unit out and 2 units above the trunk
+            low = chunk_trees[:, :3] - (1.0, 0.0, 1.0)
+            high = chunk_trees[:, :3] + (1.0, 0.0, 1.0)
+            high[:, 1] += chunk_trees[:, 3] + 2.0
+            meshes = [forest_meshes(chunk_trees, trunk_mesh, canopy_mesh) for trunk_mesh, canopy_mesh in TREE_LODS]
+            chunks.append((low.min(axis=0), high.max(axis=0), meshes))
+        return tree_positions, chunks
 
+    def build_forest(self, plan=None):
+        """Compile the forest into display lists, from a plan_forest() result if one is given."""
+        if plan is None or plan[0] is not self.tree_positions:
+            plan = self.plan_forest()  # None given, or the trees were regenerated since
+        self.release_forest()
+        self.forest_chunks = [
+            SceneryChunk(low, high, [[compile_mesh(GL_TRIANGLES, *mesh) for mesh in lod] for lod in meshes])
+            for low, high, meshes in plan[1]
+        ]
+        self.forest_chunk_bounds = chunk_bounds(self.forest_chunks)
+        self.scenery_loading = False
+
+    def release_forest(self):
+        # Free the compiled trees so they are rebuilt on the next render
+        for chunk in self.forest_chunks or []:
+            chunk.release()
+        self.forest_chunks = None
+
+    def restore_trees(self, generation):
+        # Put the trees and the scenery randomness back to how the given generate_trees call left them
+        if generation != self.tree_generation:
+            self.rng.setstate(self.first_trees_rng_state)
+            self.tree_generation = -1
+            for _ in range(generation + 1):
+                self.generate_trees()
+    
     def generate_trees(self):
-        # Generate trees along the track
-        num_trees = 200
-        for _ in range(num_trees):
+        # Generate trees along the track, after any the track file places itself
+        self.release_forest()
+        self.tree_generation += 1
+        trees = []
+        for _ in range(self.num_trees):
             # Randomly select a point index from the track
-            idx = random.randint(0, len(self.points) - 1)
+            idx = self.rng.randint(0, len(self.points) - 1)
             point = self.points[idx]
 
-            # Get road boundaries to place trees outside
-            left_bound, right_bound = self.get_road_boundaries(idx)
-
             # Determine if the tree will be on the left or right
-            side = random.choice([-1, 1])  # -1 for left, 1 for right
+            side = self.rng.choice([-1, 1])  # -1 for left, 1 for right
 
             # Offset from the road boundary (add some randomness)
-            offset = random.uniform(2, 5)
+            offset = self.rng.uniform(2, 5)
 
-            # Calculate the perpendicular vector 
-            dx = left_bound[0] - point[0]  # Vector from center to left edge
-            dz = left_bound[2] - point[2]
-            # Normalize the perpendicular vector
-            length = math.sqrt(dx*dx + dz*dz)
-            if length > 0:  # Avoid division by zero
-                dx /= length
-                dz /= length
-
-            # Calculate tree position.  Corrected calculation:
-            tree_x = point[0] + side * (self.width / 2 + offset) * dx
-            tree_z = point[2] + side * (self.width / 2 + offset) * dz
-
-            # Get y position from track point (add small offset for ground)
-            tree_y = point[1] + 0.1
+            # Step out from the centerline along the precomputed normal
+            normal = self.normals[idx]
+            distance = float(self.half_widths[idx]) + offset
+            tree_x = point[0] + side * distance * float(normal[0])
+            tree_z = point[2] + side * distance * float(normal[2])
 
             # Random tree height
-            tree_height = random.uniform(3, 6)
-            self.tree_positions.append((tree_x, tree_y, tree_z, tree_height))
+            tree_height = self.rng.uniform(3, 6)
+            trees.append((idx, tree_x, tree_z, tree_height))
+        
+        # Stand the trees on the ground, a stretch of road at a time so each batch only
+        # looks at the road segments near it
+        trees.sort()
+        self.tree_positions = list(self.fixed_trees)
+        for first in range(0, len(trees), TREE_BATCH):
+            _, tree_x, tree_z, tree_height = np.array(trees[first:first + TREE_BATCH]).T
+            tree_y = self.terrain.height_at(tree_x, tree_z)
+            self.tree_positions.extend(zip(tree_x.tolist(), tree_y.tolist(), tree_z.tolist(), tree_height.tolist()))
 
-def draw_car(x, y, z, rotation, color=(1.0, 0.0, 0.0)):
-    glPushMatrix()
+def draw_arrays(mode, vertices, colors, normals=None):
+    """
+    Draw vertex arrays with a single glDrawArrays call.
+    colors is either one color per vertex or a single color for the whole mesh.
+    """
+    vertices = np.ascontiguousarray(vertices, dtype=np.float32)
+    colors = np.ascontiguousarray(colors, dtype=np.float32)
     
-    # Position and rotate the car
-    glTranslatef(x, y, z)
-    glRotatef(rotation, 0, 1, 0)
-    
-    # Main car body
-    glColor3f(color[0], color[1], color[2])
-    glBegin(GL_QUADS)
-    
-    # Bottom
-    glVertex3f(-0.7, 0.0, -1.5)
-    glVertex3f(0.7, 0.0, -1.5)
-    glVertex3f(0.7, 0.0, 1.5)
-    glVertex3f(-0.7, 0.0, 1.5)
-    
-    # Front
-    glVertex3f(-0.7, 0.0, 1.5)
-    glVertex3f(0.7, 0.0, 1.5)
-    glVertex3f(0.7, 0.5, 1.2)
-    glVertex3f(-0.7, 0.5, 1.2)
-    
-    # Back
-    glVertex3f(-0.7, 0.0, -1.5)
-    glVertex3f(0.7, 0.0, -1.5)
-    glVertex3f(0.7, 0.5, -1.3)
-    glVertex3f(-0.7, 0.5, -1.3)
-    
-    # Left side
-    glVertex3f(-0.7, 0.0, -1.5)
-    glVertex3f(-0.7, 0.0, 1.5)
-    glVertex3f(-0.7, 0.5, 1.2)
-    glVertex3f(-0.7, 0.5, -1.3)
-    
-    # Right side
-    glVertex3f(0.7, 0.0, -1.5)
-    glVertex3f(0.7, 0.0, 1.5)
-    glVertex3f(0.7, 0.5, 1.2)
-    glVertex3f(0.7, 0.5, -1.3)
-    
-    # Top
-    glVertex3f(-0.7, 0.5, -1.3)
-    glVertex3f(0.7, 0.5, -1.3)
-    glVertex3f(0.7, 0.5, -0.3)
-    glVertex3f(-0.7, 0.5, -0.3)
-    
-    # Windshield
-    glColor3f(0.1, 0.1, 0.7)  # Blue tint
-    glVertex3f(-0.65, 0.5, 1.0)
-    glVertex3f(0.65, 0.5, 1.0)
-    glVertex3f(0.65, 1.0, 0.0)
-    glVertex3f(-0.65, 1.0, 0.0)
-    
-    # Roof
-    glColor3f(color[0], color[1], color[2])
-    glVertex3f(-0.65, 1.0, 0.0)
-    glVertex3f(0.65, 1.0, 0.0)
-    glVertex3f(0.65, 1.0, -1.0)
-    glVertex3f(-0.65, 1.0, -1.0)
-    
-    # Rear window
-    glColor3f(0.1, 0.1, 0.7)  # Blue tint
-    glVertex3f(-0.65, 1.0, -1.0)
-    glVertex3f(0.65, 1.0, -1.0)
-    glVertex3f(0.65, 0.5, -1.3)
-    glVertex3f(-0.65, 0.5, -1.3)
-    
-    glEnd()
-    
-    # Wheels
-    glColor3f(0.1, 0.1, 0.1)  # Black
-    
-    # Front-left wheel
-    glPushMatrix()
-    glTranslatef(-0.7, 0.2, 1.0)
-    glScalef(0.3, 0.3, 0.5)
-    draw_cylinder()
-    glPopMatrix()
+    glEnableClientState(GL_VERTEX_ARRAY)
+    glVertexPointer(3, GL_FLOAT, 0, vertices)
+    if colors.ndim == 1:
+        if len(colors) == 4:
+            glColor4fv(colors)
+        else:
+            glColor3fv(colors)
+    else:
+        glEnableClientState(GL_COLOR_ARRAY)
+        glColorPointer(colors.shape[1], GL_FLOAT, 0, colors)
+    if normals is not None:
+        normals = np.ascontiguousarray(normals, dtype=np.float32)
+        glEnableClientState(GL_NORMAL_ARRAY)
+        glNormalPointer(GL_FLOAT, 0, normals)
     
-    # Front-right wheel
-    glPushMatrix()
-    glTranslatef(0.7, 0.2, 1.0)
-    glScalef(0.3, 0.3, 0.5)
-    draw_cylinder()
-    glPopMatrix()
+    glDrawArrays(mode, 0, len(vertices))
     
-    # Rear-left wheel
-    glPushMatrix()
-    glTranslatef(-0.7, 0.2, -1.0)
-    glScalef(0.3, 0.3, 0.5)
-    draw_cylinder()
-    glPopMatrix()
+    if normals is not None:
+        # Leave the default normal behind for geometry drawn without normals
+        glNormal3f(0, 0, 1)
+    glDisableClientState(GL_NORMAL_ARRAY)
+    glDisableClientState(GL_COLOR_ARRAY)
+    glDisableClientState(GL_VERTEX_ARRAY)
+
+def compile_mesh(mode, vertices, colors, normals=None):
+    """
+    Compile vertex arrays into a display list and return its id.
+    """
+    list_id = glGenLists(1)
+    glNewList(list_id, GL_COMPILE)
+    # Client-side arrays are dereferenced while compiling, so the data ends up in the list
+    draw_arrays(mode, vertices, colors, normals)
+    glEndList()
+    return list_id
+
+def build_cylinder_mesh(bottom_radius, top_radius, height, num_segments):
+    """
+    Build an open cylinder or cone standing on the origin along +y.
+    Returns (vertices, normals) as float32 arrays laid out as GL_TRIANGLES.
+    """
+    angles = np.linspace(0, 2 * math.pi, num_segments + 1)
+    cos, sin = np.cos(angles), np.sin(angles)
     
-    # Rear-right wheel
-    glPushMatrix()
-    glTranslatef(0.7, 0.2, -1.0)
-    glScalef(0.3, 0.3, 0.5)
-    draw_cylinder()
-    glPopMatrix()
+    # Side normals lean up or down depending on how the radius changes with height
+    normals = np.stack([cos * height, np.full_like(cos, bottom_radius - top_radius), sin * height], axis=1)
+    normals /= np.linalg.norm(normals, axis=1, keepdims=True)
+    bottom = np.stack([cos * bottom_radius, np.zeros_like(cos), sin * bottom_radius], axis=1)
+    top = np.stack([cos * top_radius, np.full_like(cos, height), sin * top_radius], axis=1)
     
-    glPopMatrix()
+    # Two triangles per side face
+    i, j = np.arange(num_segments), np.arange(1, num_segments + 1)
+    vertices = np.stack([bottom[i], bottom[j], top[j], bottom[i], top[j], top[i]], axis=1)
+    vertex_normals = np.stack([normals[i], normals[j], normals[j], normals[i], normals[j], normals[i]], axis=1)
+    return vertices.reshape(-1, 3).astype(np.float32), vertex_normals.reshape(-1, 3).astype(np.float32)
 
-def draw_cylinder():
-    # A very simple cylinder approximation with quads
-    glBegin(GL_QUADS)
+def build_impostor_mesh(bottom_radius, top_radius, height):
+    """
+    Two crossed upright quads with the outline of a cylinder or cone, for distant scenery.
+    Returns (vertices, normals) as float32 arrays laid out as GL_TRIANGLES.
+    """
+    vertices = []
+    normals = []
+    for axis, normal in ((0, (0, 0, 1)), (2, (1, 0, 0))):
+        corners = np.zeros((4, 3), dtype=np.float32)
+        corners[:, axis] = (-bottom_radius, bottom_radius, top_radius, -top_radius)
+        corners[2:, 1] = height
+        vertices.extend(corners[[0, 1, 2, 0, 2, 3]])
+        normals.extend((normal,) * 6)
+    return np.array(vertices, dtype=np.float32), np.array(normals, dtype=np.float32)
+
+# Shared tree meshes by level of detail: a unit-height trunk (scaled per tree) and a canopy cone
+TREE_TRUNK_MESH = build_cylinder_mesh(0.2, 0.2, 1.0, 10)
+TREE_CANOPY_MESH = build_cylinder_mesh(0.0, 1.0, 2.0, 10)
+TREE_LODS = [
+    (TREE_TRUNK_MESH, TREE_CANOPY_MESH),
+    (build_cylinder_mesh(0.2, 0.2, 1.0, 4), build_cylinder_mesh(0.0, 1.0, 2.0, 5)),
+    (build_impostor_mesh(0.2, 0.2, 1.0), build_impostor_mesh(0.0, 1.0, 2.0)),
+]
+LOD_DISTANCES = (60.0, 150.0)  # Chunks further than these use the next level of detail
+SCENERY_CHUNK_SIZE = 32.0  # Side of the ground squares scenery is grouped into for culling
+
+def forest_meshes(trees, trunk_mesh, canopy_mesh):
+    # Trunks and canopies for trees given as (x, y, z, height) rows, as compile_mesh arguments
+    offsets = trees[:, np.newaxis, :3]
+    heights = trees[:, np.newaxis, 3:4]
     
-    num_segments = 8
-    for i in range(num_segments):
-        angle1 = 2 * math.pi * i / num_segments
-        angle2 = 2 * math.pi * (i + 1) / num_segments
-        
-        # Calculate points on the circle
-        x1 = math.cos(angle1)
-        y1 = math.sin(angle1)
-        x2 = math.cos(angle2)
-        y2 = math.sin(angle2)
-        
-        # Side face
-        glVertex3f(x1, y1, -0.5)
-        glVertex3f(x2, y2, -0.5)
-        glVertex3f(x2, y2, 0.5)
-        glVertex3f(x1, y1, 0.5)
-        
-        # End cap 1
-        glVertex3f(0, 0, -0.5)
-        glVertex3f(x1, y1, -0.5)
-        glVertex3f(x2, y2, -0.5)
-        
-        # End cap 2
-        glVertex3f(0, 0, 0.5)
-        glVertex3f(x1, y1, 0.5)
-        glVertex3f(x2, y2, 0.5)
+    # Trunks are stretched to the tree height, canopies sit on top of the trunk
+    trunk_vertices, trunk_normals = trunk_mesh
+    trunks = np.repeat(trunk_vertices[np.newaxis], len(trees), axis=0)
+    trunks[:, :, 1:2] *= heights
+    trunks += offsets
     
-    glEnd()
+    canopy_vertices, canopy_normals = canopy_mesh
+    canopies = canopy_vertices[np.newaxis] + offsets
+    canopies[:, :, 1:2] += heights
+    
+    return [
+        (trunks.reshape(-1, 3), (0.5, 0.35, 0.05), np.tile(trunk_normals, (len(trees), 1))),  # Brown
+        (canopies.reshape(-1, 3), (0.0, 0.8, 0.0), np.tile(canopy_normals, (len(trees), 1))),  # Green
+    ]
 
-def draw_mountain(x, y, z, height):
-    glPushMatrix()
-    glTranslatef(x, y, z)
+class SceneryChunk:
+    """A group of static scenery with a bounding sphere and display lists for each level of detail."""
+    def __init__(self, low, high, lod_lists):
+        self.center = (np.asarray(low) + np.asarray(high)) / 2
+        self.radius = float(np.linalg.norm(np.asarray(high) - np.asarray(low)) / 2)
+        self.lod_lists = lod_lists
+    
+    def release(self):
+        for lists in self.lod_lists:
+            for list_id in lists:
+                glDeleteLists(list_id, 1)
+        self.lod_lists = []
 
-    # Enable polygon offset to prevent z-fighting
-    glEnable(GL_POLYGON_OFFSET_FILL)
-    glPolygonOffset(1.0, 1.0)
+def group_by_chunk(positions):
+    # Indices of the positions falling in each occupied chunk square of the ground
+    cells = np.floor(np.asarray(positions)[:, [0, 2]] / SCENERY_CHUNK_SIZE).astype(np.int64)
+    if len(cells) == 0:
+        return []
+    _, chunk_of = np.unique(cells, axis=0, return_inverse=True)
+    chunk_of = chunk_of.reshape(-1)
+    order = np.argsort(chunk_of, kind="stable")
+    return np.split(order, np.flatnonzero(np.diff(chunk_of[order])) + 1)
 
-    # Draw a simple cone for the mountain
-    glBegin(GL_TRIANGLE_FAN)
-    glVertex3f(0, height, 0)  # Peak
+def chunk_bounds(chunks):
+    # Bounding spheres of the chunks as arrays, for culling them all at once
+    return (np.array([chunk.center for chunk in chunks]).reshape(-1, 3),
+            np.array([chunk.radius for chunk in chunks]))
 
-    num_segments = 12
-    radius = height * 0.8
+def draw_chunks(chunks, bounds, frustum=None, camera_position=None):
+    """
+    Draw the chunks whose bounding spheres touch the frustum, picking each chunk's level of detail
+    by how close it comes to the camera. Returns the number of chunks drawn.
+    """
+    centers, radii = bounds
+    visible = np.ones(len(chunks), dtype=bool) if frustum is None else frustum.spheres_visible(centers, radii)
+    if camera_position is None:
+        lods = np.zeros(len(chunks), dtype=np.int64)
+    else:
+        distances = np.linalg.norm(centers - np.asarray(camera_position, dtype=np.float32), axis=1) - radii
+        lods = np.searchsorted(LOD_DISTANCES, distances)
+    
+    for i in np.flatnonzero(visible):
+        lod_lists = chunks[i].lod_lists
+        for list_id in lod_lists[min(lods[i], len(lod_lists) - 1)]:
+            glCallList(list_id)
+    return int(np.count_nonzero(visible))
 
-    for i in range(num_segments + 1):
-        angle = 2 * math.pi * i / num_segments
-        glVertex3f(radius * math.cos(angle), 0, radius * math.sin(angle))
+class Frustum:
+    """The six clip planes of a camera, as (a, b, c, d) rows with normals pointing inward."""
+    def __init__(self, projection, modelview):
+        # Matrices are given as read back from OpenGL, in column-major order
+        clip = (np.asarray(modelview, dtype=np.float64).reshape(4, 4) @
+                np.asarray(projection, dtype=np.float64).reshape(4, 4)).T
+        self.planes = np.array([clip[3] + clip[0], clip[3] - clip[0],  # Left, right
+                                clip[3] + clip[1], clip[3] - clip[1],  # Bottom, top
+                                clip[3] + clip[2], clip[3] - clip[2]])  # Near, far
+        self.planes /= np.linalg.norm(self.planes[:, :3], axis=1, keepdims=True)
+    
+    @classmethod
+    def from_gl(cls):
+        # The camera currently set up in the projection and modelview matrices
+        return cls(glGetFloatv(GL_PROJECTION_MATRIX), glGetFloatv(GL_MODELVIEW_MATRIX))
+    
+    def spheres_visible(self, centers, radii):
+        distances = np.asarray(centers) @ self.planes[:, :3].T + self.planes[:, 3]
+        return np.all(distances > -np.asarray(radii)[:, np.newaxis], axis=1)
+    
+    def sphere_visible(self, center, radius):
+        return bool(self.spheres_visible(np.array([center]), np.array([radius]))[0])
 
-    glEnd()
+# Car bodies as quads in car space (x right, y up, z forward); True marks painted panels
+CAR_BODY_STYLES = {
+    "coupe": [
+        (True, [(-0.7, 0.0, -1.5), (0.7, 0.0, -1.5), (0.7, 0.0, 1.5), (-0.7, 0.0, 1.5)]),  # Bottom
+        (True, [(-0.7, 0.0, 1.5), (0.7, 0.0, 1.5), (0.7, 0.5, 1.2), (-0.7, 0.5, 1.2)]),  # Front
+        (True, [(-0.7, 0.0, -1.5), (0.7, 0.0, -1.5), (0.7, 0.5, -1.3), (-0.7, 0.5, -1.3)]),  # Back
+        (True, [(-0.7, 0.0, -1.5), (-0.7, 0.0, 1.5), (-0.7, 0.5, 1.2), (-0.7, 0.5, -1.3)]),  # Left side
+        (True, [(0.7, 0.0, -1.5), (0.7, 0.0, 1.5), (0.7, 0.5, 1.2), (0.7, 0.5, -1.3)]),  # Right side
+        (True, [(-0.7, 0.5, -1.3), (0.7, 0.5, -1.3), (0.7, 0.5, -0.3), (-0.7, 0.5, -0.3)]),  # Top
+        (False, [(-0.65, 0.5, 1.0), (0.65, 0.5, 1.0), (0.65, 1.0, 0.0), (-0.65, 1.0, 0.0)]),  # Windshield
+        (True, [(-0.65, 1.0, 0.0), (0.65, 1.0, 0.0), (0.65, 1.0, -1.0), (-0.65, 1.0, -1.0)]),  # Roof
+        (False, [(-0.65, 1.0, -1.0), (0.65, 1.0, -1.0), (0.65, 0.5, -1.3), (-0.65, 0.5, -1.3)]),  # Rear window
+    ],
+}
+CAR_WINDOW_COLOR = (0.1, 0.1, 0.7)  # Blue tint
+CAR_WHEEL_COLOR = (0.1, 0.1, 0.1)  # Black
+CAR_WHEEL_OFFSETS = [(-0.7, 0.2, 1.0), (0.7, 0.2, 1.0), (-0.7, 0.2, -1.0), (0.7, 0.2, -1.0)]
 
-    # Disable polygon offset
-    glDisable(GL_POLYGON_OFFSET_FILL)
+_car_mesh_cache = {}
 
-    glPopMatrix()
+def build_wheel_mesh(num_segments=8):
+    # A capped cylinder along z, scaled to wheel size
+    side_vertices, side_normals = build_cylinder_mesh(1.0, 1.0, 1.0, num_segments)
+    angles = np.linspace(0, 2 * math.pi, num_segments + 1)
+    rim = np.stack([np.cos(angles), np.zeros_like(angles), np.sin(angles)], axis=1)
+    caps = []
+    cap_normals = []
+    for y, normal in ((0.0, (0, -1, 0)), (1.0, (0, 1, 0))):
+        center = np.array([0.0, y, 0.0])
+        for i in range(num_segments):
+            caps.extend((center, rim[i] + center, rim[i + 1] + center))
+            cap_normals.extend((normal,) * 3)
+    vertices = np.concatenate([side_vertices, np.array(caps, dtype=np.float32)])
+    normals = np.concatenate([side_normals, np.array(cap_normals, dtype=np.float32)])
+    
+    # Lay the cylinder along z, centered on the origin, then scale it to a wheel
+    vertices = vertices[:, [0, 2, 1]] - (0, 0, 0.5)
+    normals = normals[:, [0, 2, 1]]
+    return vertices * (0.3, 0.3, 0.5), normals
 
-def draw_sky():
-    glPushMatrix()
+def get_car_mesh(style="coupe"):
+    """
+    Return the cached (vertices, normals, colors, paint_mask) triangle arrays for a body style.
+    Painted vertices take the color of each car when drawn.
+    """
+    if style in _car_mesh_cache:
+        return _car_mesh_cache[style]
+    
+    vertices = []
+    normals = []
+    colors = []
+    paint_mask = []
+    for painted, quad in CAR_BODY_STYLES[style]:
+        quad = np.array(quad, dtype=np.float32)
+        normal = np.cross(quad[1] - quad[0], quad[2] - quad[0])
+        # Point the normal away from the middle of the car
+        if np.dot(normal, quad.mean(axis=0) - (0, 0.5, 0)) < 0:
+            normal = -normal
+        normal /= np.linalg.norm(normal)
+        vertices.extend(quad[[0, 1, 2, 0, 2, 3]])
+        normals.extend((normal,) * 6)
+        colors.extend(((1.0, 1.0, 1.0, 1.0) if painted else CAR_WINDOW_COLOR + (1.0,),) * 6)
+        paint_mask.extend((painted,) * 6)
+    
+    wheel_vertices, wheel_normals = build_wheel_mesh()
+    for offset in CAR_WHEEL_OFFSETS:
+        vertices.extend(wheel_vertices + offset)
+        normals.extend(wheel_normals)
+        colors.extend((CAR_WHEEL_COLOR + (1.0,),) * len(wheel_vertices))
+        paint_mask.extend((False,) * len(wheel_vertices))
+    
+    mesh = (np.array(vertices, dtype=np.float32), np.array(normals, dtype=np.float32),
+            np.array(colors, dtype=np.float32), np.array(paint_mask))
+    _car_mesh_cache[style] = mesh
+    return mesh
 
-    glDisable(GL_LIGHTING)
+def draw_cars(positions, rotations, colors, style="coupe"):
+    """
+    Draw many cars sharing one body style with a single draw call.
+    positions is (N, 3), rotations are yaw angles in degrees and colors are RGB or RGBA.
+    """
+    positions = np.asarray(positions, dtype=np.float32).reshape(-1, 3)
+    if len(positions) == 0:
+        return
+    angles = np.radians(np.asarray(rotations, dtype=np.float32)).reshape(-1, 1)
+    cos, sin = np.cos(angles), np.sin(angles)
+    vertices, normals, base_colors, paint_mask = get_car_mesh(style)
     
-    # Light blue color for the sky
-    glColor3f(0.5, 0.7, 1.0)
+    # Rotate the shared mesh about the y axis for every car, then move it into place
+    world_vertices = np.empty((len(positions), len(vertices), 3), dtype=np.float32)
+    world_vertices[:, :, 0] = vertices[:, 0] * cos + vertices[:, 2] * sin + positions[:, 0:1]
+    world_vertices[:, :, 1] = vertices[:, 1] + positions[:, 1:2]
+    world_vertices[:, :, 2] = vertices[:, 2] * cos - vertices[:, 0] * sin + positions[:, 2:3]
+    world_normals = np.empty_like(world_vertices)
+    world_normals[:, :, 0] = normals[:, 0] * cos + normals[:, 2] * sin
+    world_normals[:, :, 1] = normals[:, 1]
+    world_normals[:, :, 2] = normals[:, 2] * cos - normals[:, 0] * sin
     
-    # Draw a half sphere for the sky
-    num_lat = 15
-    num_long = 30
-    radius = 3000
-    glTranslatef(0,0,0)
+    # Painted panels take each car's color, windows and wheels keep their own; alpha applies to all
+    colors = np.asarray(colors, dtype=np.float32).reshape(len(positions), -1)
+    car_colors = np.ones((len(positions), 4), dtype=np.float32)
+    car_colors[:, :colors.shape[1]] = colors
+    world_colors = np.repeat(base_colors[np.newaxis], len(positions), axis=0)
+    world_colors[:, paint_mask] = car_colors[:, np.newaxis, :]
+    world_colors[:, :, 3] = car_colors[:, 3:4]
     
+    draw_arrays(GL_TRIANGLES, world_vertices.reshape(-1, 3), world_colors.reshape(-1, 4),
+                world_normals.reshape(-1, 3))
+
+CAR_BOUNDING_RADIUS = 2.0  # Radius of a sphere around a car's position that holds all of it
+GHOST_COLOR = (0.8, 0.9, 1.0, 0.35)
+
+def draw_ghost(position, rotation):
+    # A see-through car, drawn after the solid ones without hiding what is behind it
+    glEnable(GL_BLEND)
+    glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+    glDepthMask(GL_FALSE)
+    draw_cars([position], [rotation], [GHOST_COLOR])
+    glDepthMask(GL_TRUE)
+    glDisable(GL_BLEND)
+
+def build_mountain_mesh(x, y, z, height, num_segments=12):
+    """
+    Build a simple cone standing at (x, y, z) for a distant mountain.
+    Returns its vertices as a float32 array laid out as GL_TRIANGLES.
+    """
+    angles = np.linspace(0, 2 * math.pi, num_segments + 1)
+    radius = height * 0.8
+    rim = np.stack([x + radius * np.cos(angles), np.full_like(angles, y), z + radius * np.sin(angles)], axis=1)
+    peak = np.tile((x, y + height, z), (num_segments, 1))
+    
+    # One triangle from the peak to each rim edge
+    return np.stack([peak, rim[:-1], rim[1:]], axis=1).reshape(-1, 3).astype(np.float32)
+
+def build_sky_mesh(radius=3000, num_lat=15, num_long=30):
+    """
+    Build the upper half of a sphere around the origin for the sky.
+    Returns its vertices as a float32 array laid out as GL_QUADS.
+    """
+    longitudes = 2 * math.pi * np.arange(num_long + 1) / num_long
+    ring = np.stack([np.cos(longitudes), np.zeros_like(longitudes), np.sin(longitudes)], axis=1)
+    
+    quads = []
     for i in range(num_lat):
         lat0 = math.pi * (-0.5 + (i - 1) / num_lat)
-        z0 = radius * math.sin(lat0)
-        zr0 = radius * math.cos(lat0)
-        
         lat1 = math.pi * (-0.5 + i / num_lat)
-        z1 = radius * math.sin(lat1)
-        zr1 = radius * math.cos(lat1)
         
-        # Only draw the top half
-        if z0 < 0 or z1 < 0:
+        # Only the top half
+        if math.sin(lat0) < 0 or math.sin(lat1) < 0:
             continue
         
-        glBegin(GL_QUAD_STRIP)
-        for j in range(num_long + 1):
-            lng = 2 * math.pi * j / num_long
-            x = math.cos(lng)
-            y = math.sin(lng)
-            
-            glVertex3f(x * zr0, z0, y * zr0)
-            glVertex3f(x * zr1, z1, y * zr1)
-        
-        glEnd()
+        band0 = ring * radius * math.cos(lat0) + (0, radius * math.sin(lat0), 0)
+        band1 = ring * radius * math.cos(lat1) + (0, radius * math.sin(lat1), 0)
+        quads.append(np.stack([band0[:-1], band1[:-1], band1[1:], band0[1:]], axis=1))
+    return np.concatenate(quads).reshape(-1, 3).astype(np.float32)
 
-    glEnable(GL_LIGHTING)
+_sky_list = None  # Display list for the sky dome, built on first draw
+
+def draw_sky():
+    global _sky_list
+    # The dome never changes, so it is baked into a display list the first time it is drawn
+    if _sky_list is None:
+        _sky_list = compile_mesh(GL_QUADS, build_sky_mesh(), (0.5, 0.7, 1.0))  # Light blue
     
-    glPopMatrix()
+    glDisable(GL_LIGHTING)
+    glCallList(_sky_list)
+    glEnable(GL_LIGHTING)
 
-def draw_text(x, y, text, font, color=(255, 255, 255)):
+class GlyphAtlas:
     """
-    Render text at (x, y) using OpenGL.
+    The printable ASCII glyphs of one font, rasterized once into a texture.
+    Strings are drawn as textured quads, with their layout cached by text.
     """
-    # Render the text to a Pygame surface
-    text_surface = font.render(text, True, color)
-    text_data = pygame.image.tostring(text_surface, "RGBA", True)
-    text_width, text_height = text_surface.get_size()
-
-    # Adjust y coordinate because OpenGL's origin is at the bottom left.
-    y = HEIGHT - y - text_height
-
-    # Set pixel storage mode
-    glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+    max_cached_layouts = 256
     
-    # Enable blending for transparency
-    glEnable(GL_BLEND)
-    glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+    def __init__(self, font):
+        self.font = font
+        self.line_height = font.get_height()
+        self.layouts = OrderedDict()  # text -> (vertices, texcoords, width)
+        
+        # Render each glyph in white so it can be tinted with glColor when drawn
+        glyph_surfaces = {chr(code): font.render(chr(code), True, (255, 255, 255)) for code in range(32, 127)}
+        
+        # Pack the glyphs into rows no wider than the texture
+        atlas_width = 1024
+        x = y = row_height = 0
+        placements = {}
+        for char, surface in glyph_surfaces.items():
+            width, height = surface.get_size()
+            if x + width > atlas_width:
+                x, y = 0, y + row_height
+                row_height = 0
+            placements[char] = (x, y, width, height)
+            x += width
+            row_height = max(row_height, height)
+        atlas_height = y + row_height
+        
+        atlas = pygame.Surface((atlas_width, atlas_height), pygame.SRCALPHA)
+        atlas.fill((0, 0, 0, 0))
+        self.glyphs = {}  # char -> (width, height, u0, v0, u1, v1)
+        for char, (x, y, width, height) in placements.items():
+            atlas.blit(glyph_surfaces[char], (x, y))
+            # The texture is uploaded bottom row first, so v runs upward
+            self.glyphs[char] = (width, height, x / atlas_width, 1 - (y + height) / atlas_height,
+                                 (x + width) / atlas_width, 1 - y / atlas_height)
+        
+        self.texture = glGenTextures(1)
+        glBindTexture(GL_TEXTURE_2D, self.texture)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_NEAREST)
+        glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_NEAREST)
+        glPixelStorei(GL_UNPACK_ALIGNMENT, 1)
+        glTexImage2D(GL_TEXTURE_2D, 0, GL_RGBA, atlas_width, atlas_height, 0, GL_RGBA, GL_UNSIGNED_BYTE,
+                     pygame.image.tostring(atlas, "RGBA", True))
+        glBindTexture(GL_TEXTURE_2D, 0)
     
-    # Set the raster position for drawing pixels
-    glWindowPos2i(x, y)
+    def layout(self, text):
+        # Quads for the string with its bottom-left corner at the origin
+        if text in self.layouts:
+            self.layouts.move_to_end(text)
+            return self.layouts[text]
+        
+        vertices = []
+        texcoords = []
+        x = 0
+        for char in text:
+            width, height, u0, v0, u1, v1 = self.glyphs.get(char, self.glyphs["?"])
+            y = self.line_height - height
+            vertices.extend(((x, y), (x + width, y), (x + width, y + height), (x, y + height)))
+            texcoords.extend(((u0, v0), (u1, v0), (u1, v1), (u0, v1)))
+            x += width
+        
+        layout = (np.array(vertices, dtype=np.float32).reshape(-1, 2),
+                  np.array(texcoords, dtype=np.float32).reshape(-1, 2), x)
+        self.layouts[text] = layout
+        if len(self.layouts) > self.max_cached_layouts:
+            self.layouts.popitem(last=False)
+        return layout
     
-    # Draw the text pixels
-    glDrawPixels(text_width, text_height, GL_RGBA, GL_UNSIGNED_BYTE, text_data)
+    def measure(self, text):
+        return self.layout(text)[2], self.line_height
     
-    # Optionally, disable blending if not needed elsewhere
-    glDisable(GL_BLEND)
+    def draw(self, x, y, text, color):
+        vertices, texcoords, _ = self.layout(text)
+        if len(vertices) == 0:
+            return
+        
+        glEnable(GL_TEXTURE_2D)
+        glBindTexture(GL_TEXTURE_2D, self.texture)
+        glEnable(GL_BLEND)
+        glBlendFunc(GL_SRC_ALPHA, GL_ONE_MINUS_SRC_ALPHA)
+        glColor4ub(*color[:3], color[3] if len(color) > 3 else 255)
+        
+        glPushMatrix()
+        glTranslatef(x, y, 0)
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glEnableClientState(GL_TEXTURE_COORD_ARRAY)
+        glVertexPointer(2, GL_FLOAT, 0, vertices)
+        glTexCoordPointer(2, GL_FLOAT, 0, texcoords)
+        glDrawArrays(GL_QUADS, 0, len(vertices))
+        glDisableClientState(GL_TEXTURE_COORD_ARRAY)
+        glDisableClientState(GL_VERTEX_ARRAY)
+        glPopMatrix()
+        
+        glDisable(GL_BLEND)
+        glBindTexture(GL_TEXTURE_2D, 0)
+        glDisable(GL_TEXTURE_2D)
 
-def draw_tree(x, y, z, height):  # <---  HERE, in the global scope
-    glPushMatrix()
-    glTranslatef(x, y, z)
+_glyph_atlases = {}
 
-    # Draw trunk (brown cylinder)
-    glColor3f(0.5, 0.35, 0.05)  # Brown color
-    glPushMatrix()
-    glRotatef(-90, 1, 0, 0)  # Rotate to stand upright
-    gluCylinder(gluNewQuadric(), 0.2, 0.2, height, 10, 2)
-    glPopMatrix()
+def get_glyph_atlas(font):
+    # Atlases need a GL context, so each one is built the first time its font is drawn
+    if font not in _glyph_atlases:
+        _glyph_atlases[font] = GlyphAtlas(font)
+    return _glyph_atlases[font]
 
-    # Draw leaves (green cone)
-    glColor3f(0.0, 0.8, 0.0)  # Green color
-    glTranslatef(0, height, 0)  # Move to top of trunk
-    glRotatef(-90, 1, 0, 0)
-    gluCylinder(gluNewQuadric(), 0, 1.0, 2.0, 10, 2) #Simplified from a cone
-
-    glPopMatrix()
+def draw_text(x, y, text, font, color=(255, 255, 255)):
+    """
+    Render text at (x, y), measured from the top left of the window.
+    Must be called with the orthographic HUD projection set up by render_hud.
+    """
+    atlas = get_glyph_atlas(font)
+    
+    # Adjust y coordinate because OpenGL's origin is at the bottom left.
+    atlas.draw(x, HEIGHT - y - atlas.line_height, text, color)
 
-def render_hud(game_state, player):
+def begin_overlay():
     # Switch to orthographic projection for HUD rendering
     glMatrixMode(GL_PROJECTION)
     glPushMatrix()
@@ -609,13 +1358,25 @@ def render_hud(game_state, player):
     # Disable depth testing and lighting so text draws on top
     glDisable(GL_DEPTH_TEST)
     glDisable(GL_LIGHTING)
+
+def end_overlay():
+    # Restore OpenGL state
+    glEnable(GL_DEPTH_TEST)
+    glEnable(GL_LIGHTING)
+    glMatrixMode(GL_PROJECTION)
+    glPopMatrix()
+    glMatrixMode(GL_MODELVIEW)
+    glPopMatrix()
+
+def render_hud(game_state, player):
+    begin_overlay()
     
     # Render HUD elements using draw_text
-    current_time = time.time() - game_state.start_time if game_state.game_started else 0
+    current_time = game_state.race_clock if game_state.game_started else 0
     time_str = format_time(current_time)
     draw_text(20, HEIGHT - 40, f"TIME: {time_str}", hud_font)
     draw_text(20, HEIGHT - 70, f"LAP: {game_state.laps + 1}/{game_state.total_laps}", hud_font)
-    draw_text(20, HEIGHT - 100, f"POSITION: {game_state.race_position}/8", hud_font)
+    draw_text(20, HEIGHT - 100, f"POSITION: {game_state.race_position}/{game_state.field_size}", hud_font)
     
     speed_percent = abs(player.speed / player.max_speed * 100)
     draw_text(WIDTH - 200, HEIGHT - 40, f"SPEED: {int(speed_percent)} MPH", hud_font)
@@ -628,16 +1389,15 @@ def render_hud(game_state, player):
     
     if game_state.countdown_active:
         count_text = str(game_state.countdown_value) if game_state.countdown_value > 0 else "GO!"
-        # Center the countdown text (roughly)
-        count_surface = countdown_font.render(count_text, True, (255, 255, 0))
-        text_width, text_height = count_surface.get_size()
+        # Center the countdown text
+        text_width, text_height = get_glyph_atlas(countdown_font).measure(count_text)
         center_x = (WIDTH - text_width) // 2
         center_y = (HEIGHT - text_height) // 2
         draw_text(center_x, center_y, count_text, countdown_font, (255, 255, 0))
     
     if game_state.game_over:
         go_text = "RACE COMPLETE!"
-        center_x = (WIDTH - game_over_font.size(go_text)[0]) // 2
+        center_x = (WIDTH - get_glyph_atlas(game_over_font).measure(go_text)[0]) // 2
         draw_text(center_x, HEIGHT - 200, go_text, game_over_font, (255, 255, 0))
         draw_text((WIDTH - 200) // 2, HEIGHT - 250, f"Total Time: {format_time(game_state.total_time)}", hud_font)
         draw_text((WIDTH - 200) // 2, HEIGHT - 280, f"Final Position: {get_ordinal(game_state.race_position)}", hud_font)
@@ -645,13 +1405,28 @@ def render_hud(game_state, player):
             draw_text((WIDTH - 200) // 2, HEIGHT - 310, f"Best Lap: {format_time(game_state.best_lap)}", hud_font)
         draw_text((WIDTH - 200) // 2, HEIGHT - 340, "Press ENTER to restart", hud_font)
     
-    # Restore OpenGL state
-    glEnable(GL_DEPTH_TEST)
-    glEnable(GL_LIGHTING)
-    glMatrixMode(GL_PROJECTION)
-    glPopMatrix()
-    glMatrixMode(GL_MODELVIEW)
-    glPopMatrix()
+    end_overlay()
+
+def render_profiler_overlay(profiler):
+    """Draw the rolling min/avg/p99 time of every profiled stage in the top right corner."""
+    begin_overlay()
+    
+    # One row per stage, with the numbers right-aligned in columns of milliseconds
+    atlas = get_glyph_atlas(profiler_font)
+    rows = [("STAGE", "MIN ms", "AVG ms", "P99 ms")]
+    for name, times in profiler.stats().items():
+        rows.append((name,) + tuple(f"{seconds * 1000:.2f}" for seconds in times))
+    name_width = max(atlas.measure(row[0])[0] for row in rows)
+    column_width = max(atlas.measure(cell)[0] for row in rows for cell in row[1:]) + 10
+    left = WIDTH - name_width - 3 * column_width - 10
+    for i, row in enumerate(rows):
+        y = 130 + i * atlas.line_height
+        draw_text(left, y, row[0], profiler_font)
+        for column, cell in enumerate(row[1:], 1):
+            right = left + name_width + column * column_width
+            draw_text(right - atlas.measure(cell)[0], y, cell, profiler_font)
+    
+    end_overlay()
 
 def format_time(seconds):
     minutes = int(seconds // 60)
@@ -665,40 +1440,138 @@ def get_ordinal(n):
         suffix = {1: "st", 2: "nd", 3: "rd"}.get(n % 10, "th")
     return f"{n}{suffix}"
 
-def check_collision(obj1, obj2):
-    dx = obj1.position[0] - obj2.position[0]
-    dz = obj1.position[2] - obj2.position[2]
-    distance = math.sqrt(dx*dx + dz*dz)
-    return distance < (obj1.collision_radius + obj2.collision_radius)
+def find_contacts(positions, radii):
+    """
+    Find every pair of overlapping cars in the ground plane.
+    The broad phase sorts cars along the axis they are most spread out on and only pairs
+    neighbors whose gap on that axis is within reach; the narrow phase checks the distance.
+    Returns index arrays (first, second) of the touching pairs.
+    """
+    count = len(positions)
+    if count < 2:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+    
+    axis = 0 if np.ptp(positions[:, 0]) >= np.ptp(positions[:, 2]) else 2
+    order = np.argsort(positions[:, axis], kind="stable")
+    coords = positions[order, axis]
+    reach = 2 * radii.max()
+    
+    # Pair each car with the k-th next one along the axis until no such pair is close enough
+    first = []
+    second = []
+    for k in range(1, count):
+        close = np.flatnonzero(coords[k:] - coords[:-k] < reach)
+        if len(close) == 0:
+            break
+        first.append(order[close])
+        second.append(order[close + k])
+    if not first:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+    first = np.concatenate(first)
+    second = np.concatenate(second)
+    
+    dx = positions[first, 0] - positions[second, 0]
+    dz = positions[first, 2] - positions[second, 2]
+    touching = dx*dx + dz*dz < (radii[first] + radii[second]) ** 2
+    return first[touching], second[touching]
+
+def resolve_collisions(positions, speeds, radii, slowdown=0.5, push_force=0.2):
+    """
+    Slow down both cars of every contact and push them apart, updating the arrays in place.
+    Returns the touching pairs as index arrays (first, second).
+    """
+    first, second = find_contacts(positions, radii)
+    if len(first) == 0:
+        return first, second
+    
+    # Every contact a car is part of halves its speed
+    contacts = np.bincount(np.concatenate([first, second]), minlength=len(speeds))
+    speeds *= slowdown ** contacts
+    
+    # Push along the line between the two cars
+    dx = positions[first, 0] - positions[second, 0]
+    dz = positions[first, 2] - positions[second, 2]
+    dist = np.sqrt(dx*dx + dz*dz)
+    apart = dist > 0
+    push_x = np.where(apart, dx / np.where(apart, dist, 1), 0) * push_force
+    push_z = np.where(apart, dz / np.where(apart, dist, 1), 0) * push_force
+    np.add.at(positions[:, 0], first, push_x)
+    np.add.at(positions[:, 2], first, push_z)
+    np.add.at(positions[:, 0], second, -push_x)
+    np.add.at(positions[:, 2], second, -push_z)
+    return first, second
 
 def start_countdown(game_state):
+    # The countdown is ticked by a one-second pygame.USEREVENT timer the game loop sets up
     game_state.countdown_active = True
     game_state.countdown_value = 3
-    pygame.time.set_timer(pygame.USEREVENT, 1000)  # 1 second timer
+
+def start_race(game_state):
+    game_state.countdown_active = False
+    game_state.game_started = True
+    game_state.race_clock = 0
+    game_state.lap_start_time = 0
+    game_state.ghost.start_lap()
 
 def end_race(game_state):
     game_state.game_over = True
-    game_state.total_time = time.time() - game_state.start_time
-    pygame.time.set_timer(pygame.USEREVENT, 0)  # Disable the timer
+    game_state.total_time = game_state.race_clock
+
+# Starting grid layout
+GRID_ROW_SPACING = 6.0  # Distance between rows, shortened when a big field would not fit on the track
+GRID_CAR_SPACING = 2.5  # Distance between cars side by side in a row
+GRID_LINE_GAP = 5.0  # The front row starts this far short of the start/finish line
+
+def grid_positions(track, count):
+    """
+    Starting grid slots for count cars, pole position first: rows across the road as many cars
+    wide as the narrowest part of the track allows, each column a little behind the one to its
+    left, lined up along the centerline back from just short of the start/finish line, so no car
+    is handed part of its first lap. Returns positions (count, 3), headings in degrees and the
+    track point each slot is on, the checkpoint a car starts from.
+    """
+    columns = max(1, int(2 * float(np.min(track.half_widths)) // GRID_CAR_SPACING))
+    rows = -(-count // columns)
+    row_spacing = min(GRID_ROW_SPACING, 0.9 * (track.length - GRID_LINE_GAP) / max(rows, 1))
+    slot = np.arange(count)
+    row, column = slot // columns, slot % columns
+    
+    # Distance along the track and across it for every slot
+    distance = track.length - GRID_LINE_GAP - row * row_spacing - column * row_spacing / (2 * columns)
+    across = ((columns - 1) / 2 - column) * GRID_CAR_SPACING
+    idx = np.searchsorted(track.arc_length, distance, side="right") - 1
+    tangents = track.tangents[idx]
+    positions = track.point_array[idx] + tangents * (distance - track.arc_length[idx])[:, np.newaxis]
+    positions += track.normals[idx] * across[:, np.newaxis]
+    positions[:, 1] = track.road_height(positions[:, 0], positions[:, 2], idx) + CAR_RIDE_HEIGHT
+    headings = np.degrees(np.arctan2(tangents[:, 0], tangents[:, 2])) % 360
+    return positions.astype(np.float64), headings.astype(np.float64), idx
+
+def line_up(player, position, heading, checkpoint):
+    # Put a player car on its grid slot, a lap down until it crosses the start/finish line
+    player.position = [float(value) for value in position]
+    player.rotation = float(heading)
+    player.previous_rotation = player.rotation
+    player.laps = -1
+    player.last_checkpoint = int(checkpoint)
+    player.save_previous_state()
+
+def place_on_grid(player, fleet, track):
+    # Line the field up for the start, the player on pole and the AI cars behind
+    positions, headings, checkpoints = grid_positions(track, 1 + len(fleet))
+    line_up(player, positions[0], headings[0], checkpoints[0])
+    fleet.reset(positions[1:], headings[1:], checkpoints[1:])
 
-def reset_game(game_state, player, ai_cars, track):
+def reset_game(game_state, player, fleet, track):
     # Reset player
-    player.position = [0, 0.5, 0]
-    player.rotation = 0
     player.speed = 0
     player.gear = 0
+    player.progress = 0.0
+    player.nearest_idx = None
+    
+    # Back to the starting grid
+    place_on_grid(player, fleet, track)
     
-    # Reset AI cars
-    for i, car in enumerate(ai_cars):
-        start_offset = 5 + i * 2
-        car.position = [random.uniform(-3, 3), 0.5, -start_offset]
-        car.rotation = 0
-        car.speed = random.uniform(0.2, 0.6)
-        car.laps = 0
-    
-    # Reset track checkpoints
-    track.last_checkpoint = {}
-    track.tree_positions = []  # Clear existing tree positions
     track.generate_trees()     # Re-generate tree positions
     
     # Reset game state
@@ -707,291 +1580,529 @@ def reset_game(game_state, player, ai_cars, track):
     game_state.countdown_active = False
     game_state.laps = 0
     game_state.race_position = 1
+    game_state.standings.reset()
     game_state.total_time = 0
     game_state.lap_times = []
+    game_state.collisions = 0
+    game_state.car_contacts = 0
     
     # Start new countdown
     start_countdown(game_state)
 
-def main():
-    global WIDTH, HEIGHT 
-    original_flags = DOUBLEBUF | OPENGL | RESIZABLE
+# Race events packed into the input mask of the step they happen before, above the control bits
+RACE_START = 1 << 14
+RACE_RESET = 1 << 15
 
-    WIDTH, HEIGHT = 1024, 768
+class Controls:
+    """Driver inputs held during one simulation step."""
+    FIELDS = ("accelerate", "brake", "handbrake", "shift_up", "shift_down", "steer_left", "steer_right")
+    
+    def __init__(self, accelerate=False, brake=False, handbrake=False, shift_up=False, shift_down=False,
+                 steer_left=False, steer_right=False):
+        self.accelerate = accelerate
+        self.brake = brake
+        self.handbrake = handbrake
+        self.shift_up = shift_up
+        self.shift_down = shift_down
+        self.steer_left = steer_left
+        self.steer_right = steer_right
+    
+    def to_bits(self):
+        # One bit per input, in FIELDS order, for recording
+        return sum(1 << i for i, name in enumerate(self.FIELDS) if getattr(self, name))
+    
+    @classmethod
+    def from_bits(cls, bits):
+        return cls(**{name: bool(bits >> i & 1) for i, name in enumerate(cls.FIELDS)})
 
-    # Initialize game components
-    game_state = GameState()
-    player = PlayerCar()
-    track = Track()
+def read_controls(keys):
+    # Map the keyboard state from pygame.key.get_pressed to driver inputs
+    return Controls(
+        accelerate=bool(keys[K_UP] or keys[K_w]),
+        brake=bool(keys[K_DOWN] or keys[K_s]),
+        handbrake=bool(keys[K_SPACE]),
+        shift_up=bool(keys[K_LSHIFT]),
+        shift_down=bool(keys[K_LCTRL]),
+        steer_left=bool(keys[K_LEFT] or keys[K_a]),
+        steer_right=bool(keys[K_RIGHT] or keys[K_d]),
+    )
 
-    # Set up proper lighting
-    glEnable(GL_DEPTH_TEST)
-    glEnable(GL_LIGHTING)
-    glEnable(GL_LIGHT0)
+def update_player(player, controls, dt):
+    frames = dt * REFERENCE_FRAME_RATE
     
-    # Set light properties for better outdoor lighting
-    ambient_light = [0.4, 0.4, 0.4, 1.0]  # Brighter ambient light
-    diffuse_light = [0.8, 0.8, 0.8, 1.0]  # Strong diffuse light
+    # Acceleration
+    if controls.accelerate:
+        if player.gear > 0:
+            player.acceleration = 0.01 * player.gear
+        else:
+            player.acceleration = 0
+    elif controls.brake:
+        player.acceleration = -0.02
+    else:
+        player.acceleration = -0.005
     
-    glLightfv(GL_LIGHT0, GL_AMBIENT, ambient_light)
-    glLightfv(GL_LIGHT0, GL_DIFFUSE, diffuse_light)
+    # Apply acceleration
+    player.speed += player.acceleration * frames
     
-    # Material settings
-    glEnable(GL_COLOR_MATERIAL)
-    glColorMaterial(GL_FRONT_AND_BACK, GL_AMBIENT_AND_DIFFUSE)
+    # Apply gear limits
+    gear_max_speed = (player.gear / player.max_gear) * player.max_speed
+    player.speed = max(-0.3, min(player.speed, gear_max_speed))
     
-    # Set clear color to match sky color
-    glClearColor(0.5, 0.7, 1.0, 1.0)
+    # Braking
+    if controls.handbrake:
+        player.speed *= 0.95 ** frames
     
-    # Create AI cars
-    ai_cars = []
-    car_colors = [
-        (1.0, 0.0, 0.0),  # Red
-        (0.0, 1.0, 0.0),  # Green
-        (0.0, 0.0, 1.0),  # Blue
-        (1.0, 1.0, 0.0),  # Yellow
-        (1.0, 0.0, 1.0),  # Magenta
-        (0.0, 1.0, 1.0),  # Cyan
-        (1.0, 0.5, 0.0)   # Orange
-    ]
+    # Gear shifting happens once per press
+    if controls.shift_up and not player.shift_up_held:
+        if player.gear < player.max_gear and (player.gear == 0 or player.speed >= player.gear * 0.1):
+            player.gear = min(player.gear + 1, player.max_gear)
+    player.shift_up_held = controls.shift_up
     
-    for i in range(7):
-        start_offset = 5 + i * 2
-        ai_cars.append(AICar([random.uniform(-3, 3), 0.5, -start_offset], car_colors[i]))
+    if controls.shift_down and not player.shift_down_held:
+        if player.gear > 0:
+            player.gear = max(player.gear - 1, 0)
+    player.shift_down_held = controls.shift_down
     
-    # Start countdown
-    start_countdown(game_state)
+    # Steering
+    turn = player.steering_speed * (1 - abs(player.speed / player.max_speed) * 0.5) * frames
+    if controls.steer_left:
+        player.rotation += turn
+    if controls.steer_right:
+        player.rotation -= turn
     
-    # Main game loop
-    clock = pygame.time.Clock()
-    running = True
-    last_time = time.time()
-    lap_start_time = 0
+    # Movement
+    player.position[0] += math.sin(math.radians(player.rotation)) * player.speed * frames
+    player.position[2] += math.cos(math.radians(player.rotation)) * player.speed * frames
 
-    # Variables to track button press state
-    shift_pressed = False
-    ctrl_pressed = False
-    fullscreen = False
+def follow_track(player, track, frames):
+    """
+    Keep a player car on the track after it moved: find its segment, put it on the road surface,
+    slow it down off the road and track its progress. Returns True when it just completed a lap.
+    """
+    nearest_point, nearest_idx = track.get_nearest_point_near(player.position, player.nearest_idx)
+    player.nearest_idx = nearest_idx
+    player.position[1] = float(track.road_height(player.position[0], player.position[2], nearest_idx)) + CAR_RIDE_HEIGHT
     
-    while running:
-        glViewport(0, 0, WIDTH, HEIGHT)
-        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-        # Calculate delta time
-        current_time = time.time()
-        dt = current_time - last_time
-        last_time = current_time
+    # If player is too far from center, slow them down (off-track penalty)
+    if abs(track.lateral_offset(player.position, nearest_idx)) > track.half_widths[nearest_idx]:
+        player.speed *= 0.95 ** frames
+    
+    # Check for lap completion
+    completed_lap = False
+    if track.past_start_line(player.position[0], player.position[2], nearest_idx):
+        if player.last_checkpoint > len(track.points) / 2:
+            player.laps += 1
+            player.last_checkpoint = 0
+            completed_lap = player.laps > 0  # Crossing from the grid only begins the first lap
+    
+    # Update checkpoint tracking
+    if nearest_idx > player.last_checkpoint:
+        player.last_checkpoint = nearest_idx
+    player.progress = player.laps * track.length + float(track.lap_progress(player.position[0], player.position[2],
+                                                                            nearest_idx))
+    return completed_lap
+
+def update_simulation(game_state, player, controls, fleet, track, dt):
+    """
+    Advance the race by one fixed step of dt seconds.
+    The state before the step is kept on the cars so rendering can interpolate.
+    """
+    player.save_previous_state()
+    fleet.save_previous_state()
+    if not game_state.game_started or game_state.game_over:
+        return
+    
+    game_state.race_clock += dt
+    frames = dt * REFERENCE_FRAME_RATE
+    with PROFILER.stage("player"):
+        update_player(player, controls, dt)
+    
+    # Update AI cars
+    with PROFILER.stage("ai"):
+        fleet.update(track, dt)
+        if fleet.planner is not None:
+            fleet.planner.publish(fleet.position, fleet.rotation, fleet.speed, fleet.nearest_idx, fleet.cruise_speed,
+                                  [(player.position[0], player.position[2], player.speed)])
+    
+    # Collisions between every pair of cars, with the player as car 0
+    with PROFILER.stage("collisions"):
+        positions = np.vstack([player.position, fleet.position])
+        speeds = np.concatenate([[player.speed], fleet.speed])
+        radii = np.concatenate([[player.collision_radius], fleet.collision_radius])
+        first, second = resolve_collisions(positions, speeds, radii)
+        if len(first):
+            player.position[:] = positions[0].tolist()
+            player.speed = float(speeds[0])
+            fleet.position[:] = positions[1:]
+            fleet.speed[:] = speeds[1:]
+            game_state.collisions += int(np.count_nonzero(first == 0) + np.count_nonzero(second == 0))
+            game_state.car_contacts += len(first)
+    
+    # Keep player on the track and count laps
+    if follow_track(player, track, frames):
+        current_lap_time = game_state.race_clock - game_state.lap_start_time
+        game_state.lap_times.append(current_lap_time)
         
-        # Button Press Process events
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT:
-                running = False
-            
-            # --- Event Handling ---
-            if event.type == pygame.KEYDOWN:
-                if event.key == K_RETURN and (game_state.game_over or not game_state.game_started):
-                    reset_game(game_state, player, ai_cars, track)
-                if event.key == K_f: # Check for 'F' key press
-                    fullscreen = not fullscreen  # Toggle fullscreen state
-                    if fullscreen:
-                        new_width, new_height = 1920, 1080
-                        screen = pygame.display.set_mode((new_width, new_height), original_flags | FULLSCREEN)
-                        resize_viewport(new_width, new_height)  # Resize the viewport
-                        WIDTH, HEIGHT = new_width, new_height  # update globals
-                    else:
-                        screen = pygame.display.set_mode((1024, 768), original_flags)
-                        resize_viewport(1024, 768)
-                        WIDTH, HEIGHT = 1024, 768
+        game_state.ghost.finish_lap(current_lap_time < game_state.best_lap)
+        if current_lap_time < game_state.best_lap:
+            game_state.best_lap = current_lap_time
+        
+        game_state.laps += 1
+        game_state.lap_start_time = game_state.race_clock
+        
+        if game_state.laps >= game_state.total_laps:
+            end_race(game_state)
+    
+    # Sample the lap for the ghost car
+    game_state.ghost.record(game_state.race_clock - game_state.lap_start_time, player.position, player.rotation)
+    
+    # Update race position
+    with PROFILER.stage("standings"):
+        standings = game_state.standings
+        standings.update(np.concatenate([[player.progress], fleet.progress]))
+        game_state.race_position = int(standings.rank[0]) + 1
 
+def run_step(inputs, game_state, player, fleet, track):
+    """
+    Run one simulation step from an input mask: a race start or reset queued for this step,
+    then the step itself with the recorded controls. Live play and replays both go through here,
+    so a replay takes exactly the steps the race did.
+    """
+    if inputs & RACE_RESET:
+        reset_game(game_state, player, fleet, track)
+    if inputs & RACE_START:
+        start_race(game_state)
+    update_simulation(game_state, player, Controls.from_bits(inputs), fleet, track, SIM_DT)
+
+PLAYER_COLOR = (0.9, 0.1, 0.1)
+
+def interpolate_cars(player, fleet, alpha):
+    """
+    Positions and rotations of the player followed by every AI car, blended alpha of the way
+    from the previous simulation step to the current one.
+    """
+    previous_positions = np.vstack([player.previous_position, fleet.previous_position])
+    positions = np.vstack([player.position, fleet.position])
+    previous_rotations = np.concatenate([[player.previous_rotation], fleet.previous_rotation])
+    rotations = np.concatenate([[player.rotation], fleet.rotation])
+    return (previous_positions + (positions - previous_positions) * alpha,
+            previous_rotations + (rotations - previous_rotations) * alpha)
+
+def render_scene(game_state, player, fleet, track, alpha, show_profiler=False):
+    """
+    Draw one frame: the world seen from behind the player with the cars blended alpha of the way
+    from the previous simulation step to the current one, then the HUD on top.
+    """
+    # Blend between the last two simulation steps for smooth motion
+    car_positions, car_rotations = interpolate_cars(player, fleet, alpha)
+    player_x, player_y, player_z = car_positions[0]
+    player_rotation = car_rotations[0]
+    
+    # Clear the screen
+    glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+    
+    # Set up camera
+    glMatrixMode(GL_MODELVIEW)
+    glLoadIdentity()
+    
+    # Third-person camera view
+    camera_distance = 5
+    camera_height = 2
+    
+    # Calculate camera position
+    camera_x = player_x - camera_distance * math.sin(math.radians(player_rotation))
+    camera_y = player_y + camera_height
+    camera_z = player_z - camera_distance * math.cos(math.radians(player_rotation))
+    
+    # Look at player car
+    gluLookAt(
+        camera_x, camera_y, camera_z,          # Camera position
+        player_x, player_y, player_z,          # Look at point
+        0, 1, 0                                 # Up vector
+    )
+    
+    # --- DRAW SKY FIRST ---
+    glDisable(GL_DEPTH_TEST)  # Temporarily disable depth testing
+    glDisable(GL_LIGHTING)   # Disable lighting for the sky
+    with PROFILER.stage("sky"):
+        draw_sky()
+    glEnable(GL_DEPTH_TEST)  # Re-enable depth testing
+    glEnable(GL_LIGHTING)    # Re-enable lighting
+
+    # Set up lighting (AFTER drawing the sky)
+    light_position = [0, 100, 0, 1]
+    glLightfv(GL_LIGHT0, GL_POSITION, light_position)
+    
+    # Render the track and the scenery in view
+    with PROFILER.stage("track"):
+        frustum = Frustum.from_gl()
+        track.render(frustum, (camera_x, camera_y, camera_z))
+    
+    # Render the player and AI cars in view in one batch
+    with PROFILER.stage("cars"):
+        visible = frustum.spheres_visible(car_positions, np.full(len(car_positions), CAR_BOUNDING_RADIUS))
+        car_colors = np.vstack([PLAYER_COLOR, fleet.color_array])
+        draw_cars(car_positions[visible], car_rotations[visible], car_colors[visible])
+        
+        # The ghost of the best lap, at the same point in its lap as the drawn player car
+        lap_time = game_state.race_clock - game_state.lap_start_time - (1 - alpha) * SIM_DT
+        if game_state.game_started and not game_state.game_over and game_state.ghost.sample(lap_time):
+            draw_ghost(game_state.ghost.position, game_state.ghost.rotation)
+    
+    with PROFILER.stage("hud"):
+        render_hud(game_state, player)
+        if show_profiler:
+            render_profiler_overlay(PROFILER)
+
+# AI car colors
+CAR_COLORS = [
+    (1.0, 0.0, 0.0),  # Red
+    (0.0, 1.0, 0.0),  # Green
+    (0.0, 0.0, 1.0),  # Blue
+    (1.0, 1.0, 0.0),  # Yellow
+    (1.0, 0.0, 1.0),  # Magenta
+    (0.0, 1.0, 1.0),  # Cyan
+    (1.0, 0.5, 0.0)   # Orange
+]
+
+def car_colors(count):
+    # The classic colors first, then hues spread around the color wheel by the golden ratio
+    extra = [colorsys.hsv_to_rgb((i * 0.618034) % 1.0, 0.85 - 0.3 * (i % 2), 1.0 - 0.25 * (i % 3))
+             for i in range(max(0, count - len(CAR_COLORS)))]
+    return (CAR_COLORS + extra)[:count]
+
+def new_race(seed, num_ai=len(CAR_COLORS), track_data=None):
+    """
+    Build the game components for a race, on the built-in oval or a loaded track file.
+    Everything random comes from generators seeded with seed, so the same seed, track and
+    inputs always give the same race.
+    """
+    game_state = GameState()
+    player = PlayerCar()
+    track = Track(rng=random.Random(seed), data=track_data)
+    
+    game_state.field_size = 1 + num_ai
+    
+    # Create AI cars and line everyone up on the grid
+    rng = np.random.default_rng(seed)
+    fleet = AIFleet(np.zeros((num_ai, 3)), car_colors(num_ai), rng)
+    place_on_grid(player, fleet, track)
+    return game_state, player, track, fleet
+
+def main(record_path=None, track_path=None, num_ai=len(CAR_COLORS), ai_planner=False):
+    global WIDTH, HEIGHT 
+    WIDTH, HEIGHT = 1024, 768
+    
+    # A track file is compiled on first use and memory-mapped from the cache after that
+    track_data = trackfile.load_track(track_path) if track_path else None
+    init_display()
+    init_lighting()
+
+    # Initialize game components; the forest, music and fonts load while the countdown runs
+    seed = random.randrange(2 ** 32)
+    game_state, player, track, fleet = new_race(seed, num_ai, track_data)
+    loader = Loader(track)
+    
+    # Let the AI think in a worker process; it drives the simple way until the first plan arrives
+    if ai_planner:
+        fleet.planner = AIPlanner(track, len(fleet), min_corner_speed=fleet.min_corner_speed,
+                                  corner_slowdown=fleet.corner_slowdown)
+    
+    # Record every simulation step if asked to
+    recorder = None
+    try:
+        if record_path:
+            recorder = ReplayWriter(record_path, seed, len(fleet), sim_rate=SIM_RATE,
+                                    track_hash=trackfile.track_hash(track_data))
+        
+        # Start countdown
+        start_countdown(game_state)
+        pygame.time.set_timer(pygame.USEREVENT, 1000)  # 1 second timer
+        race_events = 0  # RACE_START and RACE_RESET waiting for the next simulation step
+        
+        # Main game loop
+        clock = pygame.time.Clock()
+        running = True
+        last_time = time.perf_counter()
+        sim_accumulator = 0.0
+        fullscreen = False
+        
+        # Frame stages are always timed so a trace can be dumped right after a hitch
+        PROFILER.set_enabled(True)
+        show_profiler = False
+        
+        while running:
+            PROFILER.begin_frame()
+            if loader:
+                loader = None if loader.poll() else loader
+            glViewport(0, 0, WIDTH, HEIGHT)
+            glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+            # Calculate delta time
+            current_time = time.perf_counter()
+            frame_time = min(current_time - last_time, 0.25)
+            last_time = current_time
             
-            if event.type == pygame.VIDEORESIZE:  # Handle window resizing (if not fullscreen)
-                if not fullscreen:  # Only resize if NOT in fullscreen
-                    new_width, new_height = event.size
-                    screen = pygame.display.set_mode((new_width, new_height), original_flags | RESIZABLE)
-                    resize_viewport(new_width, new_height)
-            if event.type == pygame.USEREVENT:  # 1-second timer for countdown
-                if game_state.countdown_value > 0:
-                    game_state.countdown_value -= 1
-                else:
-                    game_state.countdown_active = False
-                    game_state.game_started = True
-                    game_state.start_time = time.time()
-                    lap_start_time = time.time()
-                    pygame.time.set_timer(pygame.USEREVENT, 0)  # Disable the timer
-        
-        # Get keyboard input
-        keys = pygame.key.get_pressed()
-        
-        # Game logic
-        if game_state.game_started and not game_state.game_over:
-            # Acceleration
-            if keys[K_UP] or keys[K_w]:
-                if player.gear > 0:
-                    player.acceleration = 0.01 * player.gear
-                else:
-                    player.acceleration = 0
-            elif keys[K_DOWN] or keys[K_s]:
-                player.acceleration = -0.02
-            else:
-                player.acceleration = -0.005
-            
-            # Apply acceleration
-            player.speed += player.acceleration
-            
-            # Apply gear limits
-            gear_max_speed = (player.gear / player.max_gear) * player.max_speed
-            player.speed = max(-0.3, min(player.speed, gear_max_speed))
-            
-            # Braking
-            if keys[K_SPACE]:
-                player.speed *= 0.95
-            
-            # Gear shifting (using button press/release logic)
-            if keys[K_LSHIFT] and not shift_pressed:  # Key pressed and not already pressed
-                shift_pressed = True  # Mark key as pressed
-                if player.gear < player.max_gear and (player.gear == 0 or player.speed >= player.gear * 0.1):
-                    player.gear = min(player.gear + 1, player.max_gear)
-            elif not keys[K_LSHIFT]:  # Key released
-                shift_pressed = False  # Mark key as released
+            # Button Press Process events
+            with PROFILER.stage("events"):
+                for event in pygame.event.get():
+                    if event.type == pygame.QUIT:
+                        running = False
                 
-            if keys[K_LCTRL] and not ctrl_pressed: # Key pressed and not already pressed
-                ctrl_pressed = True # Mark key as pressed
-                if player.gear > 0:
-                   player.gear = max(player.gear - 1, 0)
-            elif not keys[K_LCTRL]:  # Key released
-                ctrl_pressed = False # Mark Key as released
-            
-            # Steering
-            if keys[K_LEFT] or keys[K_a]:
-                player.rotation += player.steering_speed * (1 - abs(player.speed / player.max_speed) * 0.5)
-            if keys[K_RIGHT] or keys[K_d]:
-                player.rotation -= player.steering_speed * (1 - abs(player.speed / player.max_speed) * 0.5)
-            
-            # Movement
-            player.position[0] += math.sin(math.radians(player.rotation)) * player.speed
-            player.position[2] += math.cos(math.radians(player.rotation)) * player.speed
-            
-            # Update AI cars
-            for car in ai_cars:
-                car.update(track, dt)
-            
-            # Check for collisions between player and AI cars
-            for car in ai_cars:
-                if check_collision(player, car):
-                    # Slow down both cars
-                    player.speed *= 0.5
-                    car.speed *= 0.5
-                    
-                    # Calculate push direction
-                    dx = player.position[0] - car.position[0]
-                    dz = player.position[2] - car.position[2]
-                    dist = math.sqrt(dx*dx + dz*dz)
-                    
-                    if dist > 0:
-                        # Normalize
-                        dx /= dist
-                        dz /= dist
-                        
-                        # Push cars apart
-                        push_force = 0.2
-                        player.position[0] += dx * push_force
-                        player.position[2] += dz * push_force
-                        car.position[0] -= dx * push_force
-                        car.position[2] -= dz * push_force
-            
-            # Keep player on the track (simple boundary check)
-            nearest_point, nearest_idx = track.get_nearest_point(player.position)
-            left_bound, right_bound = track.get_road_boundaries(nearest_idx)
-            
-            # Calculate distance to track center
-            center_x = (left_bound[0] + right_bound[0]) / 2
-            center_z = (left_bound[2] + right_bound[2]) / 2
-            dist_to_center = math.sqrt((player.position[0] - center_x)**2 + (player.position[2] - center_z)**2)
+                    # --- Event Handling ---
+                    if event.type == pygame.KEYDOWN:
+                        if event.key == K_RETURN and (game_state.game_over or not game_state.game_started):
+                            race_events = RACE_RESET  # A reset also drops a start still waiting
+                            pygame.time.set_timer(pygame.USEREVENT, 1000)  # Restart the countdown timer
+                        if event.key == K_f: # Check for 'F' key press
+                            fullscreen = not fullscreen  # Toggle fullscreen state
+                            if fullscreen:
+                                new_width, new_height = 1920, 1080
+                                screen = pygame.display.set_mode((new_width, new_height), WINDOW_FLAGS | FULLSCREEN)
+                                resize_viewport(new_width, new_height)  # Resize the viewport
+                                WIDTH, HEIGHT = new_width, new_height  # update globals
+                            else:
+                                screen = pygame.display.set_mode((1024, 768), WINDOW_FLAGS)
+                                resize_viewport(1024, 768)
+                                WIDTH, HEIGHT = 1024, 768
+                        if event.key == K_F3:  # Toggle the frame profiler overlay
+                            show_profiler = not show_profiler
+                        if event.key == K_F12:  # Save a trace of the recent frames
+                            path = PROFILER.dump_trace(time.strftime("profile_trace_%Y%m%d_%H%M%S.json"))
+                            print(f"Saved frame trace to {path}")
+
+                
+                    if event.type == pygame.VIDEORESIZE:  # Handle window resizing (if not fullscreen)
+                        if not fullscreen:  # Only resize if NOT in fullscreen
+                            new_width, new_height = event.size
+                            screen = pygame.display.set_mode((new_width, new_height), WINDOW_FLAGS)
+                            resize_viewport(new_width, new_height)
+                    if event.type == pygame.USEREVENT:  # 1-second timer for countdown
+                        if game_state.countdown_value > 0:
+                            game_state.countdown_value -= 1
+                        else:
+                            race_events |= RACE_START
+                            pygame.time.set_timer(pygame.USEREVENT, 0)  # Disable the timer
+                
+                # Get keyboard input
+                controls = read_controls(pygame.key.get_pressed())
             
-            # If player is too far from center, slow them down (off-track penalty)
-            if dist_to_center > track.width / 2:
-                player.speed *= 0.95
+            # Game logic runs in fixed steps, as many as the elapsed time calls for
+            sim_accumulator += frame_time
+            sim_steps = 0
+            while sim_accumulator >= SIM_DT and sim_steps < MAX_SIM_STEPS_PER_FRAME:
+                inputs = controls.to_bits() | race_events
+                race_events = 0
+                with PROFILER.stage("simulation"):
+                    if recorder:
+                        recorder.record(inputs, game_state, player, fleet, track)
+                    run_step(inputs, game_state, player, fleet, track)
+                sim_accumulator -= SIM_DT
+                sim_steps += 1
+            if sim_steps == MAX_SIM_STEPS_PER_FRAME:
+                # Too slow to keep up: drop the backlog rather than falling further behind
+                sim_accumulator = min(sim_accumulator, SIM_DT)
             
-            # Check for lap completion
-            if nearest_idx < 5 and player.position[2] > 0 and abs(player.position[0]) < 5:
-                last_checkpoint = track.last_checkpoint.get(player, 0)
-                if last_checkpoint > len(track.points) / 2:
-                    # Completed a lap
-                    current_lap_time = time.time() - lap_start_time
-                    game_state.lap_times.append(current_lap_time)
-                    
-                    if current_lap_time < game_state.best_lap:
-                        game_state.best_lap = current_lap_time
-                    
-                    game_state.laps += 1
-                    lap_start_time = time.time()
-                    
-                    if game_state.laps >= game_state.total_laps:
-                        end_race(game_state)
+            # Draw the world, blending between the last two simulation steps for smooth motion
+            render_scene(game_state, player, fleet, track, sim_accumulator / SIM_DT, show_profiler)
             
-            # Update checkpoint tracking
-            if nearest_idx > track.last_checkpoint.get(player, 0):
-                track.last_checkpoint[player] = nearest_idx
+            # Update the screen
+            screen = pygame.display.get_surface()
+            with PROFILER.stage("flip"):
+                pygame.display.flip()
             
-            # Update race position
-            all_cars = [player] + ai_cars
-            sorted_cars = sorted(all_cars, key=lambda car: car.laps * len(track.points) + track.last_checkpoint.get(car, 0), reverse=True)
-            game_state.race_position = sorted_cars.index(player) + 1
-        
-        # Clear the screen
-        glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
-        
-        # Set up camera
-        glMatrixMode(GL_MODELVIEW)
-        glLoadIdentity()
-        
-        # Third-person camera view
-        camera_distance = 5
-        camera_height = 2
-        
-        # Calculate camera position
-        camera_x = player.position[0] - camera_distance * math.sin(math.radians(player.rotation))
-        camera_y = player.position[1] + camera_height
-        camera_z = player.position[2] - camera_distance * math.cos(math.radians(player.rotation))
-        
-        # Look at player car
-        gluLookAt(
-            camera_x, camera_y, camera_z,          # Camera position
-            player.position[0], player.position[1], player.position[2],  # Look at point
-            0, 1, 0                                 # Up vector
-        )
-        
-        # --- DRAW SKY FIRST ---
-        glDisable(GL_DEPTH_TEST)  # Temporarily disable depth testing
-        glDisable(GL_LIGHTING)   # Disable lighting for the sky
-        draw_sky()
-        glEnable(GL_DEPTH_TEST)  # Re-enable depth testing
-        glEnable(GL_LIGHTING)    # Re-enable lighting
+            # Cap the frame rate; the simulation keeps its own pace
+            with PROFILER.stage("tick"):
+                clock.tick(MAX_RENDER_FPS)
+            PROFILER.end_frame()
+    finally:
+        # Close the planner's shared memory and finish the replay however the loop ended
+        if recorder:
+            recorder.close()
+        if fleet.planner:
+            fleet.planner.close()
+    
+    # Quit pygame
+    pygame.quit()
+    sys.exit()
 
-        # Set up lighting (AFTER drawing the sky)
-        light_position = [0, 100, 0, 1]
-        glLightfv(GL_LIGHT0, GL_POSITION, light_position)
-        
-        # Render the track
-        track.render()
+def play_replay(path, track_path=None):
+    """
+    Watch a recorded race, on the track it was recorded on. SPACE pauses, LEFT and RIGHT jump
+    5 seconds back or forward, HOME jumps to the start and ESC quits.
+    """
+    try:
+        reader = ReplayReader(path)
+    except (OSError, ValueError) as error:
+        sys.exit(f"Can't play the replay: {error}")
+    track_data = trackfile.load_track(track_path) if track_path else None
+    if trackfile.track_hash(track_data) != reader.track_hash:
+        sys.exit(f"{path} was recorded on another track; pass the --track it was recorded on")
+    init_display()
+    init_lighting()
+    game_state, player, track, fleet = new_race(reader.seed, reader.num_ai, track_data)
+    loader = Loader(track, music=False)
+    
+    def simulate(inputs):
+        run_step(inputs, game_state, player, fleet, track)
+    
+    step = reader.seek(0, game_state, player, fleet, track, simulate)
+    clock = pygame.time.Clock()
+    last_time = time.perf_counter()
+    sim_accumulator = 0.0
+    paused = False
+    running = True
+    while running:
+        if loader:
+            loader = None if loader.poll() else loader
+        current_time = time.perf_counter()
+        frame_time = min(current_time - last_time, 0.25)
+        last_time = current_time
         
-        # Render the player car
-        draw_car(player.position[0], player.position[1], player.position[2], player.rotation, (0.9, 0.1, 0.1))
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == K_ESCAPE):
+                running = False
+            if event.type == pygame.KEYDOWN:
+                jump = {K_LEFT: -5 * SIM_RATE, K_RIGHT: 5 * SIM_RATE, K_HOME: -step}.get(event.key)
+                if jump is not None:
+                    step = reader.seek(step + jump, game_state, player, fleet, track, simulate)
+                    sim_accumulator = 0.0
+                if event.key == K_SPACE:
+                    paused = not paused
         
-        # Render the AI cars
-        for car in ai_cars:
-            draw_car(car.position[0], car.position[1], car.position[2], car.rotation, car.color)
+        # Play the recorded steps at the speed they were recorded
+        if not paused:
+            sim_accumulator += frame_time
+        while sim_accumulator >= SIM_DT and step < reader.steps:
+            simulate(reader.inputs(step))
+            step += 1
+            sim_accumulator -= SIM_DT
         
-        # Update the screen
-        screen = pygame.display.get_surface()
-        render_hud(game_state, player)
+        glViewport(0, 0, WIDTH, HEIGHT)
+        render_scene(game_state, player, fleet, track, min(sim_accumulator / SIM_DT, 1.0))
+        begin_overlay()
+        status = "PAUSED" if paused else "REPLAY"
+        draw_text(20, 20, f"{status} {format_time(step / SIM_RATE)} / {format_time(reader.duration)}", hud_font,
+                  (255, 255, 0))
+        end_overlay()
         pygame.display.flip()
-        
-        # Cap the frame rate
-        clock.tick(60)
+        clock.tick(MAX_RENDER_FPS)
     
-    # Quit pygame
+    reader.close()
     pygame.quit()
     sys.exit()
 
 if __name__ == "__main__":
-    main()
+    import argparse
+    parser = argparse.ArgumentParser(description="Python Racing USA")
+    parser.add_argument("--record", metavar="PATH", help="record the session to a replay file")
+    parser.add_argument("--replay", metavar="PATH", help="watch a recorded replay")
+    parser.add_argument("--track", metavar="PATH", help="race on a track file instead of the oval")
+    parser.add_argument("--ai", type=int, default=len(CAR_COLORS), metavar="N", help="number of AI cars to race")
+    parser.add_argument("--ai-planner", action="store_true", help="plan the AI cars' driving in a separate process")
+    args = parser.parse_args()
+    if args.ai_planner and args.record:
+        parser.error("--ai-planner can't be recorded: planned AI depends on timing, so replays wouldn't match")
+    if args.replay:
+        play_replay(args.replay, args.track)
+    else:
+        main(args.record, args.track, args.ai, args.ai_planner)
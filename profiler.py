@@ -0,0 +1,149 @@
+"""
+Per-stage frame profiler.
+
+Stages of a frame are timed with perf_counter by wrapping them in `with PROFILER.stage(name):`.
+The last few hundred frames are kept in a ring buffer, giving rolling min/avg/p99 times per stage
+and a Chrome trace (chrome://tracing or https://ui.perfetto.dev) of recent frames on demand.
+
+The profiler is off until enabled, so code run headless pays only for the check.
+"""
+import json
+import time
+import numpy as np
+
+class _NullStage:
+    # Stands in for a stage while profiling is off
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+class _Stage:
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.depth += 1
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter()
+        profiler = self.profiler
+        profiler.depth -= 1
+        profiler.events.append((self.name, self.start, end - self.start, profiler.depth))
+        return False
+
+class Profiler:
+    """
+    Times named stages of each frame. Stages may nest and may run several times a frame
+    (like the fixed simulation steps); their times are summed per frame for the statistics.
+    """
+    def __init__(self, capacity=600):
+        self.capacity = capacity  # Frames kept for statistics and traces
+        self.enabled = False
+        self.frame_count = 0  # Frames completed since the profiler was created
+        self.frame_start = None
+        self.depth = 0
+        self.events = []  # (name, start, duration, depth) for the frame in progress
+        self.frames = [None] * capacity  # Ring of (start, duration, events) per completed frame
+        self.totals = {}  # Stage name -> ring of seconds per frame, NaN where the stage did not run
+
+    def stage(self, name):
+        # Context manager timing one stage of the current frame
+        if not self.enabled or self.frame_start is None:
+            return _NULL_STAGE
+        return _Stage(self, name)
+
+    def begin_frame(self):
+        if self.enabled:
+            self.events = []
+            self.depth = 0
+            self.frame_start = time.perf_counter()
+
+    def end_frame(self):
+        if self.frame_start is None:
+            return
+        end = time.perf_counter()
+        slot = self.frame_count % self.capacity
+        self.frames[slot] = (self.frame_start, end - self.frame_start, self.events)
+
+        stage_totals = {"frame": end - self.frame_start}
+        for name, _, duration, _ in self.events:
+            stage_totals[name] = stage_totals.get(name, 0.0) + duration
+        for name in self.totals.keys() - stage_totals.keys():
+            self.totals[name][slot] = np.nan
+        for name, total in stage_totals.items():
+            if name not in self.totals:
+                self.totals[name] = np.full(self.capacity, np.nan)
+            self.totals[name][slot] = total
+
+        self.frame_count += 1
+        self.frame_start = None
+
+    def clear(self, capacity=None):
+        # Forget every recorded frame, optionally keeping a different number from now on
+        self.capacity = capacity or self.capacity
+        self.frame_count = 0
+        self.frame_start = None
+        self.frames = [None] * self.capacity
+        self.totals = {}
+
+    def set_enabled(self, enabled):
+        # Turning the profiler off drops the frame in progress but keeps the history
+        self.enabled = enabled
+        if not enabled:
+            self.frame_start = None
+
+    def stats(self):
+        """
+        Rolling statistics over the frames kept, as {stage: (min, avg, p99)} in seconds,
+        in the order stages first ran.
+        """
+        stats = {}
+        for name, totals in self.totals.items():
+            samples = totals[~np.isnan(totals)]
+            if len(samples):
+                stats[name] = (float(samples.min()), float(samples.mean()), float(np.percentile(samples, 99)))
+        return stats
+
+    def recent_frames(self, count=None):
+        # Completed frames, oldest first, as (start, duration, events)
+        kept = min(self.frame_count, self.capacity)
+        if count is not None:
+            kept = min(kept, count)
+        first = self.frame_count - kept
+        return [self.frames[i % self.capacity] for i in range(first, self.frame_count)]
+
+    def trace_events(self, count=None):
+        """The last count frames (all kept frames by default) as Chrome trace events."""
+        frames = self.recent_frames(count)
+        if not frames:
+            return []
+        origin = frames[0][0]
+
+        def complete_event(name, start, duration):
+            return {"name": name, "ph": "X", "pid": 0, "tid": 0,
+                    "ts": (start - origin) * 1e6, "dur": duration * 1e6}
+
+        events = []
+        for start, duration, stages in frames:
+            events.append(complete_event("frame", start, duration))
+            events.extend(complete_event(name, stage_start, stage_duration)
+                          for name, stage_start, stage_duration, _ in stages)
+        return events
+
+    def dump_trace(self, path, count=None):
+        # Write a Chrome trace JSON file of the last count frames
+        with open(path, "w") as trace_file:
+            json.dump({"traceEvents": self.trace_events(count), "displayTimeUnit": "ms"}, trace_file)
+        return path
+
+# The profiler the game is instrumented with
+PROFILER = Profiler()
@@ -0,0 +1,143 @@
+"""
+Race farm: runs many independent headless races across a process pool and writes one summary.
+
+Each race is a job with its own seed, track and AI parameter set. Every job seeds its own random
+generators, so results depend only on the job and not on which worker ran it:
+
+    python race_farm.py --seeds 0-199 --param steering_gain=1.5,2.0,2.5 --out summary.json
+    python race_farm.py --seeds 0-99 --track tracks/example.track --track oval
+"""
+import argparse
+import itertools
+import json
+import os
+import statistics
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from headless import run_race
+import trackfile
+
+OVAL = "oval"  # --track name of the built-in oval
+
+_track_data = {}  # Tracks loaded in this worker process, by path
+
+def parse_seeds(text):
+    # "0-99" or "1,5,9"
+    if "-" in text:
+        first, last = text.split("-", 1)
+        return list(range(int(first), int(last) + 1))
+    return [int(seed) for seed in text.split(",")]
+
+def parse_param(text):
+    # "name=v1,v2,v3" -> (name, [v1, v2, v3])
+    name, values = text.split("=", 1)
+    return name, [float(value) for value in values.split(",")]
+
+def build_jobs(seeds, param_grid=None, tracks=None, **race_options):
+    """
+    One job per seed and track for every combination of the AI parameter values in param_grid,
+    a dict of name -> list of values. tracks are track file paths, None or OVAL for the built-in
+    oval (the default). race_options are passed through to run_race.
+    """
+    param_grid = param_grid or {}
+    names = sorted(param_grid)
+    jobs = []
+    for track in tracks or [None]:
+        for values in itertools.product(*(param_grid[name] for name in names)):
+            for seed in seeds:
+                jobs.append(dict(race_options, seed=seed, track=track, ai_params=dict(zip(names, values))))
+    return jobs
+
+def load_track_data(path):
+    # Jobs carry track paths rather than TrackData, whose memory-mapped arrays can't be pickled to
+    # workers; each worker loads a track once, from the compiled cache after the first time
+    if path is None or path == OVAL:
+        return None
+    if path not in _track_data:
+        _track_data[path] = trackfile.load_track(path)
+    return _track_data[path]
+
+def run_job(job):
+    # Runs in a worker process; failures are reported instead of stopping the farm
+    job = dict(job)
+    track = job.pop("track", None)
+    try:
+        return dict(run_race(track_data=load_track_data(track), **job), track=track)
+    except Exception:
+        return {"seed": job.get("seed"), "track": track, "ai_params": job.get("ai_params", {}),
+                "error": traceback.format_exc()}
+
+def run_farm(jobs, workers=None):
+    workers = workers or os.cpu_count()
+    if workers == 1:
+        return [run_job(job) for job in jobs]
+    
+    # Races take about the same time, so hand them out in chunks to cut scheduling overhead
+    chunksize = max(1, len(jobs) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(run_job, jobs, chunksize=chunksize))
+
+def summarize(results):
+    """Aggregate race results per track and AI parameter set."""
+    groups = {}
+    for result in results:
+        key = (result.get("track"), json.dumps(result.get("ai_params", {}), sort_keys=True))
+        groups.setdefault(key, []).append(result)
+    
+    summary = []
+    for (track, params), group in groups.items():
+        completed = [r for r in group if "error" not in r]
+        best_laps = [r["best_lap"] for r in completed if r["best_lap"] is not None]
+        # The AI side, which is what the tuning values change
+        ai_cars = [car for r in completed for car in r["finishing_order"] if car != "player"]
+        ai_finish_times = [time for r in completed for car, time in r["finish_times"].items() if car != "player"]
+        ai_gaps = [gap for r in completed for car, gap in r["gaps_to_leader"].items() if car != "player"]
+        summary.append({
+            "track": track,
+            "ai_params": json.loads(params),
+            "races": len(group),
+            "errors": len(group) - len(completed),
+            "finished": sum(r["finished"] for r in completed),
+            "mean_race_time": statistics.fmean(r["race_time"] for r in completed) if completed else None,
+            "mean_best_lap": statistics.fmean(best_laps) if best_laps else None,
+            "min_best_lap": min(best_laps) if best_laps else None,
+            "mean_player_position": statistics.fmean(r["player_position"] for r in completed) if completed else None,
+            "mean_collisions": statistics.fmean(r["collisions"] for r in completed) if completed else None,
+            "ai_finish_rate": len(ai_finish_times) / len(ai_cars) if ai_cars else None,
+            "mean_ai_finish_time": statistics.fmean(ai_finish_times) if ai_finish_times else None,
+            "mean_ai_gap_to_leader": statistics.fmean(ai_gaps) if ai_gaps else None,
+            "mean_car_contacts": statistics.fmean(r["car_contacts"] for r in completed) if completed else None,
+        })
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description="Run headless races in parallel and summarize them.")
+    parser.add_argument("--seeds", default="0-99", help='seed range "first-last" or list "1,2,3"')
+    parser.add_argument("--param", action="append", default=[], metavar="NAME=V1,V2",
+                        help="AI parameter values to sweep, may be repeated")
+    parser.add_argument("--track", action="append", default=[], metavar="PATH",
+                        help=f'track file to race on, may be repeated ("{OVAL}" for the built-in oval, the default)')
+    parser.add_argument("--laps", type=int, default=3)
+    parser.add_argument("--ai", type=int, default=7, help="number of AI cars")
+    parser.add_argument("--time-limit", type=float, default=600.0)
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, default one per core")
+    parser.add_argument("--out", default="race_farm_summary.json")
+    args = parser.parse_args()
+    
+    # Compile any uncompiled tracks once here, instead of in every worker at the same time
+    for path in args.track:
+        load_track_data(path)
+    jobs = build_jobs(parse_seeds(args.seeds), dict(parse_param(p) for p in args.param), args.track,
+                      total_laps=args.laps, num_ai=args.ai, time_limit=args.time_limit)
+    start = time.perf_counter()
+    results = run_farm(jobs, args.workers)
+    elapsed = time.perf_counter() - start
+    
+    with open(args.out, "w") as f:
+        json.dump({"jobs": len(jobs), "elapsed": elapsed, "summary": summarize(results), "results": results}, f, indent=1)
+    print(f"{len(jobs)} races in {elapsed:.1f}s, summary written to {args.out}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+Racing lines.
+
+A racing line is the path an AI driver takes around a track: an offset from the centerline at
+every track point, chosen to straighten the corners out as far as the road allows, and the
+fastest speed at every point of that path. Both are worked out once per track shape:
+
+- the offsets are relaxed toward where each point's neighbours on the line would put it if the
+  line didn't bend there, first with neighbours far apart and then closer, which irons out
+  curvature from whole corners down to single segments, and are kept within the road edges
+- the speed at each point is the most the grip allows around the line's curvature near it, then
+  lowered wherever a car couldn't brake down to the next corner's speed in time, or accelerate
+  up to it from the last one
+
+Optimizing takes a moment on long tracks, so lines are cached on disk keyed by a hash of the
+track geometry and the settings; after the first time a line just loads. Speeds are in the
+cars' units, world units per 1/60 s, and accelerations per 1/60 s squared.
+
+    python racing_line.py tracks/example.track
+"""
+import argparse
+import hashlib
+import os
+import tempfile
+import numpy as np
+
+import trackfile
+
+VERSION = 1  # Part of the cache key; bump when the optimizer changes
+EDGE_MARGIN = 2.5  # The line keeps a car this far inside the road edges
+RELAXATION = 0.5  # Fraction of the way to its unbent position a line point moves per iteration
+ITERATIONS = 100  # Iterations at each stride
+TOP_SPEED = 0.7  # Fastest speed on a straight, like the fastest AI cruise speed
+GRIP = 0.006  # Sideways acceleration a car can hold in a corner
+ACCELERATION = 0.01  # Speed gained per 1/60 s, like AIFleet.acceleration
+BRAKING = 0.02  # Speed lost per 1/60 s when braking, like AIFleet.braking
+CURVATURE_WINDOW = 4.0  # Length of road the curvature for the speed profile is averaged over
+LOOKAHEAD = 8.0  # Distance along the track to the point a car on the line steers at
+
+def default_cache_dir():
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), "track_cache")
+
+def geometry_hash(points, half_widths, **settings):
+    # Identifies a racing line: the track shape, the optimizer version and the settings it ran with
+    digest = hashlib.sha256(f"{VERSION}\n{sorted(settings.items())}\n".encode())
+    digest.update(np.ascontiguousarray(points, dtype=np.float64).tobytes())
+    digest.update(np.ascontiguousarray(half_widths, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+def optimize_offsets(points, normals, half_widths, margin=EDGE_MARGIN, iterations=ITERATIONS):
+    """
+    Offsets from the centerline along the normals that bend the line through points as little as
+    the road allows: each iteration moves every line point toward where its four nearest neighbours
+    would put it if the line had no bend there, then back inside the road. Working on every
+    stride-th point first and interpolating down to every point settles whole corners quickly.
+    """
+    ground = np.asarray(points, dtype=np.float64)[:, [0, 2]]
+    across = np.asarray(normals, dtype=np.float64)[:, [0, 2]]
+    limit = np.maximum(np.asarray(half_widths, dtype=np.float64) - margin, 0.0)
+    num_points = len(ground)
+    every = np.arange(num_points)
+    offsets = np.zeros(num_points)
+    stride = 1 << max(int(np.log2(max(num_points // 8, 1))), 0)
+    while stride >= 1:
+        idx = every[::stride]
+        level_ground, level_across, level_limit = ground[idx], across[idx], limit[idx]
+        level_offsets = offsets[idx]
+        for _ in range(iterations):
+            line = level_ground + level_across * level_offsets[:, np.newaxis]
+            straight = (4 * (np.roll(line, 1, axis=0) + np.roll(line, -1, axis=0)) -
+                        np.roll(line, 2, axis=0) - np.roll(line, -2, axis=0)) / 6
+            level_offsets += np.sum((straight - line) * level_across, axis=1) * RELAXATION
+            np.clip(level_offsets, -level_limit, level_limit, out=level_offsets)
+        offsets = np.interp(every, idx, level_offsets, period=num_points)
+        stride //= 2
+    return np.clip(offsets, -limit, limit)
+
+def speed_profile(curvature, segment_lengths, top_speed=TOP_SPEED, grip=GRIP, acceleration=ACCELERATION,
+                  braking=BRAKING):
+    """
+    Fastest speed at every point of a closed path with the given curvature and segment lengths,
+    for a car that holds grip sideways and gains or loses speed at the given rates.
+    """
+    num_points = len(curvature)
+    segment_lengths = np.asarray(segment_lengths, dtype=np.float64)
+    length = float(segment_lengths.sum())
+
+    # The curvature a car feels is the turn over a stretch of road, not at one sampled point
+    turn = np.asarray(curvature, dtype=np.float64) * (segment_lengths + np.roll(segment_lengths, 1)) / 2
+    window = min(CURVATURE_WINDOW, length / 2)
+    distance = np.concatenate([[0.0], np.cumsum(np.tile(segment_lengths, 3))])[:-1] - length
+    total_turn = np.concatenate([[0.0], np.cumsum(np.tile(turn, 3))])
+    centers = distance[num_points:2 * num_points]
+    first = np.searchsorted(distance, centers - window / 2)
+    last = np.searchsorted(distance, centers + window / 2, side="right")
+    curvature = np.abs(total_turn[last] - total_turn[first]) / window
+    squared = np.minimum(grip / np.maximum(curvature, 1e-9), top_speed ** 2)
+
+    # Distance to every point over two laps, so each pass sees around the start/finish line.
+    # Braking: v_i^2 <= v_j^2 + 2 b (d_j - d_i) for every j ahead, a running minimum from the end.
+    distance = distance[num_points:] - distance[num_points]
+    laps = np.tile(squared, 2)
+    braked = np.minimum.accumulate((laps + 2 * braking * distance)[::-1])[::-1] - 2 * braking * distance
+    # Accelerating: v_i^2 <= v_j^2 + 2 a (d_i - d_j) for every j behind, a running minimum from the start
+    laps = np.tile(braked[:num_points], 2)
+    accelerated = np.minimum.accumulate(laps - 2 * acceleration * distance) + 2 * acceleration * distance
+    return np.sqrt(np.maximum(accelerated[num_points:], 0.0))
+
+class RacingLine:
+    """
+    The racing line of a track: offsets from the centerline, the line's points and the speed at
+    each track point, and for each point the point LOOKAHEAD ahead of it to steer at.
+    """
+    def __init__(self, track, offsets, speeds, key=""):
+        self.offsets = np.asarray(offsets, dtype=np.float64)
+        self.speeds = np.asarray(speeds, dtype=np.float64)
+        self.key = key
+        self.points = np.asarray(track.point_array, dtype=np.float64) + track.normals * self.offsets[:, np.newaxis]
+        starts = track.arc_length[:-1]
+        ahead = np.concatenate([starts, starts + track.length])
+        self.aim_index = np.searchsorted(ahead, starts + LOOKAHEAD) % len(starts)
+
+def build_racing_line(track, key=""):
+    """Optimize the racing line of a track (a Track, or anything with its geometry table)."""
+    offsets = optimize_offsets(track.point_array, track.normals, track.half_widths)
+    line_points = np.asarray(track.point_array, dtype=np.float64) + track.normals * offsets[:, np.newaxis]
+    geometry = trackfile.segment_geometry(line_points, track.half_widths)
+    speeds = speed_profile(geometry["curvature"], geometry["segment_lengths"])
+    return RacingLine(track, offsets, speeds, key)
+
+def load_racing_line(track, cache_dir=None):
+    """The racing line of a track from the cache, optimizing and caching it the first time."""
+    key = geometry_hash(track.point_array, track.half_widths, edge_margin=EDGE_MARGIN, relaxation=RELAXATION,
+                        iterations=ITERATIONS, top_speed=TOP_SPEED, grip=GRIP, acceleration=ACCELERATION,
+                        braking=BRAKING, curvature_window=CURVATURE_WINDOW)
+    cache_dir = cache_dir or default_cache_dir()
+    path = os.path.join(cache_dir, key + ".line.npz")
+    try:
+        with np.load(path) as cached:
+            if len(cached["offsets"]) == len(track.point_array):
+                return RacingLine(track, cached["offsets"], cached["speeds"], key)
+    except (OSError, KeyError, ValueError):
+        pass  # Not cached yet, or unreadable; build it again
+
+    line = build_racing_line(track, key)
+    try:
+        # Written to a temporary file and moved into place, so parallel races never read half a file
+        os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile("wb", dir=cache_dir, suffix=".npz", delete=False) as line_file:
+            np.savez(line_file, offsets=line.offsets, speeds=line.speeds)
+        trackfile.publish_file(line_file.name, path)
+    except OSError:
+        pass  # A read-only install still races, it just optimizes every time
+    return line
+
+def main():
+    import time
+    from main import Track  # Only the command line needs the game's Track
+
+    parser = argparse.ArgumentParser(description="Optimize and cache the racing line of tracks.")
+    parser.add_argument("tracks", nargs="*", help="track files or descriptions (the built-in oval if none)")
+    args = parser.parse_args()
+    for path in args.tracks or [None]:
+        track = Track(num_trees=0, data=trackfile.load_track(path) if path else None)
+        start = time.perf_counter()
+        line = load_racing_line(track)
+        print(f"{track.name}: {len(line.offsets)} points, offsets {line.offsets.min():.1f} to {line.offsets.max():.1f}, "
+              f"speeds {line.speeds.min():.2f} to {line.speeds.max():.2f}, "
+              f"{(time.perf_counter() - start) * 1000:.0f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+"""
+Compact binary race replays.
+
+A replay stores the seed the world was built from, the driver inputs of every simulation
+step (a 16-bit mask per step) and, every keyframe_interval steps, a keyframe with the full
+state of the race and every car. The file is a fixed-size header followed by fixed-size
+blocks of one keyframe and the inputs of the steps after it, so the offset of any step
+can be computed directly:
+
+    header | keyframe 0, inputs 0..K-1 | keyframe K, inputs K..2K-1 | ...
+
+ReplayWriter streams blocks to disk from a background thread, holding at most a few
+blocks in memory. ReplayReader memory-maps the file, so opening, seeking and scrubbing
+cost the same for a minute-long replay as for an hour-long one.
+
+Keyframes store the state as attributes of the game state, player car, AI fleet and track, so
+this module doesn't depend on the game itself; stepping the simulation is left to the caller.
+The ghost lap is too big to keep in every keyframe, so restoring one starts the ghost afresh.
+"""
+import mmap
+import queue
+import struct
+import threading
+import numpy as np
+
+MAGIC = b"RACEREPL"
+VERSION = 6  # Bumped whenever the format or the simulation changes, so old replays are refused rather than desync
+
+# Header: magic, version, keyframe interval, simulation rate, AI cars, seed, total steps (0 while recording)
+# and the track's fingerprint (trackfile.track_hash)
+HEADER = struct.Struct("<8sHHHIQQ8s")
+
+GAME_FIELDS = [
+    ("game_started", "?"), ("game_over", "?"), ("countdown_active", "?"), ("countdown_value", "<i4"),
+    ("laps", "<i4"), ("total_laps", "<i4"), ("race_position", "<i4"),
+    ("race_clock", "<f8"), ("lap_start_time", "<f8"), ("total_time", "<f8"), ("best_lap", "<f8"),
+    ("collisions", "<i8"), ("car_contacts", "<i8"),
+]
+PLAYER_FIELDS = [
+    ("position", "<f8", (3,)), ("rotation", "<f8"), ("speed", "<f8"), ("gear", "<i4"), ("laps", "<i4"),
+    ("last_checkpoint", "<i4"), ("progress", "<f8"), ("nearest_idx", "<i4"), ("shift_up_held", "?"), ("shift_down_held", "?"),
+]
+FLEET_FIELDS = [
+    ("position", "<f8", (3,)), ("rotation", "<f8"), ("speed", "<f8"), ("target_speed", "<f8"),
+    ("cruise_speed", "<f8"), ("laps", "<i8"), ("checkpoint", "<i8"), ("progress", "<f8"),
+    ("nearest_idx", "<i8"),
+]
+
+def keyframe_dtype(num_ai):
+    # Everything needed to resume the simulation exactly, including the AI random generator
+    return np.dtype([
+        ("step", "<u8"),
+        ("game", GAME_FIELDS),
+        ("player", PLAYER_FIELDS),
+        ("fleet", FLEET_FIELDS, (num_ai,)),
+        ("standings", "<i8", (num_ai + 1,)),  # Running order of the player and the AI cars, -1 before the first
+        ("standings_progress", "<f8", (num_ai + 1,)),  # and the progress it was built from
+        ("tree_generation", "<i4"),  # Track.tree_generation, which also fixes the scenery random state
+        ("rng_state", "<u8", (4,)),  # PCG64 state and increment, as 64-bit halves
+        ("rng_cached", "<u4", (2,)),  # has_uint32 and uinteger
+    ])
+
+def block_dtype(num_ai, keyframe_interval):
+    return np.dtype([("keyframe", keyframe_dtype(num_ai)), ("inputs", "<u2", (keyframe_interval,))])
+
+def pack_rng(rng, keyframe):
+    state = rng.bit_generator.state
+    if state["bit_generator"] != "PCG64":
+        raise ValueError(f"Replays need a PCG64 generator, not {state['bit_generator']}")
+    mask = (1 << 64) - 1
+    value, increment = state["state"]["state"], state["state"]["inc"]
+    keyframe["rng_state"] = (value & mask, value >> 64, increment & mask, increment >> 64)
+    keyframe["rng_cached"] = (state["has_uint32"], state["uinteger"])
+
+def unpack_rng(keyframe, rng):
+    low, high, increment_low, increment_high = (int(part) for part in keyframe["rng_state"])
+    has_uint32, uinteger = (int(part) for part in keyframe["rng_cached"])
+    rng.bit_generator.state = {
+        "bit_generator": "PCG64",
+        "state": {"state": low | high << 64, "inc": increment_low | increment_high << 64},
+        "has_uint32": has_uint32,
+        "uinteger": uinteger,
+    }
+
+def capture_keyframe(keyframe, step, game_state, player, fleet, track):
+    """Copy the race state into a keyframe record."""
+    keyframe["step"] = step
+    game = keyframe["game"]
+    for name, *_ in GAME_FIELDS:
+        game[name] = getattr(game_state, name)
+    car = keyframe["player"]
+    for name, *_ in PLAYER_FIELDS:
+        value = getattr(player, name)
+        car[name] = -1 if value is None else value
+    cars = keyframe["fleet"]
+    for name, *_ in FLEET_FIELDS:
+        cars[name] = getattr(fleet, name)
+    standings = game_state.standings
+    if len(standings.order) == len(keyframe["standings"]):
+        keyframe["standings"] = standings.order
+        keyframe["standings_progress"] = standings.progress
+    else:
+        keyframe["standings"] = -1
+    keyframe["tree_generation"] = track.tree_generation
+    pack_rng(fleet.rng, keyframe)
+
+def restore_keyframe(keyframe, game_state, player, fleet, track):
+    """Put the race back into the state stored in a keyframe."""
+    game = keyframe["game"]
+    for name, *_ in GAME_FIELDS:
+        setattr(game_state, name, game[name].item())
+    car = keyframe["player"]
+    for name, *_ in PLAYER_FIELDS:
+        setattr(player, name, car[name].tolist())
+    if player.nearest_idx < 0:
+        player.nearest_idx = None
+    cars = keyframe["fleet"]
+    for name, *_ in FLEET_FIELDS:
+        getattr(fleet, name)[:] = cars[name]
+    unpack_rng(keyframe, fleet.rng)
+    if keyframe["standings"][0] < 0:
+        game_state.standings.reset()
+    else:
+        game_state.standings.restore(keyframe["standings"], keyframe["standings_progress"])
+    game_state.ghost.discard()
+    track.restore_trees(int(keyframe["tree_generation"]))
+    player.save_previous_state()
+    fleet.save_previous_state()
+
+class ReplayWriter:
+    """
+    Records a race one simulation step at a time. Blocks are filled in preallocated buffers
+    and written by a background thread; recording only waits for the disk when more than
+    max_pending blocks are queued.
+    """
+    def __init__(self, path, seed, num_ai, keyframe_interval=120, sim_rate=120, max_pending=16, track_hash=bytes(8)):
+        self.path = path
+        self.seed = seed
+        self.num_ai = num_ai
+        self.keyframe_interval = keyframe_interval
+        self.sim_rate = sim_rate
+        self.track_hash = track_hash
+        self.steps = 0
+        self.file = open(path, "wb")
+        self.file.write(HEADER.pack(MAGIC, VERSION, keyframe_interval, sim_rate, num_ai, seed, 0, track_hash))
+
+        # Filled blocks go to the writer thread, and come back through free_blocks once written
+        dtype = block_dtype(num_ai, keyframe_interval)
+        self.free_blocks = queue.Queue()
+        for _ in range(max_pending + 1):
+            self.free_blocks.put(np.zeros(1, dtype=dtype))
+        self.pending = queue.Queue()
+        self.block = None
+        self.error = None
+        self.thread = threading.Thread(target=self._write_blocks, name="replay-writer", daemon=True)
+        self.thread.start()
+
+    def record(self, inputs, game_state, player, fleet, track):
+        """
+        Record one simulation step: the state before the step (kept when a keyframe is due)
+        and the input mask the step is about to run with.
+        """
+        if self.error is not None:
+            raise self.error
+        slot = self.steps % self.keyframe_interval
+        if slot == 0:
+            self.block = self.free_blocks.get()
+            capture_keyframe(self.block[0]["keyframe"], self.steps, game_state, player, fleet, track)
+        self.block[0]["inputs"][slot] = inputs
+        self.steps += 1
+        if slot == self.keyframe_interval - 1:
+            self.pending.put(self.block)
+            self.block = None
+
+    def close(self):
+        """Flush the last block, wait for the writer thread and store the step count in the header."""
+        if self.block is not None:
+            # Steps past the end of the recording are left as zero inputs
+            self.block[0]["inputs"][self.steps % self.keyframe_interval:] = 0
+            self.pending.put(self.block)
+            self.block = None
+        self.pending.put(None)
+        self.thread.join()
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, VERSION, self.keyframe_interval, self.sim_rate, self.num_ai,
+                                    self.seed, self.steps, self.track_hash))
+        self.file.close()
+        if self.error is not None:
+            raise self.error
+
+    def _write_blocks(self):
+        while True:
+            block = self.pending.get()
+            if block is None:
+                return
+            try:
+                self.file.write(block.tobytes())
+            except Exception as error:
+                self.error = error  # Raised by the next record() or close()
+            finally:
+                self.free_blocks.put(block)  # Always given back, or record() would wait for it forever
+
+class ReplayReader:
+    """
+    A memory-mapped replay file. Blocks are numpy views straight onto the file, so nothing is
+    read until it is used. A replay that was never closed is read up to its last whole block.
+    """
+    def __init__(self, path):
+        with open(path, "rb") as replay_file:
+            self.mmap = mmap.mmap(replay_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.mmap) < HEADER.size:
+            self.mmap.close()
+            raise ValueError(f"{path} is not a replay")
+        magic, version, self.keyframe_interval, self.sim_rate, self.num_ai, self.seed, steps, self.track_hash = \
+            HEADER.unpack_from(self.mmap)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} replay")
+        dtype = block_dtype(self.num_ai, self.keyframe_interval)
+        num_blocks = (len(self.mmap) - HEADER.size) // dtype.itemsize
+        self.blocks = np.frombuffer(self.mmap, dtype=dtype, count=num_blocks, offset=HEADER.size)
+        self.steps = steps or num_blocks * self.keyframe_interval
+        if self.steps == 0:
+            self.close()
+            raise ValueError(f"{path} holds no steps: the race was quit before it began")
+        self.duration = self.steps / self.sim_rate
+
+    def close(self):
+        self.blocks = None
+        self.mmap.close()
+
+    def inputs(self, step):
+        # The input mask recorded for a step
+        return int(self.blocks[step // self.keyframe_interval]["inputs"][step % self.keyframe_interval])
+
+    def keyframe(self, step):
+        # The last keyframe at or before a step
+        return self.blocks[step // self.keyframe_interval]["keyframe"]
+
+    def seek(self, step, game_state, player, fleet, track, simulate):
+        """
+        Put the race into its exact state before the given step: restore the keyframe before it,
+        then replay the steps in between by calling simulate(inputs) for each.
+        """
+        step = max(0, min(step, self.steps - 1))
+        keyframe = self.keyframe(step)
+        restore_keyframe(keyframe, game_state, player, fleet, track)
+        for replayed in range(int(keyframe["step"]), step):
+            simulate(self.inputs(replayed))
+        return step
+
+    def car_states(self, time):
+        """
+        Approximate positions and rotations of every car (player first) at a time in seconds,
+        blended between the keyframes around it, without simulating. For quick scrubbing.
+        """
+        position = max(0.0, min(time * self.sim_rate / self.keyframe_interval, len(self.blocks) - 1))
+        first = int(position)
+        second = min(first + 1, len(self.blocks) - 1)
+        alpha = position - first
+
+        def cars(index):
+            keyframe = self.blocks[index]["keyframe"]
+            positions = np.vstack([keyframe["player"]["position"], keyframe["fleet"]["position"]])
+            rotations = np.concatenate([[keyframe["player"]["rotation"]], keyframe["fleet"]["rotation"]])
+            return positions, rotations
+
+        (positions0, rotations0), (positions1, rotations1) = cars(first), cars(second)
+        return positions0 + (positions1 - positions0) * alpha, rotations0 + (rotations1 - rotations0) * alpha
@@ -0,0 +1,904 @@
+"""
+Multiplayer races over UDP.
+
+The server owns the race: it runs the same fixed-step simulation as the game (Track, the
+player cars and the AI fleet from main.py) at SIM_RATE ticks a second, for up to 32 players
+plus the AI cars, and nothing a client sends can do more than steer its own car.
+
+    python server.py serve --port 47800 --ai 7
+    python server.py join localhost:47800
+    python server.py loopback --clients 32 --seconds 20
+
+Every datagram starts with a message type byte:
+
+    JOIN      client -> server  asks for a slot
+    WELCOME   server -> client  slot, race settings, world seed and track hash
+    REJECT    server -> client  server full or protocol mismatch
+    INPUT     client -> server  newest input sequence number, the last few control masks
+                                (so a lost packet costs nothing) and the newest snapshot it has
+    SNAPSHOT  server -> client  race phase and clock, the client's own car at full precision
+                                and every car quantized, as a delta against the snapshot the
+                                client acknowledged last
+    LEAVE     client -> server  frees the slot
+
+Snapshots go out every SNAPSHOT_INTERVAL ticks. Car state is quantized to integers (position
+to 1/64 of a unit, heading to 1/65536 of a turn, race progress to 1/16 of a unit) and only the
+fields that changed since the baseline are sent, each column with the narrowest integer type
+that holds its deltas, so a field of 40 cars costs a few hundred bytes. Each client also has
+a bandwidth budget; when it runs out snapshots are skipped and the next one simply deltas
+against an older baseline.
+
+Clients predict their own car by running the player physics on their inputs as soon as they
+are made, and on every snapshot rewind to the server's state and replay the inputs it hasn't
+simulated yet. Everyone else is drawn INTERPOLATION_DELAY behind, between two snapshots.
+
+The loopback mode runs a server and a field of bot clients in one process over an in-memory
+network with latency, jitter and packet loss, and reports tick times and bandwidth.
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import struct
+import sys
+import time
+from collections import OrderedDict, deque
+import numpy as np
+
+import trackfile
+from headless import BotDriver
+from main import (AIFleet, Controls, GameState, PlayerCar, MAX_RENDER_FPS, MAX_SIM_STEPS_PER_FRAME,
+                  REFERENCE_FRAME_RATE, SIM_DT, SIM_RATE, Track, car_colors, end_race, follow_track,
+                  grid_positions, line_up, resolve_collisions, start_countdown, start_race, update_player)
+
+PROTOCOL_VERSION = 2
+DEFAULT_PORT = 47800
+MAX_CLIENTS = 32  # Player slots; the active ones travel as a 32-bit mask
+
+MSG_JOIN, MSG_WELCOME, MSG_REJECT, MSG_INPUT, MSG_SNAPSHOT, MSG_LEAVE = range(1, 7)
+REJECT_FULL, REJECT_VERSION = 1, 2
+
+# Message layouts, all little-endian and starting with the message type
+JOIN = struct.Struct("<BH")  # protocol version
+# slot, player slots, AI cars, laps, tick rate, ticks per snapshot, world seed, first 8 bytes of the track hash
+WELCOME = struct.Struct("<BBBHHHHI8s")
+REJECT = struct.Struct("<BB")  # reason
+INPUT = struct.Struct("<BIIB")  # acknowledged snapshot tick, newest input sequence number, masks that follow
+# tick, baseline tick, last input simulated for this client, phase, countdown, race clock, active slots, field widths
+SNAPSHOT = struct.Struct("<BIIIBBfIH")
+OWN_CAR = struct.Struct("<5dBBhI")  # x, y, z, rotation, speed, gear, shift keys held, laps, checkpoint
+LEAVE = struct.Struct("<B")
+NO_BASELINE = 0xFFFFFFFF  # Baseline tick of a full snapshot
+UDP_OVERHEAD = 28  # IPv4 and UDP headers, counted against the bandwidth budget
+
+# Race phases as sent in snapshots
+WAITING, COUNTDOWN, RACING, FINISHED = range(4)
+PHASE_NAMES = ("waiting", "countdown", "racing", "finished")
+
+SNAPSHOT_INTERVAL = 4  # Ticks between snapshots, 30 a second
+SNAPSHOT_HISTORY = 32  # Snapshots the server keeps as baselines, about a second
+CLIENT_BANDWIDTH = 16000  # Bytes per second the server may send one client
+INPUT_INTERVAL = 2  # Client steps between input packets
+INPUT_REDUNDANCY = 8  # Masks per input packet, so each input is sent four times
+INPUT_BUFFER = 8  # Inputs a client may be ahead of the server before the oldest are dropped
+CLIENT_TIMEOUT = 5.0  # Seconds of silence before a client loses its slot
+RESULTS_TIME = 10.0  # Seconds the results stand before the next race's countdown
+RACE_TIME_LIMIT = 600.0
+JOIN_RETRY = 0.5  # Seconds between join requests until the server answers
+INTERPOLATION_DELAY = 3 * SNAPSHOT_INTERVAL  # Ticks other cars are drawn behind the newest snapshot
+
+# Quantized car state, one int32 column per field
+X, Y, Z, ROTATION, PROGRESS = range(5)
+CAR_FIELDS = 5
+POSITION_SCALE = 64.0
+ROTATION_SCALE = 65536 / 360.0
+PROGRESS_SCALE = 16.0
+FIELD_DTYPES = (np.dtype("<i1"), np.dtype("<i2"), np.dtype("<i4"))
+FIELD_WIDTH_LIMITS = (127, 32767)  # Largest delta each of the first two types holds
+
+def quantize_cars(positions, rotations, progress):
+    state = np.empty((len(positions), CAR_FIELDS), dtype=np.int32)
+    state[:, X:Z + 1] = np.round(np.asarray(positions) * POSITION_SCALE)
+    state[:, ROTATION] = np.round(np.asarray(rotations) % 360 * ROTATION_SCALE).astype(np.int64) % 65536
+    state[:, PROGRESS] = np.round(np.asarray(progress) * PROGRESS_SCALE)
+    return state
+
+def encode_cars(state, baseline=None):
+    """
+    Encode quantized car state as a delta against baseline (a full snapshot when None):
+    a bit per car that changed, a field mask byte per changed car, then the changed deltas
+    field by field. Returns the field widths (2 bits per field) and the bytes.
+    """
+    delta = state - baseline if baseline is not None else state.copy()
+    delta[:, ROTATION] = (delta[:, ROTATION] + 32768) % 65536 - 32768  # Shortest way around
+    changed = delta != 0
+    moved = changed.any(axis=1)
+    parts = [np.packbits(moved, bitorder="little").tobytes(),
+             np.packbits(changed[moved], axis=1, bitorder="little").tobytes()]
+    widths = 0
+    for field in range(CAR_FIELDS):
+        values = delta[changed[:, field], field]
+        # -128 still fits an i1, so negative deltas are measured one smaller
+        largest = max(int(values.max()), -1 - int(values.min())) if len(values) else 0
+        width = int(np.searchsorted(FIELD_WIDTH_LIMITS, largest))
+        widths |= width << 2 * field
+        parts.append(values.astype(FIELD_DTYPES[width]).tobytes())
+    return widths, b"".join(parts)
+
+def decode_cars(data, widths, count, baseline=None):
+    """Rebuild quantized car state for count cars from encode_cars output and the same baseline."""
+    car_bytes = (count + 7) // 8
+    moved = np.unpackbits(np.frombuffer(data, np.uint8, car_bytes), count=count, bitorder="little").astype(bool)
+    offset = car_bytes
+    num_moved = int(np.count_nonzero(moved))
+    masks = np.frombuffer(data, np.uint8, num_moved, offset).reshape(-1, 1)
+    offset += num_moved
+    changed = np.zeros((count, CAR_FIELDS), dtype=bool)
+    changed[moved] = np.unpackbits(masks, axis=1, count=CAR_FIELDS, bitorder="little").astype(bool)
+
+    state = baseline.copy() if baseline is not None else np.zeros((count, CAR_FIELDS), dtype=np.int32)
+    for field in range(CAR_FIELDS):
+        dtype = FIELD_DTYPES[widths >> 2 * field & 3]
+        rows = changed[:, field]
+        num_values = int(np.count_nonzero(rows))
+        state[rows, field] += np.frombuffer(data, dtype, num_values, offset)
+        offset += num_values * dtype.itemsize
+    if offset != len(data):
+        raise ValueError("Malformed snapshot")
+    state[:, ROTATION] %= 65536
+    return state
+
+def grid_car(grid, slot):
+    # A fresh player car waiting on its grid slot
+    player = PlayerCar()
+    positions, headings, checkpoints = grid
+    line_up(player, positions[slot], headings[slot], checkpoints[slot])
+    return player
+
+class ClientSlot:
+    """The server's view of one connected client."""
+    def __init__(self, address, slot, tick):
+        self.address = address
+        self.slot = slot
+        self.inputs = deque()  # (sequence number, mask) received but not simulated yet, oldest first
+        self.next_seq = 1  # Sequence number of the next new input
+        self.processed_seq = 0  # Last input simulated, echoed in snapshots for reconciliation
+        self.last_mask = 0  # Held while inputs are late
+        self.acked_tick = NO_BASELINE  # Newest snapshot the client has
+        self.last_heard = tick
+        self.budget = CLIENT_BANDWIDTH * 0.25  # Bytes that may be sent right now
+        self.bytes_sent = 0
+        self.snapshots_sent = 0
+        self.snapshots_skipped = 0
+        self.late_inputs = 0  # Ticks simulated with a repeated input
+
+class RaceServer(asyncio.DatagramProtocol):
+    """
+    The authoritative race: player slots and the AI fleet stepped at SIM_RATE, inputs taken
+    from each client's queue and snapshots sent to every client within its bandwidth.
+    Races start with a countdown once someone joins and restart after the results.
+    """
+    def __init__(self, seed=0, num_ai=7, total_laps=3, max_clients=MAX_CLIENTS, track_data=None,
+                 bandwidth=CLIENT_BANDWIDTH, time_limit=RACE_TIME_LIMIT, verbose=True):
+        if not 1 <= max_clients <= MAX_CLIENTS:
+            raise ValueError(f"max_clients must be between 1 and {MAX_CLIENTS}")
+        self.seed = seed
+        self.max_clients = max_clients
+        self.track_hash = trackfile.track_hash(track_data)
+        self.bandwidth = bandwidth
+        self.time_limit = time_limit
+        self.verbose = verbose
+        self.track = Track(num_trees=0, rng=random.Random(seed), data=track_data)  # Scenery only matters when drawing
+        self.game_state = GameState()
+        self.game_state.total_laps = total_laps
+        self.fleet = AIFleet(np.zeros((num_ai, 3)), car_colors(num_ai), np.random.default_rng(seed))
+
+        # Players take the front of the grid, the AI cars line up behind
+        self.grid = grid_positions(self.track, max_clients + num_ai)
+        self.players = [grid_car(self.grid, slot) for slot in range(max_clients)]
+        self.clients = {}  # Address -> ClientSlot
+        self.slots = [None] * max_clients
+        self.transport = None
+        self.tick_count = 0
+        self.ticks_dropped = 0  # Ticks skipped because the server fell behind
+        self.history = OrderedDict()  # Snapshot tick -> quantized car state, kept as delta baselines
+        self.tick_times = deque(maxlen=SIM_RATE * 60)  # Seconds each recent tick took
+        self.reset_race()
+
+    def log(self, message):
+        if self.verbose:
+            print(message, flush=True)
+
+    # --- Networking ---
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        if not data:
+            return
+        client = self.clients.get(address)
+        try:
+            if data[0] == MSG_JOIN:
+                self.join(data, address)
+            elif client is None:
+                return
+            elif data[0] == MSG_INPUT:
+                self.receive_input(client, data)
+            elif data[0] == MSG_LEAVE:
+                self.drop(client, "left")
+        except (struct.error, ValueError):
+            pass  # Malformed datagrams are dropped like lost ones
+
+    def error_received(self, exc):
+        pass  # A client that went away without leaving times out
+
+    def join(self, data, address):
+        _, version = JOIN.unpack_from(data)
+        if version != PROTOCOL_VERSION:
+            self.transport.sendto(REJECT.pack(MSG_REJECT, REJECT_VERSION), address)
+            return
+        client = self.clients.get(address)
+        if client is None:
+            # A repeated join gets the same welcome again
+            if None not in self.slots:
+                self.transport.sendto(REJECT.pack(MSG_REJECT, REJECT_FULL), address)
+                return
+            client = ClientSlot(address, self.slots.index(None), self.tick_count)
+            self.clients[address] = client
+            self.slots[client.slot] = client
+            self.players[client.slot] = grid_car(self.grid, client.slot)
+            self.log(f"{address} joined in slot {client.slot} ({len(self.clients)} connected)")
+            if self.phase == WAITING:
+                self.set_phase(COUNTDOWN)
+        self.transport.sendto(WELCOME.pack(MSG_WELCOME, client.slot, self.max_clients, len(self.fleet),
+                                           self.game_state.total_laps, SIM_RATE, SNAPSHOT_INTERVAL,
+                                           self.seed, self.track_hash), address)
+
+    def receive_input(self, client, data):
+        _, acked_tick, newest, count = INPUT.unpack_from(data)
+        masks = struct.unpack_from(f"<{count}H", data, INPUT.size)
+        client.last_heard = self.tick_count
+        if acked_tick != NO_BASELINE and (client.acked_tick == NO_BASELINE or acked_tick > client.acked_tick):
+            client.acked_tick = acked_tick
+
+        # Queue the inputs not seen before; the packet repeats older ones in case some were lost
+        first = newest - count + 1
+        for seq in range(max(first, client.next_seq), newest + 1):
+            client.inputs.append((seq, masks[seq - first]))
+        client.next_seq = max(client.next_seq, newest + 1)
+        while len(client.inputs) > INPUT_BUFFER:
+            client.inputs.popleft()
+
+    def drop(self, client, reason):
+        del self.clients[client.address]
+        self.slots[client.slot] = None
+        self.players[client.slot] = grid_car(self.grid, client.slot)
+        self.finish_times.pop(client.slot, None)
+        self.log(f"{client.address} {reason} ({len(self.clients)} connected)")
+        if not self.clients:
+            self.reset_race()
+
+    def drop_silent_clients(self):
+        for client in list(self.clients.values()):
+            if self.tick_count - client.last_heard > CLIENT_TIMEOUT * SIM_RATE:
+                self.drop(client, "timed out")
+
+    # --- Race ---
+
+    def set_phase(self, phase):
+        self.phase = phase
+        self.phase_ticks = 0
+        if phase == COUNTDOWN:
+            start_countdown(self.game_state)
+        elif phase == RACING:
+            start_race(self.game_state)
+        elif phase == FINISHED:
+            end_race(self.game_state)
+
+    def reset_race(self):
+        # Everyone back to the grid; the countdown starts right away if anyone is connected
+        positions, headings, checkpoints = self.grid
+        for slot in range(self.max_clients):
+            self.players[slot] = grid_car(self.grid, slot)
+        self.fleet.reset(positions[self.max_clients:], headings[self.max_clients:], checkpoints[self.max_clients:])
+        game_state = self.game_state
+        game_state.game_started = False
+        game_state.game_over = False
+        game_state.race_clock = 0
+        self.finish_times = {}  # Slot -> race clock when that player finished
+        self.set_phase(COUNTDOWN if self.clients else WAITING)
+
+    def active_slots(self):
+        return [slot for slot, client in enumerate(self.slots) if client is not None]
+
+    def step(self, inputs):
+        """Advance the race by one tick, with inputs mapping each active slot to its control mask."""
+        game_state = self.game_state
+        if self.phase != RACING:
+            return
+        game_state.race_clock += SIM_DT
+        frames = SIM_DT * REFERENCE_FRAME_RATE
+        slots = list(inputs)
+        players = [self.players[slot] for slot in slots]
+        for slot, player in zip(slots, players):
+            update_player(player, Controls.from_bits(inputs[slot]), SIM_DT)
+        self.fleet.update(self.track, SIM_DT)
+
+        # Collisions between every pair of cars, the connected players first
+        fleet = self.fleet
+        positions = np.vstack([np.reshape([player.position for player in players], (-1, 3)), fleet.position])
+        speeds = np.concatenate([[player.speed for player in players], fleet.speed])
+        radii = np.concatenate([[player.collision_radius for player in players], fleet.collision_radius])
+        first, second = resolve_collisions(positions, speeds, radii)
+        if len(first):
+            for i, player in enumerate(players):
+                player.position[:] = positions[i].tolist()
+                player.speed = float(speeds[i])
+            fleet.position[:] = positions[len(players):]
+            fleet.speed[:] = speeds[len(players):]
+
+        for slot, player in zip(slots, players):
+            if follow_track(player, self.track, frames) and player.laps >= game_state.total_laps:
+                self.finish_times.setdefault(slot, game_state.race_clock)
+
+    def advance_phase(self):
+        game_state = self.game_state
+        self.phase_ticks += 1
+        if self.phase == COUNTDOWN and self.phase_ticks % SIM_RATE == 0:
+            # One second per count, then a second of "GO!", like the game
+            if game_state.countdown_value > 0:
+                game_state.countdown_value -= 1
+            else:
+                self.set_phase(RACING)
+        elif self.phase == RACING:
+            if len(self.finish_times) == len(self.clients) or game_state.race_clock >= self.time_limit:
+                self.set_phase(FINISHED)
+                results = ", ".join(f"slot {slot} {game_state.race_clock if slot not in self.finish_times else self.finish_times[slot]:.2f}s"
+                                    for slot in sorted(self.finish_times, key=self.finish_times.get))
+                self.log(f"Race over: {results or 'nobody finished'}")
+        elif self.phase == FINISHED and self.phase_ticks >= RESULTS_TIME * SIM_RATE:
+            self.reset_race()
+
+    def tick(self):
+        start = time.perf_counter()
+
+        # One input per connected client; a late one is stood in for by the last
+        inputs = {}
+        for slot in self.active_slots():
+            client = self.slots[slot]
+            if client.inputs:
+                client.processed_seq, client.last_mask = client.inputs.popleft()
+            elif self.phase == RACING:
+                client.late_inputs += 1
+            inputs[slot] = client.last_mask
+        self.step(inputs)
+        self.advance_phase()
+
+        self.tick_count += 1
+        if self.tick_count % SNAPSHOT_INTERVAL == 0:
+            self.broadcast()
+        if self.tick_count % SIM_RATE == 0:
+            self.drop_silent_clients()
+        self.tick_times.append(time.perf_counter() - start)
+
+    def broadcast(self):
+        """Snapshot the race and send it to every client that has bandwidth left."""
+        players = self.players
+        state = quantize_cars(np.vstack([np.reshape([player.position for player in players], (-1, 3)),
+                                         self.fleet.position]),
+                              np.concatenate([[player.rotation for player in players], self.fleet.rotation]),
+                              np.concatenate([[player.progress for player in players], self.fleet.progress]))
+        tick = self.tick_count
+        self.history[tick] = state
+        while len(self.history) > SNAPSHOT_HISTORY:
+            self.history.popitem(last=False)
+
+        game_state = self.game_state
+        active = sum(1 << slot for slot in self.active_slots())
+        encoded = {}  # Baseline tick -> encoded cars, shared by the clients that have the same one
+        refill = self.bandwidth * SNAPSHOT_INTERVAL * SIM_DT
+        for client in self.clients.values():
+            client.budget = min(client.budget + refill, self.bandwidth * 0.25)
+            if client.budget <= 0:
+                client.snapshots_skipped += 1
+                continue
+            baseline = client.acked_tick if client.acked_tick in self.history else NO_BASELINE
+            if baseline not in encoded:
+                encoded[baseline] = encode_cars(state, self.history.get(baseline))
+            widths, cars = encoded[baseline]
+            player = players[client.slot]
+            packet = b"".join([
+                SNAPSHOT.pack(MSG_SNAPSHOT, tick, baseline, client.processed_seq, self.phase,
+                              game_state.countdown_value, game_state.race_clock, active, widths),
+                OWN_CAR.pack(*player.position, player.rotation, player.speed, player.gear,
+                             player.shift_up_held | player.shift_down_held << 1, player.laps,
+                             player.last_checkpoint),
+                cars])
+            self.transport.sendto(packet, client.address)
+            client.budget -= len(packet) + UDP_OVERHEAD
+            client.bytes_sent += len(packet) + UDP_OVERHEAD
+            client.snapshots_sent += 1
+
+    async def run(self):
+        # Tick at SIM_RATE against the event loop clock, catching up after a slow tick
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            ticks = 0
+            while loop.time() >= next_tick and ticks < MAX_SIM_STEPS_PER_FRAME:
+                self.tick()
+                next_tick += SIM_DT
+                ticks += 1
+            if ticks == MAX_SIM_STEPS_PER_FRAME and loop.time() > next_tick:
+                # Too slow to keep up: drop the backlog
+                self.ticks_dropped += int((loop.time() - next_tick) / SIM_DT)
+                next_tick = loop.time()
+            await asyncio.sleep(max(0.0, next_tick - loop.time()))
+
+    def stats(self):
+        tick_ms = np.array(self.tick_times) * 1000 if self.tick_times else np.zeros(1)
+        seconds = max(self.tick_count * SIM_DT, SIM_DT)
+        return {
+            "ticks": self.tick_count,
+            "ticks_dropped": self.ticks_dropped,
+            "clients": len(self.clients),
+            "ai": len(self.fleet),
+            "phase": PHASE_NAMES[self.phase],
+            "race_clock": self.game_state.race_clock,
+            "tick_ms_avg": float(tick_ms.mean()),
+            "tick_ms_p99": float(np.percentile(tick_ms, 99)),
+            "tick_ms_max": float(tick_ms.max()),
+            "cpu_share": float(tick_ms.sum() / 1000 / (len(tick_ms) * SIM_DT)),  # Of one core, while ticking on time
+            "bytes_per_client_per_s": {str(client.slot): client.bytes_sent / seconds for client in self.clients.values()},
+            "snapshots_sent": sum(client.snapshots_sent for client in self.clients.values()),
+            "snapshots_skipped": sum(client.snapshots_skipped for client in self.clients.values()),
+            "late_inputs": sum(client.late_inputs for client in self.clients.values()),
+        }
+
+class RaceClient(asyncio.DatagramProtocol):
+    """
+    One player's side of a network race. update() runs the local fixed steps (input, prediction
+    and sending), interpolate() places the other cars, and game_state, player, view (an AIFleet
+    holding everyone else) and track can be drawn with render_scene like a local race.
+    """
+    def __init__(self, track_data=None, num_trees=200):
+        self.track_data = track_data
+        self.num_trees = num_trees
+        self.transport = None
+        self.error = None  # Why the server turned us away
+        self.slot = None
+        self.track = None  # Built once the server says which world it runs
+        self.game_state = GameState()
+        self.player = PlayerCar()
+        self.view = None
+        self.view_cars = None  # Car index of each car in view
+        self.phase = WAITING
+        self.seq = 0  # Sequence number of the newest input
+        self.pending = deque()  # [seq, mask, x, z] for inputs the server hasn't simulated, oldest first
+        self.latest_tick = None  # Newest snapshot decoded
+        self.history = OrderedDict()  # Snapshot tick -> (quantized cars, active slots)
+        self.tick_offset = None  # Server tick minus local time in ticks
+        self.sim_accumulator = 0.0
+        self.join_timer = 0.0
+        self.snapshots_received = 0
+        self.snapshots_dropped = 0  # Snapshots whose baseline was no longer here
+        self.prediction_errors = deque(maxlen=SIM_RATE * 60)  # Distance between prediction and server per snapshot
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.transport.sendto(JOIN.pack(MSG_JOIN, PROTOCOL_VERSION))
+
+    def leave(self):
+        if self.transport is not None and self.slot is not None:
+            self.transport.sendto(LEAVE.pack(MSG_LEAVE))
+
+    def datagram_received(self, data, address):
+        if not data:
+            return
+        try:
+            if data[0] == MSG_WELCOME:
+                self.welcome(data)
+            elif data[0] == MSG_REJECT:
+                reason = REJECT.unpack_from(data)[1]
+                self.error = "the server is full" if reason == REJECT_FULL else "the server runs another version"
+            elif data[0] == MSG_SNAPSHOT and self.track is not None:
+                self.receive_snapshot(data, time.monotonic())
+        except (struct.error, ValueError):
+            self.snapshots_dropped += 1
+
+    def error_received(self, exc):
+        pass  # Retried by the next join or input packet
+
+    def welcome(self, data):
+        if self.track is not None:
+            return
+        _, slot, max_clients, num_ai, total_laps, tick_rate, snapshot_interval, seed, server_hash = WELCOME.unpack(data)
+        if tick_rate != SIM_RATE:
+            self.error = f"the server ticks at {tick_rate} Hz, this client at {SIM_RATE} Hz"
+            return
+        if server_hash != trackfile.track_hash(self.track_data):
+            self.error = "the server races on a different track"
+            return
+        self.slot = slot
+        self.max_clients = max_clients
+        self.num_ai = num_ai
+        self.colors = car_colors(max_clients + num_ai)
+        self.game_state.total_laps = total_laps
+        self.track = Track(num_trees=self.num_trees, rng=random.Random(seed), data=self.track_data)
+
+    # --- Snapshots ---
+
+    def receive_snapshot(self, data, now):
+        _, tick, baseline, processed_seq, phase, countdown, race_clock, active, widths = SNAPSHOT.unpack_from(data)
+        if self.latest_tick is not None and tick <= self.latest_tick:
+            return  # Arrived out of order; a newer one is already in
+        if baseline != NO_BASELINE and baseline not in self.history:
+            self.snapshots_dropped += 1
+            return
+        own = OWN_CAR.unpack_from(data, SNAPSHOT.size)
+        state = decode_cars(memoryview(data)[SNAPSHOT.size + OWN_CAR.size:], widths, self.max_clients + self.num_ai,
+                            self.history[baseline][0] if baseline != NO_BASELINE else None)
+        self.history[tick] = (state, active)
+        while len(self.history) > 2 * SNAPSHOT_HISTORY:
+            self.history.popitem(last=False)
+        self.latest_tick = tick
+        self.snapshots_received += 1
+
+        # Follow the server clock smoothly, unless it jumped
+        offset = tick - now * SIM_RATE
+        if self.tick_offset is None or abs(offset - self.tick_offset) > SIM_RATE / 2:
+            self.tick_offset = offset
+        else:
+            self.tick_offset += (offset - self.tick_offset) * 0.05
+
+        self.update_race(phase, countdown, race_clock, active, state, own)
+        self.reconcile(own, processed_seq)
+
+    def update_race(self, phase, countdown, race_clock, active, state, own):
+        game_state = self.game_state
+        if phase != self.phase:
+            if phase in (WAITING, COUNTDOWN):
+                # A new race: forget the last one's laps
+                total_laps = game_state.total_laps
+                self.game_state = game_state = GameState()
+                game_state.total_laps = total_laps
+            elif phase == RACING:
+                start_race(game_state)
+            self.phase = phase
+        game_state.countdown_active = phase == COUNTDOWN
+        game_state.countdown_value = countdown
+        game_state.game_started = phase in (RACING, FINISHED)
+        game_state.race_clock = race_clock
+
+        # Lap times as the server counts them
+        laps = own[7]
+        if laps > game_state.laps and game_state.game_started:
+            lap_time = race_clock - game_state.lap_start_time
+            game_state.lap_times.append(lap_time)
+            game_state.best_lap = min(game_state.best_lap, lap_time)
+            game_state.laps = laps
+            game_state.lap_start_time = race_clock
+            if laps >= game_state.total_laps and not game_state.game_over:
+                end_race(game_state)
+        if phase == FINISHED and not game_state.game_over:
+            end_race(game_state)
+
+        # Position among the connected players and the AI cars
+        cars = [slot for slot in range(self.max_clients) if active >> slot & 1]
+        cars += range(self.max_clients, self.max_clients + self.num_ai)
+        game_state.field_size = len(cars)
+        if self.slot in cars:
+            game_state.standings.update(state[cars, PROGRESS] / PROGRESS_SCALE)
+            game_state.race_position = int(game_state.standings.rank[cars.index(self.slot)]) + 1
+
+    def reconcile(self, own, processed_seq):
+        """Take the server's state of our car and replay the inputs it hasn't simulated yet on top."""
+        x, y, z, rotation, speed, gear, held, laps, checkpoint = own
+        pending = self.pending
+        while pending and pending[0][0] < processed_seq:
+            pending.popleft()
+        if pending and pending[0][0] == processed_seq:
+            _, _, predicted_x, predicted_z = pending.popleft()
+            self.prediction_errors.append(math.hypot(predicted_x - x, predicted_z - z))
+
+        player = self.player
+        player.position = [x, y, z]
+        player.rotation = rotation
+        player.speed = speed
+        player.gear = gear
+        player.shift_up_held = bool(held & 1)
+        player.shift_down_held = bool(held & 2)
+        player.laps = laps
+        player.last_checkpoint = checkpoint
+        if self.phase == RACING:
+            for entry in pending:
+                self.predict(entry[1])
+                entry[2], entry[3] = player.position[0], player.position[2]
+
+    def predict(self, mask):
+        update_player(self.player, Controls.from_bits(mask), SIM_DT)
+        follow_track(self.player, self.track, SIM_DT * REFERENCE_FRAME_RATE)
+
+    # --- Local steps ---
+
+    def retry_join(self, elapsed):
+        # Ask again every JOIN_RETRY seconds until the server answers
+        self.join_timer += elapsed
+        if self.join_timer >= JOIN_RETRY and self.transport is not None and self.error is None:
+            self.join_timer = 0.0
+            self.transport.sendto(JOIN.pack(MSG_JOIN, PROTOCOL_VERSION))
+
+    def update(self, elapsed, driver):
+        """
+        Run the local fixed steps for elapsed seconds: each reads the controls from
+        driver(game_state, player, track), moves our car at once and queues the input for the server.
+        """
+        if self.track is None:
+            self.retry_join(elapsed)
+            return
+
+        self.sim_accumulator += elapsed
+        steps = 0
+        while self.sim_accumulator >= SIM_DT and steps < MAX_SIM_STEPS_PER_FRAME:
+            player = self.player
+            player.save_previous_state()
+            mask = driver(self.game_state, player, self.track).to_bits()
+            self.seq += 1
+            if self.phase == RACING:
+                self.predict(mask)
+                self.game_state.race_clock += SIM_DT
+            self.pending.append([self.seq, mask, player.position[0], player.position[2]])
+            if self.seq % INPUT_INTERVAL == 0:
+                self.send_input()
+            self.sim_accumulator -= SIM_DT
+            steps += 1
+        if steps == MAX_SIM_STEPS_PER_FRAME:
+            self.sim_accumulator = min(self.sim_accumulator, SIM_DT)
+
+        # Without answers the server has long dropped these
+        while len(self.pending) > 2 * SIM_RATE:
+            self.pending.popleft()
+
+    def send_input(self):
+        masks = [entry[1] for entry in list(self.pending)[-INPUT_REDUNDANCY:]]
+        acked_tick = self.latest_tick if self.latest_tick is not None else NO_BASELINE
+        self.transport.sendto(INPUT.pack(MSG_INPUT, acked_tick, self.seq, len(masks)) +
+                              struct.pack(f"<{len(masks)}H", *masks))
+
+    def interpolate(self, now):
+        """Place the other cars INTERPOLATION_DELAY ticks behind the server, between the snapshots around then."""
+        if not self.history:
+            return
+        render_tick = now * SIM_RATE + self.tick_offset - INTERPOLATION_DELAY
+        ticks = list(self.history)
+        after = min(int(np.searchsorted(ticks, render_tick)), len(ticks) - 1)
+        before = max(after - 1, 0)
+        old_state, _ = self.history[ticks[before]]
+        new_state, active = self.history[ticks[after]]
+        span = ticks[after] - ticks[before]
+        alpha = min(max((render_tick - ticks[before]) / span, 0.0), 1.0) if span else 1.0
+
+        old_positions = old_state[:, X:Z + 1] / POSITION_SCALE
+        positions = old_positions + (new_state[:, X:Z + 1] / POSITION_SCALE - old_positions) * alpha
+        old_rotations = old_state[:, ROTATION] / ROTATION_SCALE
+        turn = (new_state[:, ROTATION] / ROTATION_SCALE - old_rotations + 180) % 360 - 180
+        rotations = old_rotations + turn * alpha
+
+        # Everyone but us, rebuilding the view when someone joins or leaves
+        cars = [slot for slot in range(self.max_clients) if active >> slot & 1 and slot != self.slot]
+        cars += range(self.max_clients, self.max_clients + self.num_ai)
+        if cars != self.view_cars:
+            self.view_cars = cars
+            self.view = AIFleet(np.zeros((len(cars), 3)), [self.colors[car] for car in cars], np.random.default_rng(0))
+        view = self.view
+        view.position[:] = positions[cars]
+        view.rotation[:] = rotations[cars]
+        view.save_previous_state()  # Already blended, so render_scene's alpha has nothing to do
+
+class LoopbackTransport:
+    """Datagram transport of one LoopbackNetwork endpoint, with the sendto of an asyncio one."""
+    def __init__(self, network, address, peer=None):
+        self.network = network
+        self.address = address
+        self.peer = peer  # Where sendto without an address goes, like a connected UDP socket
+
+    def sendto(self, data, address=None):
+        self.network.send(bytes(data), self.address, address if address is not None else self.peer)
+
+    def close(self):
+        self.network.endpoints.pop(self.address, None)
+
+class LoopbackNetwork:
+    """
+    Stand-in for a UDP network inside one process: every datagram is delivered by the event
+    loop after latency give or take jitter seconds, unless it is lost, and may overtake others.
+    """
+    def __init__(self, latency=0.04, jitter=0.01, loss=0.02, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.rng = random.Random(seed)
+        self.endpoints = {}  # Address -> protocol
+        self.datagrams = 0
+        self.lost = 0
+
+    def connect(self, protocol, address, peer=None):
+        self.endpoints[address] = protocol
+        transport = LoopbackTransport(self, address, peer)
+        protocol.connection_made(transport)
+        return transport
+
+    def send(self, data, source, destination):
+        self.datagrams += 1
+        if self.rng.random() < self.loss:
+            self.lost += 1
+            return
+        delay = max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter))
+        asyncio.get_running_loop().call_later(delay, self.deliver, data, source, destination)
+
+    def deliver(self, data, source, destination):
+        protocol = self.endpoints.get(destination)
+        if protocol is not None:
+            protocol.datagram_received(data, source)
+
+async def run_loopback(num_clients=32, seconds=20.0, num_ai=7, total_laps=3, track_data=None,
+                       latency=0.04, jitter=0.01, loss=0.02, seed=0):
+    """
+    Race num_clients bots against the AI on a server over a LoopbackNetwork for seconds of
+    real time and return the server's statistics together with the clients'.
+    """
+    network = LoopbackNetwork(latency, jitter, loss, seed)
+    server = RaceServer(seed, num_ai, total_laps, track_data=track_data, verbose=False)
+    network.connect(server, "server")
+    clients = [RaceClient(track_data, num_trees=0) for _ in range(num_clients)]
+    for i, client in enumerate(clients):
+        network.connect(client, f"client{i}", "server")
+
+    server_task = asyncio.create_task(server.run())
+    driver = BotDriver()
+    loop = asyncio.get_running_loop()
+    start = last = loop.time()
+    client_time = 0.0
+    while loop.time() - start < seconds:
+        await asyncio.sleep(1.0 / MAX_RENDER_FPS)
+        now = loop.time()
+        client_start = time.perf_counter()
+        for client in clients:
+            client.update(now - last, driver)
+            client.interpolate(time.monotonic())
+        client_time += time.perf_counter() - client_start
+        last = now
+    server_task.cancel()
+
+    errors = np.concatenate([list(client.prediction_errors) for client in clients] + [[0.0]])
+    bandwidth = list(server.stats()["bytes_per_client_per_s"].values()) or [0.0]
+    result = server.stats()
+    result.update({
+        "seconds": seconds,
+        "expected_ticks": int(seconds * SIM_RATE),
+        "bytes_per_client_per_s": {"avg": float(np.mean(bandwidth)), "max": float(np.max(bandwidth))},
+        "bandwidth_limit": CLIENT_BANDWIDTH,
+        "clients_joined": sum(client.track is not None for client in clients),
+        "client_errors": sorted({client.error for client in clients if client.error}),
+        "snapshots_received_per_client": float(np.mean([client.snapshots_received for client in clients])),
+        "snapshots_dropped": sum(client.snapshots_dropped for client in clients),
+        "prediction_error_avg": float(errors.mean()),
+        "prediction_error_p99": float(np.percentile(errors, 99)),
+        "client_ms_per_frame": client_time * 1000 / max(seconds * MAX_RENDER_FPS, 1),
+        "datagrams": network.datagrams,
+        "datagrams_lost": network.lost,
+    })
+    return result
+
+async def serve(host, port, **race_options):
+    loop = asyncio.get_running_loop()
+    server = RaceServer(**race_options)
+    transport, _ = await loop.create_datagram_endpoint(lambda: server, local_addr=(host, port))
+    print(f"Race server on {host}:{port}: {server.max_clients} player slots, {len(server.fleet)} AI cars, "
+          f"{server.game_state.total_laps} laps on the {server.track.name.lower()}", flush=True)
+    try:
+        await server.run()
+    finally:
+        transport.close()
+
+async def play(host, port, track_data=None):
+    """Join a race server in a game window. ESC leaves, F3 shows the frame profiler."""
+    import pygame
+    from pygame.locals import K_ESCAPE, K_F3
+    from OpenGL.GL import glViewport
+    from main import HEIGHT, WIDTH, Loader, init_display, init_lighting, read_controls, render_scene
+
+    loop = asyncio.get_running_loop()
+    client = RaceClient(track_data)
+    transport, _ = await loop.create_datagram_endpoint(lambda: client, remote_addr=(host, port))
+    deadline = loop.time() + 10
+    while client.track is None:
+        if client.error:
+            sys.exit(f"Couldn't join: {client.error}")
+        if loop.time() > deadline:
+            sys.exit(f"No answer from {host}:{port}")
+        await asyncio.sleep(0.05)
+        client.retry_join(0.05)
+
+    init_display()
+    init_lighting()
+    loader = Loader(client.track)
+
+    def drive(game_state, player, track):
+        return read_controls(pygame.key.get_pressed())
+
+    show_profiler = False
+    running = True
+    last = loop.time()
+    while running:
+        if loader:
+            loader = None if loader.poll() else loader
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == K_ESCAPE):
+                running = False
+            if event.type == pygame.KEYDOWN and event.key == K_F3:
+                show_profiler = not show_profiler
+        now = loop.time()
+        client.update(min(now - last, 0.25), drive)
+        client.interpolate(time.monotonic())
+        last = now
+
+        if client.view is None:
+            await asyncio.sleep(1.0 / MAX_RENDER_FPS)  # Nothing to draw before the first snapshot
+            continue
+        glViewport(0, 0, WIDTH, HEIGHT)
+        render_scene(client.game_state, client.player, client.view, client.track,
+                     client.sim_accumulator / SIM_DT, show_profiler)
+        pygame.display.flip()
+        # Sleeping in the event loop rather than in pygame lets snapshots in between frames
+        await asyncio.sleep(max(0.0, 1.0 / MAX_RENDER_FPS - (loop.time() - now)))
+
+    client.leave()
+    transport.close()
+    pygame.quit()
+
+def parse_address(text):
+    host, _, port = text.rpartition(":")
+    return (host or "localhost"), int(port or DEFAULT_PORT)
+
+def main():
+    parser = argparse.ArgumentParser(description="Multiplayer races over UDP.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve_parser = commands.add_parser("serve", help="run a race server")
+    serve_parser.add_argument("--host", default="0.0.0.0")
+    serve_parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    join_parser = commands.add_parser("join", help="race on a server in a game window")
+    join_parser.add_argument("address", help="HOST:PORT of the server")
+    loopback_parser = commands.add_parser("loopback", help="race bots against an in-process server and report")
+    loopback_parser.add_argument("--clients", type=int, default=MAX_CLIENTS)
+    loopback_parser.add_argument("--seconds", type=float, default=20.0)
+    loopback_parser.add_argument("--latency", type=float, default=40.0, help="one-way latency in milliseconds")
+    loopback_parser.add_argument("--jitter", type=float, default=10.0, help="latency jitter in milliseconds")
+    loopback_parser.add_argument("--loss", type=float, default=0.02, help="fraction of datagrams lost")
+    for command in (serve_parser, loopback_parser):
+        command.add_argument("--ai", type=int, default=7, help="number of AI cars")
+        command.add_argument("--laps", type=int, default=3)
+        command.add_argument("--seed", type=int, default=0)
+    for command in (serve_parser, join_parser, loopback_parser):
+        command.add_argument("--track", help="race on a track file instead of the oval (the same on server and clients)")
+    args = parser.parse_args()
+    track_data = trackfile.load_track(args.track) if args.track else None
+
+    try:
+        if args.command == "serve":
+            asyncio.run(serve(args.host, args.port, seed=args.seed, num_ai=args.ai, total_laps=args.laps,
+                              track_data=track_data))
+        elif args.command == "join":
+            asyncio.run(play(*parse_address(args.address), track_data))
+        else:
+            result = asyncio.run(run_loopback(args.clients, args.seconds, args.ai, args.laps, track_data,
+                                              args.latency / 1000, args.jitter / 1000, args.loss, args.seed))
+            json.dump(result, sys.stdout)
+            sys.stdout.write("\n")
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Race standings.
+
+Cars are ranked by continuous progress: laps completed times the lap length plus the distance
+travelled along the centerline on the current lap. Between simulation steps the order hardly
+ever changes, so it is kept from step to step and repaired with neighbour swaps (an insertion
+sort that only visits cars which moved past the one ahead) instead of being sorted again.
+"""
+import numpy as np
+
+class Standings:
+    """
+    The running order of a field of cars, identified by their index in the progress array
+    given to update(). order lists the cars from the leader back, rank gives each car's place
+    counting from 0, and progress holds the values the order was last built from.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # Forget the order, so the next update ranks the field from scratch
+        self.order = np.zeros(0, dtype=np.int64)
+        self.rank = np.zeros(0, dtype=np.int64)
+        self.progress = np.zeros(0)
+        self.swaps = 0  # Neighbour swaps made by the last update
+
+    def restore(self, order, progress):
+        # Take over a running order saved from an earlier update, with the progress it was built from
+        self.order = np.array(order, dtype=np.int64)
+        self.rank = np.empty_like(self.order)
+        self.rank[self.order] = np.arange(len(self.order))
+        self.progress = np.array(progress, dtype=np.float64)
+        self.swaps = 0
+
+    def update(self, progress):
+        """Re-rank the field from each car's progress. Cars level on progress keep their order."""
+        progress = np.asarray(progress, dtype=np.float64)
+        if len(progress) != len(self.order):
+            self.order = np.argsort(-progress, kind="stable")
+            self.rank = np.empty_like(self.order)
+            self.progress = progress.copy()
+            self.swaps = 0
+            self.rank[self.order] = np.arange(len(self.order))
+            return
+
+        self.progress[:] = progress
+        order = self.order
+        swaps = 0
+        while True:
+            # Cars further along than the car ranked ahead of them
+            ranked = progress[order]
+            passing = np.flatnonzero(ranked[1:] > ranked[:-1]) + 1
+            if not len(passing):
+                break
+            for place in passing.tolist():
+                car = order[place]
+                car_progress = progress[car]
+                while place > 0 and progress[order[place - 1]] < car_progress:
+                    order[place] = order[place - 1]
+                    place -= 1
+                    swaps += 1
+                order[place] = car
+        self.swaps = swaps
+        if swaps:
+            self.rank[order] = np.arange(len(order))
+
+    def gaps(self):
+        # Distance from the leader back to each car, in running order
+        return self.progress[self.order[0]] - self.progress[self.order] if len(self.order) else self.progress
+
+    def intervals(self):
+        # Distance from each car to the one ranked directly ahead, in running order (0 for the leader)
+        return np.concatenate([[0.0], -np.diff(self.progress[self.order])]) if len(self.order) else self.progress
+
+    def gap_to_leader(self, car):
+        return float(self.progress[self.order[0]] - self.progress[car])
@@ -0,0 +1,254 @@
+"""
+Streaming heightmap terrain.
+
+The ground is a heightmap defined everywhere, split into square tiles. Only tiles within the
+view distance are drawn, each at a level of detail picked by its distance from the camera.
+Tile meshes are generated on demand and kept as display lists in a least recently used cache,
+so memory and the work per frame stay bounded however far the world reaches:
+
+- at most max_tiles display lists exist at once, the least recently drawn are deleted first
+- at most builds_per_frame tiles are generated at their proper detail each frame; until then a
+  tile is drawn at whatever detail is cached, or generated at the coarsest (and cheapest) one
+
+The ground is flattened under the road, sitting just below its surface with a level shoulder
+either side, and blends into the hills further out.
+"""
+from collections import OrderedDict
+import numpy as np
+from OpenGL.GL import *
+
+TILE_SIZE = 64.0  # World units along each side of a tile
+TILE_LODS = (16, 8, 4, 2)  # Grid squares along a tile side, from the finest level of detail to the coarsest
+TILE_LOD_DISTANCES = (100.0, 200.0, 350.0)  # Tiles further than these use the next level of detail
+SKIRT_DEPTH = 3.0  # Tile edges hang down this far, hiding cracks between neighbours of different detail
+
+ROAD_CLEARANCE = 0.2  # Ground under the road sits this far below it
+ROAD_SHOULDER = 10.0  # Level ground beside the road edges
+ROAD_BLEND = 200.0  # Distance over which the ground rises from the road into the hills
+ROAD_SAMPLE_SPACING = 2.0  # Very dense centerlines are thinned to about this spacing for flattening
+
+GRASS_COLOR = np.array([0.05, 0.45, 0.05], dtype=np.float32)
+HILLTOP_COLOR = np.array([0.4, 0.45, 0.2], dtype=np.float32)
+
+class NoiseHeightmap:
+    """
+    Rolling hills from a few octaves of value noise on a hashed lattice, so any part of an
+    unbounded world can be sampled without storing anything. Heights run from 0 to amplitude.
+    """
+    def __init__(self, seed=0, amplitude=30.0, wavelength=250.0, octaves=4):
+        self.seed = seed
+        self.seed_hash = np.uint64(((seed & 0xFFFFFFFF) * 0x165667B19E3779F9) & 0xFFFFFFFFFFFFFFFF)
+        self.amplitude = amplitude
+        self.wavelength = wavelength
+        self.octaves = octaves
+
+    def lattice(self, ix, iz):
+        # A repeatable pseudo-random value in [0, 1) for each lattice point. The hash relies on
+        # uint64 products wrapping around, which numpy only warns about for single values.
+        with np.errstate(over="ignore"):
+            h = ix.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15) ^ iz.astype(np.uint64) * np.uint64(0xC2B2AE3D27D4EB4F)
+            h ^= self.seed_hash
+            h ^= h >> np.uint64(29)
+            h *= np.uint64(0xBF58476D1CE4E5B9)
+            h ^= h >> np.uint64(32)
+        return (h >> np.uint64(40)).astype(np.float64) / float(1 << 24)
+
+    def noise(self, x, z):
+        # Smoothly interpolated lattice values
+        ix, iz = np.floor(x), np.floor(z)
+        fx, fz = x - ix, z - iz
+        fx, fz = fx * fx * (3 - 2 * fx), fz * fz * (3 - 2 * fz)
+        ix, iz = ix.astype(np.int64), iz.astype(np.int64)
+        top = self.lattice(ix, iz) * (1 - fx) + self.lattice(ix + 1, iz) * fx
+        bottom = self.lattice(ix, iz + 1) * (1 - fx) + self.lattice(ix + 1, iz + 1) * fx
+        return top * (1 - fz) + bottom * fz
+
+    def __call__(self, x, z):
+        x = np.asarray(x, dtype=np.float64) / self.wavelength
+        z = np.asarray(z, dtype=np.float64) / self.wavelength
+        height = np.zeros(np.broadcast(x, z).shape)
+        weight = 1.0
+        for octave in range(self.octaves):
+            height += self.noise(x * 2 ** octave + octave * 17.0, z * 2 ** octave) * weight
+            weight /= 2
+        return height * self.amplitude / (2 - 2 * weight)
+
+def _grid_indices(size):
+    # Triangles covering a size x size grid of vertices laid out row by row
+    rows, columns = np.meshgrid(np.arange(size - 1), np.arange(size - 1), indexing="ij")
+    corner = (rows * size + columns).ravel()
+    quads = np.stack([corner, corner + size, corner + size + 1, corner, corner + size + 1, corner + 1], axis=1)
+    return np.ascontiguousarray(quads.ravel(), dtype=np.uint32)
+
+class Terrain:
+    """
+    The ground around a road: a heightmap flattened under the road's centerline (points and
+    half_widths per point, as in a Track), drawn as streamed tiles around the camera.
+    """
+    def __init__(self, road_points, road_half_widths, heightmap, view_distance=500.0, max_tiles=512,
+                 builds_per_frame=4):
+        self.heightmap = heightmap
+        self.view_distance = view_distance
+        self.max_tiles = max_tiles
+        self.builds_per_frame = builds_per_frame
+        self.tiles = OrderedDict()  # (tile x, tile z, lod) -> display list, least recently drawn first
+        self.tiles_drawn = 0  # Tiles that passed culling in the last render
+        self.tiles_built = 0  # Tiles generated in the last render
+        self.indices = {size: _grid_indices(size + 3) for size in TILE_LODS}
+
+        # Road segments for flattening, thinned out on very dense centerlines
+        road_points = np.asarray(road_points, dtype=np.float64)
+        road_half_widths = np.asarray(road_half_widths, dtype=np.float64)
+        spacing = np.mean(np.linalg.norm(np.diff(road_points[:, [0, 2]], axis=0), axis=1)) if len(road_points) > 1 else 1.0
+        keep = np.arange(0, len(road_points), max(1, int(ROAD_SAMPLE_SPACING / max(spacing, 1e-9))))
+        starts = road_points[keep]
+        self.road_start = starts
+        self.road_end = np.roll(starts, -1, axis=0)
+        self.road_half_width = road_half_widths[keep]
+        self.road_half_width_end = np.roll(self.road_half_width, -1)
+        self.road_low = np.minimum(self.road_start, self.road_end)[:, [0, 2]]
+        self.road_high = np.maximum(self.road_start, self.road_end)[:, [0, 2]]
+        self.road_reach = float(np.max(road_half_widths, initial=0.0)) + ROAD_SHOULDER + ROAD_BLEND
+
+        # Tiles are culled against a box as tall as the heightmap can reach, plus the road
+        low = min(0.0, float(np.min(road_points[:, 1], initial=0.0))) - SKIRT_DEPTH
+        high = max(heightmap.amplitude, float(np.max(road_points[:, 1], initial=0.0)))
+        self.tile_center_y = (low + high) / 2
+        self.tile_radius = float(np.hypot(TILE_SIZE / np.sqrt(2), (high - low) / 2))
+
+    def height_at(self, x, z):
+        """Ground height at world positions (x, z), as an array shaped like them."""
+        x = np.asarray(x, dtype=np.float64)
+        z = np.asarray(z, dtype=np.float64)
+        ground = self.heightmap(x, z)
+
+        # Only road segments within reach of the positions can flatten them
+        near = np.flatnonzero(np.all(self.road_low - self.road_reach <= (x.max(), z.max()), axis=1) &
+                              np.all(self.road_high + self.road_reach >= (x.min(), z.min()), axis=1))
+        if not len(near):
+            return ground
+
+        # Distance to the nearest road segment, and the road height and half width there
+        start, end = self.road_start[near], self.road_end[near]
+        px, pz = x.reshape(-1, 1), z.reshape(-1, 1)
+        dx, dz = end[:, 0] - start[:, 0], end[:, 2] - start[:, 2]
+        t = np.clip(((px - start[:, 0]) * dx + (pz - start[:, 2]) * dz) / np.maximum(dx * dx + dz * dz, 1e-12), 0, 1)
+        distance_sq = (px - start[:, 0] - t * dx) ** 2 + (pz - start[:, 2] - t * dz) ** 2
+        nearest = np.argmin(distance_sq, axis=1)
+        rows = np.arange(len(nearest))
+        t = t[rows, nearest]
+        segment = near[nearest]
+        road_y = self.road_start[segment, 1] + t * (self.road_end[segment, 1] - self.road_start[segment, 1])
+        half_width = self.road_half_width[segment] + t * (self.road_half_width_end[segment] -
+                                                          self.road_half_width[segment])
+        from_edge = np.sqrt(distance_sq[rows, nearest]) - half_width
+
+        # Level beside the road, then easing into the hills
+        blend = np.clip((from_edge - ROAD_SHOULDER) / ROAD_BLEND, 0, 1).reshape(x.shape)
+        blend = blend * blend * (3 - 2 * blend)
+        return (road_y.reshape(x.shape) - ROAD_CLEARANCE) * (1 - blend) + ground * blend
+
+    def tile_mesh(self, tile_x, tile_z, lod):
+        """
+        Vertices, colors and normals of one tile at a level of detail, with a skirt around it,
+        as float32 arrays to draw with the triangle indices in self.indices for its grid size.
+        """
+        size = TILE_LODS[lod]
+        spacing = TILE_SIZE / size
+
+        # Heights one sample past each edge too, so normals match across tile borders
+        offsets = np.arange(-1, size + 2) * spacing
+        z, x = np.meshgrid(tile_z * TILE_SIZE + offsets, tile_x * TILE_SIZE + offsets, indexing="ij")
+        heights = self.height_at(x, z)
+        slope_x = (heights[1:-1, 2:] - heights[1:-1, :-2]) / (2 * spacing)
+        slope_z = (heights[2:, 1:-1] - heights[:-2, 1:-1]) / (2 * spacing)
+        normals = np.stack([-slope_x, np.ones_like(slope_x), -slope_z], axis=-1)
+        normals /= np.linalg.norm(normals, axis=-1, keepdims=True)
+
+        # The skirt repeats the edge vertices lower down
+        vertices = np.stack([x[1:-1, 1:-1], heights[1:-1, 1:-1], z[1:-1, 1:-1]], axis=-1)
+        vertices = np.pad(vertices, ((1, 1), (1, 1), (0, 0)), mode="edge")
+        vertices[[0, -1], :, 1] -= SKIRT_DEPTH
+        vertices[1:-1, [0, -1], 1] -= SKIRT_DEPTH
+        normals = np.pad(normals, ((1, 1), (1, 1), (0, 0)), mode="edge")
+
+        # Grass, drying out toward the hilltops
+        rise = np.clip(vertices[..., 1:2] / self.heightmap.amplitude, 0, 1)
+        colors = GRASS_COLOR + (HILLTOP_COLOR - GRASS_COLOR) * rise
+        return (np.ascontiguousarray(vertices.reshape(-1, 3), dtype=np.float32),
+                np.ascontiguousarray(colors.reshape(-1, 3), dtype=np.float32),
+                np.ascontiguousarray(normals.reshape(-1, 3), dtype=np.float32))
+
+    def build_tile(self, tile_x, tile_z, lod):
+        # Compile one tile into a display list and add it to the cache
+        vertices, colors, normals = self.tile_mesh(tile_x, tile_z, lod)
+        indices = self.indices[TILE_LODS[lod]]
+        list_id = glGenLists(1)
+        glNewList(list_id, GL_COMPILE)
+        glEnableClientState(GL_VERTEX_ARRAY)
+        glEnableClientState(GL_COLOR_ARRAY)
+        glEnableClientState(GL_NORMAL_ARRAY)
+        glVertexPointer(3, GL_FLOAT, 0, vertices)
+        glColorPointer(3, GL_FLOAT, 0, colors)
+        glNormalPointer(GL_FLOAT, 0, normals)
+        glDrawElements(GL_TRIANGLES, len(indices), GL_UNSIGNED_INT, indices)
+        glDisableClientState(GL_NORMAL_ARRAY)
+        glDisableClientState(GL_COLOR_ARRAY)
+        glDisableClientState(GL_VERTEX_ARRAY)
+        glNormal3f(0, 0, 1)
+        glEndList()
+        self.tiles[tile_x, tile_z, lod] = list_id
+        self.tiles_built += 1
+        return list_id
+
+    def cached_tile(self, tile_x, tile_z, lod):
+        # The closest level of detail to lod already compiled for a tile, or None
+        for other in sorted(range(len(TILE_LODS)), key=lambda other: abs(other - lod)):
+            list_id = self.tiles.get((tile_x, tile_z, other))
+            if list_id is not None:
+                self.tiles.move_to_end((tile_x, tile_z, other))
+                return list_id
+        return None
+
+    def render(self, frustum=None, camera_position=None):
+        """Draw the tiles in view around the camera, generating missing ones within the frame's budget."""
+        camera_x, _, camera_z = camera_position if camera_position is not None else (0.0, 0.0, 0.0)
+        reach = int(np.ceil(self.view_distance / TILE_SIZE))
+        tile_x, tile_z = np.meshgrid(np.arange(-reach, reach + 1) + int(np.floor(camera_x / TILE_SIZE)),
+                                     np.arange(-reach, reach + 1) + int(np.floor(camera_z / TILE_SIZE)))
+        tile_x, tile_z = tile_x.ravel(), tile_z.ravel()
+        centers = np.stack([(tile_x + 0.5) * TILE_SIZE, np.full(len(tile_x), self.tile_center_y),
+                            (tile_z + 0.5) * TILE_SIZE], axis=1)
+        distances = np.hypot(centers[:, 0] - camera_x, centers[:, 2] - camera_z) - TILE_SIZE / np.sqrt(2)
+        wanted = distances < self.view_distance
+        if frustum is not None:
+            wanted &= frustum.spheres_visible(centers, np.full(len(centers), self.tile_radius))
+        lods = np.searchsorted(TILE_LOD_DISTANCES, distances)
+
+        # Nearest tiles first, so the build budget goes where detail shows most
+        self.tiles_built = 0
+        visible = np.flatnonzero(wanted)
+        for i in visible[np.argsort(distances[visible])].tolist():
+            key = (int(tile_x[i]), int(tile_z[i]), int(lods[i]))
+            list_id = self.tiles.get(key)
+            if list_id is not None:
+                self.tiles.move_to_end(key)
+            elif self.tiles_built < self.builds_per_frame:
+                list_id = self.build_tile(*key)
+            else:
+                list_id = self.cached_tile(*key)
+                if list_id is None:
+                    list_id = self.build_tile(key[0], key[1], len(TILE_LODS) - 1)
+            glCallList(list_id)
+        self.tiles_drawn = len(visible)
+
+        # Drop the least recently drawn tiles beyond the cache size
+        while len(self.tiles) > self.max_tiles:
+            _, list_id = self.tiles.popitem(last=False)
+            glDeleteLists(list_id, 1)
+
+    def release(self):
+        # Free every compiled tile; they are generated again as they come into view
+        for list_id in self.tiles.values():
+            glDeleteLists(list_id, 1)
+        self.tiles.clear()
@@ -0,0 +1,58 @@
+"""
+AI planner: the fleet only takes commands from a live worker that is keeping up.
+"""
+import os
+import signal
+import sys
+import time
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ai_planner import AIPlanner, MAX_LAG
+from main import Track
+
+NUM_CARS = 3
+
+def publish(planner, track):
+    indices = np.arange(NUM_CARS) * 5
+    planner.publish(track.point_array[indices], np.zeros(NUM_CARS), np.full(NUM_CARS, 0.5), indices,
+                    np.full(NUM_CARS, 0.6))
+
+def wait_for_commands(planner, track, timeout=10.0):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        publish(planner, track)
+        if planner.poll() is not None:
+            return
+        time.sleep(0.01)
+    pytest.fail("the planner sent no commands")
+
+@pytest.fixture
+def planner():
+    track = Track(num_trees=0)
+    planner = AIPlanner(track, NUM_CARS)
+    yield planner, track
+    planner.close()
+
+@pytest.mark.skipif(not hasattr(signal, "SIGSTOP"), reason="needs POSIX job control signals")
+def test_stale_commands_are_dropped(planner):
+    planner, track = planner
+    wait_for_commands(planner, track)
+    os.kill(planner.process.pid, signal.SIGSTOP)
+    try:
+        for _ in range(MAX_LAG + 1):
+            publish(planner, track)
+        assert planner.poll() is None
+    finally:
+        os.kill(planner.process.pid, signal.SIGCONT)
+    wait_for_commands(planner, track)  # A worker that catches up steers again
+
+def test_dead_worker_is_ignored(planner):
+    planner, track = planner
+    wait_for_commands(planner, track)
+    planner.process.kill()
+    planner.process.join()
+    assert planner.poll() is None
@@ -0,0 +1,16 @@
+"""
+Headless races: the starting grid hands no car part of its first lap.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from headless import run_race
+
+def test_first_lap_covers_a_full_lap():
+    # A field this big fills the grid far back from the start/finish line
+    result = run_race(3, 3, 500)
+    assert result["finished"]
+    first, *later = result["lap_times"]
+    assert first >= min(later)
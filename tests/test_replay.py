@@ -0,0 +1,114 @@
+"""
+Replays: seeking puts the race back exactly as it was when recorded, and broken recordings fail loudly.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main
+from headless import BotDriver
+from replay import ReplayReader, ReplayWriter
+import trackfile
+
+SEED = 7
+
+def race_state(game_state, player, fleet, track):
+    # Everything a seek has to bring back, in comparable form
+    return {
+        "player": list(player.position),
+        "fleet": fleet.position.copy(),
+        "laps": game_state.laps,
+        "race_clock": game_state.race_clock,
+        "standings": game_state.standings.order.copy(),
+        "trees": list(track.tree_positions),
+        "scenery_rng": track.rng.getstate(),
+    }
+
+def test_seek_backward_across_lap_and_reset(tmp_path):
+    path = str(tmp_path / "race.rpl")
+    game_state, player, track, fleet = main.new_race(SEED)
+    driver = BotDriver()
+    recorder = ReplayWriter(path, SEED, len(fleet))
+    states = {}
+    lap_step = None
+    reset_step = None
+    step = 0
+    # Race past the first lap, reset, and race on a little after the restart
+    while reset_step is None or step < reset_step + 600:
+        inputs = driver(game_state, player, track).to_bits()
+        if step == 0:
+            inputs |= main.RACE_START
+        elif step == reset_step:
+            inputs |= main.RACE_RESET | main.RACE_START
+        recorder.record(inputs, game_state, player, fleet, track)
+        main.run_step(inputs, game_state, player, fleet, track)
+        step += 1
+        states[step] = race_state(game_state, player, fleet, track)
+        if lap_step is None and game_state.laps == 1:
+            lap_step = step
+            reset_step = step + 300
+    recorder.close()
+    assert game_state.ghost.best_count > 0
+
+    reader = ReplayReader(path)
+    game_state, player, track, fleet = main.new_race(SEED)
+
+    def simulate(inputs):
+        main.run_step(inputs, game_state, player, fleet, track)
+
+    reader.seek(reader.steps - 1, game_state, player, fleet, track, simulate)
+    target = lap_step - 50  # Before the first lap was completed, and before the reset
+    reader.seek(target, game_state, player, fleet, track, simulate)
+    expected = states[target]
+    actual = race_state(game_state, player, fleet, track)
+    assert actual["player"] == expected["player"]
+    assert np.array_equal(actual["fleet"], expected["fleet"])
+    assert actual["laps"] == expected["laps"] == 0
+    assert actual["race_clock"] == expected["race_clock"]
+    assert np.array_equal(actual["standings"], expected["standings"])
+    assert actual["trees"] == expected["trees"]
+    assert actual["scenery_rng"] == expected["scenery_rng"]
+    # No ghost from a lap driven later in the race
+    assert not game_state.ghost.sample(game_state.race_clock - game_state.lap_start_time)
+
+    # Replaying on from there still matches the recording, across the lap and the reset
+    for replayed in range(target, reader.steps):
+        simulate(reader.inputs(replayed))
+    expected = states[reader.steps]
+    actual = race_state(game_state, player, fleet, track)
+    assert actual["player"] == expected["player"]
+    assert np.array_equal(actual["fleet"], expected["fleet"])
+    assert np.array_equal(actual["standings"], expected["standings"])
+    assert actual["trees"] == expected["trees"]
+    assert actual["scenery_rng"] == expected["scenery_rng"]
+    reader.close()
+
+def test_empty_replay_is_refused(tmp_path):
+    path = str(tmp_path / "empty.rpl")
+    game_state, player, track, fleet = main.new_race(SEED)
+    ReplayWriter(path, SEED, len(fleet)).close()
+    with pytest.raises(ValueError):
+        ReplayReader(path)
+
+def test_writer_errors_reach_the_recorder(tmp_path):
+    game_state, player, track, fleet = main.new_race(SEED)
+    recorder = ReplayWriter(str(tmp_path / "race.rpl"), SEED, len(fleet), keyframe_interval=4, max_pending=1)
+    recorder.file.close()  # Every block write now fails
+    with pytest.raises(ValueError):
+        for _ in range(100):
+            recorder.record(0, game_state, player, fleet, track)
+
+def test_replay_on_another_track_is_refused(tmp_path):
+    path = str(tmp_path / "oval.rpl")
+    game_state, player, track, fleet = main.new_race(SEED)
+    recorder = ReplayWriter(path, SEED, len(fleet), track_hash=trackfile.track_hash(None))
+    recorder.record(main.RACE_START, game_state, player, fleet, track)
+    recorder.close()
+    assert ReplayReader(path).track_hash == trackfile.track_hash(None)
+    track_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tracks", "example.track")
+    with pytest.raises(SystemExit, match="another track"):
+        main.play_replay(path, track_path)
@@ -0,0 +1,101 @@
+"""
+Server: car state survives delta encoding, and repeated inputs are simulated once.
+"""
+import os
+import struct
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+from server import (CAR_FIELDS, INPUT, MSG_INPUT, NO_BASELINE, PROGRESS, ROTATION, X, Y, Z,
+                    ClientSlot, RaceServer, decode_cars, encode_cars, quantize_cars)
+
+def random_state(rng, count):
+    return quantize_cars(rng.uniform(-500, 500, (count, 3)), rng.uniform(0, 360, count), rng.uniform(0, 2000, count))
+
+def round_trip(state, baseline=None):
+    widths, data = encode_cars(state, baseline)
+    return widths, decode_cars(data, widths, len(state), baseline)
+
+def field_width(widths, field):
+    return server.FIELD_DTYPES[widths >> 2 * field & 3].itemsize
+
+@pytest.mark.parametrize("count", [1, 8, 9, 40])
+def test_full_snapshot_round_trip(count):
+    state = random_state(np.random.default_rng(count), count)
+    state[0] = 0  # A car that has not moved from the origin is left out entirely
+    _, decoded = round_trip(state)
+    assert np.array_equal(decoded, state)
+
+@pytest.mark.parametrize("delta, width", [
+    (1, 1), (-1, 1), (127, 1), (-128, 1), (128, 2), (-129, 2),
+    (32767, 2), (-32768, 2), (32768, 4), (-32769, 4), (2 ** 30, 4), (-2 ** 30, 4),
+])
+def test_delta_widths_at_their_limits(delta, width):
+    baseline = random_state(np.random.default_rng(5), 12)
+    state = baseline.copy()
+    for field in (X, Y, Z, PROGRESS):
+        state[field, field] += delta
+    widths, decoded = round_trip(state, baseline)
+    assert np.array_equal(decoded, state)
+    for field in (X, Y, Z, PROGRESS):
+        assert field_width(widths, field) == width
+    assert field_width(widths, ROTATION) == 1  # No rotation changed
+
+def test_delta_round_trip_without_changes():
+    baseline = random_state(np.random.default_rng(6), 20)
+    widths, data = encode_cars(baseline, baseline)
+    assert widths == 0 and len(data) == 3  # Just the bits saying no car moved
+    assert np.array_equal(decode_cars(data, widths, 20, baseline), baseline)
+
+@pytest.mark.parametrize("before, after", [
+    (359.9, 0.1), (0.1, 359.9), (0.0, 180.0), (180.0, 0.0), (90.0, 270.1), (350.0, 350.0),
+])
+def test_rotation_wraps_the_short_way(before, after):
+    baseline = quantize_cars(np.zeros((2, 3)), [before, 10.0], [0.0, 0.0])
+    state = quantize_cars(np.zeros((2, 3)), [after, 10.0], [0.0, 0.0])
+    widths, decoded = round_trip(state, baseline)
+    assert np.array_equal(decoded, state)
+    assert decoded[0, ROTATION] == round(after % 360 * server.ROTATION_SCALE) % 65536
+    # Turning the short way, even half a turn fits an i2
+    assert field_width(widths, ROTATION) <= 2
+
+def test_delta_round_trip_over_a_race():
+    rng = np.random.default_rng(7)
+    baseline = random_state(rng, 30)
+    for _ in range(50):
+        state = baseline.copy()
+        moved = rng.random(30) < 0.6
+        state[moved] += rng.integers(-40000, 40000, (np.count_nonzero(moved), CAR_FIELDS), dtype=np.int32)
+        state[:, ROTATION] %= 65536
+        _, decoded = round_trip(state, baseline)
+        assert np.array_equal(decoded, state)
+        baseline = state
+
+def test_malformed_snapshot_is_refused():
+    state = random_state(np.random.default_rng(8), 10)
+    widths, data = encode_cars(state)
+    with pytest.raises(ValueError):
+        decode_cars(data + b"\0", widths, len(state))
+
+def input_packet(newest, masks):
+    # masks oldest first, ending with the input numbered newest
+    return INPUT.pack(MSG_INPUT, NO_BASELINE, newest, len(masks)) + struct.pack(f"<{len(masks)}H", *masks)
+
+def test_repeated_inputs_are_queued_once():
+    race = RaceServer(num_ai=0, max_clients=1, verbose=False)
+    client = ClientSlot(("127.0.0.1", 1), 0, race.tick_count)
+    race.receive_input(client, input_packet(4, [1, 2, 3, 4]))
+    race.receive_input(client, input_packet(6, [3, 4, 5, 6]))  # 3 and 4 again
+    race.receive_input(client, input_packet(6, [3, 4, 5, 6]))  # A duplicated datagram
+    race.receive_input(client, input_packet(5, [2, 3, 4, 5]))  # A late one, all seen before
+    assert list(client.inputs) == [(seq, seq) for seq in range(1, 7)]
+    assert client.next_seq == 7
+
+    # Once more inputs wait than the buffer holds, the oldest go
+    race.receive_input(client, input_packet(10, [7, 8, 9, 10]))
+    assert list(client.inputs) == [(seq, seq) for seq in range(11 - server.INPUT_BUFFER, 11)]
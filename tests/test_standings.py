@@ -0,0 +1,45 @@
+"""
+Standings: the incrementally repaired order always matches a fresh stable sort.
+"""
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from standings import Standings
+
+def expected_order(progress):
+    return np.argsort(-progress, kind="stable")
+
+def test_incremental_order_matches_sorting():
+    rng = np.random.default_rng(3)
+    standings = Standings()
+    for num_cars in (8, 1, 50, 50, 2, 200):  # Repeated sizes keep the order, new ones rebuild it
+        progress = rng.uniform(0, 100, num_cars)
+        standings.update(progress)
+        reference = expected_order(progress)
+        for _ in range(200):
+            # Mostly small moves with the odd overtake, and cars dead level with others
+            progress = progress + rng.uniform(0, 2, num_cars)
+            level = rng.random(num_cars) < 0.1
+            progress[level] = progress[rng.integers(0, num_cars, np.count_nonzero(level))]
+            standings.update(progress)
+
+            # Cars level on progress keep the order they had, which a stable sort of the last
+            # order reproduces
+            reference = reference[np.argsort(-progress[reference], kind="stable")]
+            assert np.array_equal(standings.order, reference)
+            assert np.array_equal(standings.rank[standings.order], np.arange(num_cars))
+            assert np.array_equal(standings.progress, progress)
+
+def test_rebuilt_order_is_a_stable_sort():
+    standings = Standings()
+    progress = np.array([5.0, 7.0, 5.0, 7.0, 1.0])
+    standings.update(progress)
+    assert np.array_equal(standings.order, expected_order(progress))
+    assert standings.rank.tolist() == [2, 0, 3, 1, 4]
+    standings.reset()
+    standings.update(progress[:3])
+    assert np.array_equal(standings.order, expected_order(progress[:3]))
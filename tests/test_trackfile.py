@@ -0,0 +1,95 @@
+"""
+Track files: parsing, compiling, the compiled file format and the compile cache.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import trackfile
+
+SOURCE = """\
+name Test Loop
+density 0.3
+width 12
+point 0 0 -50
+point 40 2 0 16   # a wider, raised corner
+point 0 0 50
+point -40 0 0
+trees 20
+tree 10 0 10 4.5
+mountain -100 0 -150 30
+"""
+
+def compiled_arrays(data):
+    return {name: np.array(getattr(data, name)) for name in trackfile.TrackData.ARRAYS + ("trees", "mountains")}
+
+def assert_same_track(first, second):
+    assert first.name == second.name
+    assert first.random_trees == second.random_trees
+    assert first.source_hash == second.source_hash
+    for name, array in compiled_arrays(first).items():
+        assert np.array_equal(array, getattr(second, name)), name
+
+@pytest.mark.parametrize("text, message", [
+    ("point 0 0 0\npoint 1 0 0\n", "at least 3 control points"),
+    ("point 0 0 0\npoint 1 0 0\npoint 1 0 1\ndensity 0\n", "density must be positive"),
+    ("point 0 0\n", "line 1"),
+    ("point 0 0 0\nwiggle 3\n", "line 2: unknown statement"),
+    ("tree 1 2 3\n", "line 1"),
+    ("density fast\n", "line 1"),
+])
+def test_parse_errors(text, message):
+    with pytest.raises(trackfile.TrackFormatError, match=message):
+        trackfile.parse_track(text)
+
+def test_describe_round_trip():
+    data = trackfile.compile_track(SOURCE)
+    text = trackfile.describe_track(data)
+    again = trackfile.compile_track(text)
+    for name, array in compiled_arrays(data).items():
+        assert np.array_equal(array, getattr(again, name)), name
+    assert again.name == data.name and again.random_trees == data.random_trees
+    # Every control point carries its width, including those that took the default
+    assert np.array_equal(again.controls, data.controls)
+
+def test_file_round_trip(tmp_path):
+    path = str(tmp_path / "loop.trk")
+    data = trackfile.compile_track(SOURCE)
+    trackfile.write_track_file(path, data)
+    loaded = trackfile.read_track_file(path)
+    assert_same_track(data, loaded)
+    assert np.array_equal(loaded.controls, data.controls)
+    assert loaded.density == data.density == 0.3
+
+def test_cache_is_named_by_the_stored_hash(tmp_path):
+    source = tmp_path / "loop.track"
+    source.write_text(SOURCE)
+    for density in (None, 0.3, 1.0):
+        path = trackfile.compile_track_file(str(source), density)
+        assert os.path.basename(path) == trackfile.read_track_file(path).source_hash + ".trk"
+    # The density in the file and the same density asked for are the same compiled track
+    assert trackfile.compile_track_file(str(source)) == trackfile.compile_track_file(str(source), 0.3)
+
+@pytest.mark.parametrize("keep", [0, 10, 200, 1000, -8])
+def test_damaged_files(tmp_path, keep):
+    path = str(tmp_path / "loop.trk")
+    trackfile.write_track_file(path, trackfile.compile_track(SOURCE))
+    with open(path, "rb") as track_file:
+        contents = track_file.read()
+    with open(path, "wb") as track_file:
+        track_file.write(contents[:keep])
+    with pytest.raises(trackfile.TrackFormatError):
+        trackfile.read_track_file(path)
+
+def test_damaged_cache_is_recompiled(tmp_path):
+    source = tmp_path / "loop.track"
+    source.write_text(SOURCE)
+    path = trackfile.compile_track_file(str(source))
+    with open(path, "r+b") as track_file:
+        track_file.truncate(300)
+    assert trackfile.compile_track_file(str(source)) == path
+    assert_same_track(trackfile.compile_track(SOURCE), trackfile.read_track_file(path))
@@ -0,0 +1,353 @@
+"""
+Track files.
+
+A track is written as a short text description and compiled into a binary file holding
+the sampled centerline and every per-segment table the game needs, so loading it is just
+memory-mapping the arrays, however many points the track has.
+
+The text format has one statement per line; # starts a comment:
+
+    name Example Circuit
+    density 0.5              # centerline samples per unit of length
+    width 10                 # road width for control points that don't give one
+    point 0 0 100            # control point x y z [width], in driving order around the loop
+    point 60 2 80 14
+    ...
+    trees 200                # trees scattered along the road at random each race
+    tree 20 0 40 5           # a tree at x y z with the given height
+    mountain -100 0 -150 30  # a mountain at x y z with the given height
+
+The centerline is a closed centripetal Catmull-Rom spline through the control points,
+with the elevation and road width interpolated along it. The first control point is the
+start/finish line.
+
+Compiled files are cached by a hash of their source, so editing a track rebuilds it once.
+They keep the control points and settings too, so a compiled track can be turned back into
+a description to edit:
+
+    python trackfile.py tracks/example.track
+    python trackfile.py --decompile example.trk > example.track
+"""
+import argparse
+import hashlib
+import json
+import math
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import numpy as np
+
+MAGIC = b"RACETRK1"
+FORMAT_VERSION = 2
+HEADER = struct.Struct("<8sII")  # Magic, format version, length of the JSON manifest that follows
+ALIGNMENT = 64  # Arrays start on multiples of this many bytes
+
+DEFAULT_DENSITY = 0.15  # Samples per unit of length, close to the spacing of the built-in oval
+DEFAULT_WIDTH = 10.0
+
+class TrackFormatError(ValueError):
+    """A track description or compiled track file that can't be used."""
+
+class TrackData:
+    """
+    A compiled track: the sampled centerline with its precomputed tables, and the scenery.
+    Arrays are read-only views onto the memory-mapped file when loaded from disk.
+    """
+    # Arrays stored in a compiled file, besides the scenery
+    ARRAYS = ("points", "half_widths", "segment_lengths", "tangents", "normals",
+              "left_edges", "right_edges", "arc_length", "curvature")
+
+    def __init__(self, name, arrays, trees, mountains, random_trees, source_hash="", controls=None, density=None):
+        self.name = name
+        for array_name in self.ARRAYS:
+            setattr(self, array_name, arrays[array_name])
+        self.trees = trees  # (N, 4) rows of x, y, z, height
+        self.mountains = mountains  # (N, 4) rows of x, y, z, height
+        self.random_trees = random_trees  # Trees to scatter along the road, or None for the game's default
+        self.source_hash = source_hash
+        self.controls = controls  # (N, 4) rows of x, y, z, width the centerline was sampled from, if known
+        self.density = density  # Centerline samples per unit of length it was sampled at
+        self.length = float(self.arc_length[-1])
+
+def segment_geometry(points, half_widths):
+    """
+    The per-point geometry table of a closed centerline: unit tangents and normals in the ground
+    plane, left/right road edges, segment lengths, cumulative arc length and signed curvature.
+    Entry i describes the segment running from point i to point i + 1.
+    """
+    points = np.asarray(points, dtype=np.float32)
+    half_widths = np.asarray(half_widths, dtype=np.float32)
+    next_points = np.roll(points, -1, axis=0)
+
+    # Direction of each segment in the ground plane
+    direction = next_points - points
+    direction[:, 1] = 0
+    segment_lengths = np.linalg.norm(direction, axis=1)
+    tangents = direction / np.maximum(segment_lengths, 1e-9)[:, np.newaxis]
+
+    # Perpendicular vector pointing to the left edge of the road
+    normals = np.stack([-tangents[:, 2], np.zeros(len(points), dtype=np.float32), tangents[:, 0]], axis=1)
+
+    # Distance along the centerline to each point, with the full lap length at the end
+    arc_length = np.concatenate([[0.0], np.cumsum(segment_lengths, dtype=np.float64)])
+
+    # Turn angle between consecutive segments over the distance it happens across
+    previous_tangents = np.roll(tangents, 1, axis=0)
+    turn = np.arctan2(previous_tangents[:, 2] * tangents[:, 0] - previous_tangents[:, 0] * tangents[:, 2],
+                      np.sum(previous_tangents * tangents, axis=1))
+    curvature = (turn / np.maximum((segment_lengths + np.roll(segment_lengths, 1)) / 2, 1e-9)).astype(np.float32)
+
+    return {
+        "points": points,
+        "half_widths": half_widths,
+        "segment_lengths": segment_lengths,
+        "tangents": tangents,
+        "normals": normals,
+        "left_edges": points + normals * half_widths[:, np.newaxis],
+        "right_edges": points - normals * half_widths[:, np.newaxis],
+        "arc_length": arc_length,
+        "curvature": curvature,
+    }
+
+def sample_spline(controls, density):
+    """
+    Sample a closed centripetal Catmull-Rom spline through the rows of controls, about density
+    samples per unit of length. Knots are spaced by the square root of the distance between
+    control points in space, and any further columns (like the road width) are interpolated
+    along with the position. Returns the samples, starting at the first control point.
+    """
+    controls = np.asarray(controls, dtype=np.float64)
+    count = len(controls)
+    indices = np.arange(count)
+    p0, p1, p2, p3 = (controls[(indices + shift) % count] for shift in (-1, 0, 1, 2))
+
+    def knot_gap(a, b):
+        return np.maximum(np.linalg.norm(b[:, :3] - a[:, :3], axis=1) ** 0.5, 1e-6)
+
+    t1 = knot_gap(p0, p1)
+    t2 = t1 + knot_gap(p1, p2)
+    t3 = t2 + knot_gap(p2, p3)
+
+    # Each span gets samples in proportion to its length, evenly spaced in its knot interval
+    chords = np.linalg.norm(p2[:, :3] - p1[:, :3], axis=1)
+    samples_per_span = np.maximum(1, np.ceil(chords * density)).astype(np.int64)
+    span = np.repeat(indices, samples_per_span)
+    starts = np.repeat(np.cumsum(samples_per_span) - samples_per_span, samples_per_span)
+    u = (np.arange(len(span)) - starts) / samples_per_span[span]
+
+    # Barry and Goldman's pyramid for the centripetal parameterization
+    t1, t2, t3 = t1[span, np.newaxis], t2[span, np.newaxis], t3[span, np.newaxis]
+    p0, p1, p2, p3 = p0[span], p1[span], p2[span], p3[span]
+    t = t1 + u[:, np.newaxis] * (t2 - t1)
+    a1 = ((t1 - t) * p0 + t * p1) / t1
+    a2 = ((t2 - t) * p1 + (t - t1) * p2) / (t2 - t1)
+    a3 = ((t3 - t) * p2 + (t - t2) * p3) / (t3 - t2)
+    b1 = ((t2 - t) * a1 + t * a2) / t2
+    b2 = ((t3 - t) * a2 + (t - t1) * a3) / (t3 - t1)
+    return ((t2 - t) * b1 + (t - t1) * b2) / (t2 - t1)
+
+def parse_track(text):
+    """Read a track description into a dict of its settings, control points and scenery."""
+    track = {"name": "Unnamed", "density": DEFAULT_DENSITY, "width": DEFAULT_WIDTH,
+             "points": [], "trees": [], "mountains": [], "random_trees": None}
+    for number, line in enumerate(text.splitlines(), 1):
+        words = line.split("#", 1)[0].split()
+        if not words:
+            continue
+        keyword, arguments = words[0], words[1:]
+        try:
+            if keyword == "name":
+                track["name"] = " ".join(arguments)
+            elif keyword in ("density", "width"):
+                (value,) = arguments
+                track[keyword] = float(value)
+            elif keyword == "trees":
+                (value,) = arguments
+                track["random_trees"] = int(value)
+            elif keyword == "point":
+                if len(arguments) not in (3, 4):
+                    raise ValueError("expected x y z [width]")
+                track["points"].append([float(value) for value in arguments])
+            elif keyword in ("tree", "mountain"):
+                if len(arguments) != 4:
+                    raise ValueError("expected x y z height")
+                track[keyword + "s"].append([float(value) for value in arguments])
+            else:
+                raise ValueError(f"unknown statement {keyword!r}")
+        except ValueError as error:
+            raise TrackFormatError(f"line {number}: {error}") from None
+    if len(track["points"]) < 3:
+        raise TrackFormatError("a track needs at least 3 control points")
+    if track["density"] <= 0:
+        raise TrackFormatError("density must be positive")
+    return track
+
+def compile_track(text, density=None):
+    """Compile a track description into TrackData, sampling density points per unit of length."""
+    track = parse_track(text)
+    density = density or track["density"]
+    controls = np.array([point if len(point) == 4 else point + [track["width"]] for point in track["points"]])
+    samples = sample_spline(controls, density)
+    arrays = segment_geometry(samples[:, :3], samples[:, 3] / 2)
+    return TrackData(track["name"], arrays,
+                     np.array(track["trees"], dtype=np.float32).reshape(-1, 4),
+                     np.array(track["mountains"], dtype=np.float32).reshape(-1, 4),
+                     track["random_trees"], source_hash(text, density), controls, density)
+
+def describe_track(data):
+    """A track description that compiles to the same track, from TrackData that kept its control points."""
+    if data.controls is None:
+        raise TrackFormatError(f"{data.name} doesn't keep its control points")
+
+    def numbers(row):
+        return " ".join(np.format_float_positional(value, trim="-") for value in row.tolist())
+
+    lines = [f"name {data.name}", f"density {np.format_float_positional(data.density, trim='-')}"]
+    lines += [f"point {numbers(point)}" for point in data.controls]
+    if data.random_trees is not None:
+        lines.append(f"trees {data.random_trees}")
+    lines += [f"tree {numbers(tree)}" for tree in data.trees]
+    lines += [f"mountain {numbers(mountain)}" for mountain in data.mountains]
+    return "\n".join(lines) + "\n"
+
+def source_hash(text, density):
+    # Identifies a compiled track: its source, the sampling density it was compiled at and the compiler version
+    return hashlib.sha256(f"{FORMAT_VERSION}\n{density}\n{text}".encode()).hexdigest()
+
+def track_hash(data):
+    # Short fingerprint of a track, TrackData or None for the built-in oval, so races recorded or
+    # hosted on one track are never replayed or joined on another
+    return bytes.fromhex(data.source_hash[:16]) if data is not None else bytes(8)
+
+def write_track_file(path, data):
+    """Write TrackData as a compiled track file, atomically."""
+    arrays = {name: np.ascontiguousarray(getattr(data, name)) for name in TrackData.ARRAYS}
+    arrays["trees"] = np.ascontiguousarray(data.trees, dtype=np.float32)
+    arrays["mountains"] = np.ascontiguousarray(data.mountains, dtype=np.float32)
+    if data.controls is not None:
+        arrays["controls"] = np.ascontiguousarray(data.controls, dtype=np.float64)
+
+    # The manifest records where each array lives; offsets count from the start of the data area
+    manifest = {"name": data.name, "random_trees": data.random_trees, "source_hash": data.source_hash,
+                "density": data.density, "arrays": {}}
+    offset = 0
+    for name, array in arrays.items():
+        manifest["arrays"][name] = {"dtype": array.dtype.str, "shape": array.shape, "offset": offset}
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    manifest_bytes = json.dumps(manifest).encode()
+    data_start = -(-(HEADER.size + len(manifest_bytes)) // ALIGNMENT) * ALIGNMENT
+
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile("wb", dir=directory, delete=False) as track_file:
+        track_file.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(manifest_bytes)))
+        track_file.write(manifest_bytes)
+        for name, array in arrays.items():
+            track_file.seek(data_start + manifest["arrays"][name]["offset"])
+            track_file.write(array.tobytes())
+        track_file.truncate(data_start + offset)
+    publish_file(track_file.name, path)
+
+def publish_file(temp_path, path):
+    """
+    Move a finished temporary file into place, readable by everyone the umask allows: temporary
+    files are created private to their owner, which would hide a shared cache from other users.
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(temp_path, 0o666 & ~umask)
+    os.replace(temp_path, path)
+
+def read_track_file(path):
+    """Memory-map a compiled track file. Nothing is read until the arrays are used."""
+    with open(path, "rb") as track_file:
+        if os.fstat(track_file.fileno()).st_size < HEADER.size:
+            raise TrackFormatError(f"{path} is not a compiled track")
+        mapped = mmap.mmap(track_file.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, manifest_size = HEADER.unpack_from(mapped)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise TrackFormatError(f"{path} is not a version {FORMAT_VERSION} compiled track")
+    if HEADER.size + manifest_size > len(mapped):
+        raise TrackFormatError(f"{path} is cut short")
+
+    # A damaged file fails here as a TrackFormatError, whatever part of it is broken
+    try:
+        manifest = json.loads(mapped[HEADER.size:HEADER.size + manifest_size])
+        data_start = -(-(HEADER.size + manifest_size) // ALIGNMENT) * ALIGNMENT
+        arrays = {}
+        for name, layout in manifest["arrays"].items():
+            dtype = np.dtype(layout["dtype"])
+            shape = tuple(layout["shape"])
+            start = data_start + layout["offset"]
+            if layout["offset"] < 0 or start + dtype.itemsize * math.prod(shape) > len(mapped):
+                raise TrackFormatError(f"{path} is cut short")
+            arrays[name] = np.frombuffer(mapped, dtype=dtype, count=math.prod(shape), offset=start).reshape(shape)
+        return TrackData(manifest["name"], arrays, arrays["trees"], arrays["mountains"], manifest["random_trees"],
+                         manifest["source_hash"], arrays.get("controls"), manifest["density"])
+    except TrackFormatError:
+        raise
+    except (ValueError, KeyError, TypeError, IndexError) as error:
+        raise TrackFormatError(f"{path} is damaged: {error!r}") from None
+
+def default_cache_dir(source_path):
+    return os.path.join(os.path.dirname(os.path.abspath(source_path)), "track_cache")
+
+def compile_track_file(source_path, density=None, cache_dir=None):
+    """
+    Compile a track description into the cache unless an up-to-date compiled copy is there.
+    Returns the path of the compiled file.
+    """
+    with open(source_path, encoding="utf-8") as source_file:
+        text = source_file.read()
+    cache_dir = cache_dir or default_cache_dir(source_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    compiled_path = os.path.join(cache_dir, source_hash(text, density or parse_track(text)["density"]) + ".trk")
+    if os.path.exists(compiled_path):
+        try:
+            read_track_file(compiled_path)
+            return compiled_path
+        except TrackFormatError:
+            pass  # Damaged, say by a crash while it was copied in; compile it again
+    write_track_file(compiled_path, compile_track(text, density))
+    return compiled_path
+
+def load_track(path, density=None, cache_dir=None):
+    """Load a compiled track file, or a track description through the compile cache."""
+    if path.endswith(".trk"):
+        return read_track_file(path)
+    return read_track_file(compile_track_file(path, density, cache_dir))
+
+def main():
+    parser = argparse.ArgumentParser(description="Compile track descriptions into track files.")
+    parser.add_argument("sources", nargs="+", help="track descriptions to compile")
+    parser.add_argument("--density", type=float, help="centerline samples per unit of length")
+    parser.add_argument("--out", help="write the compiled track here instead of into the cache")
+    parser.add_argument("--decompile", action="store_true", help="print the description of compiled track files")
+    args = parser.parse_args()
+    if args.out and len(args.sources) > 1:
+        parser.error("--out needs a single source")
+
+    if args.decompile:
+        for source in args.sources:
+            try:
+                sys.stdout.write(describe_track(read_track_file(source)))
+            except (OSError, TrackFormatError) as error:
+                sys.exit(f"{source}: {error}")
+        return
+
+    for source in args.sources:
+        try:
+            if args.out:
+                with open(source, encoding="utf-8") as source_file:
+                    write_track_file(args.out, compile_track(source_file.read(), args.density))
+                path = args.out
+            else:
+                path = compile_track_file(source, args.density)
+        except (OSError, TrackFormatError) as error:
+            sys.exit(f"{source}: {error}")
+        data = read_track_file(path)
+        print(f"{source} -> {path}: {len(data.points)} points, {data.length:.0f} units long")
+
+if __name__ == "__main__":
+    main()